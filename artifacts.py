@@ -0,0 +1,251 @@
+#!/usr/bin/env python3
+
+# A persistent, content-addressed cache for downloaded artifacts (plugin archives, compiled plugins, etc.).
+# Artifacts are stored under their sha256 hash and indexed by URL along with the validators (ETag/Last-Modified) the
+# server handed out, so repeat downloads turn into conditional requests, or into nothing at all within max_age seconds.
+# The cache is shared by every instance and every run on the host, and is trimmed back to max_size by evicting the
+# least recently used entries.
+# Callers that know which content they want (from plugins.lock) pass its sha256, which is served straight from the
+# object store and verified when it has to be downloaded. An offline cache never touches the network at all.
+
+from fileops import copy_file
+from helpers import error
+import hashlib
+import instrumentation
+import json
+import os
+import pathlib
+import requests
+from shared import _version, _repo
+import tempfile
+import threading
+import time
+
+
+
+class ArtifactCache:
+	def __init__(self, root="artifact-cache", max_size=2048 * 1024 * 1024, max_age=3600, session=None, offline=False):
+		self.root = pathlib.PosixPath(root)
+		self.objects = self.root / "objects"
+		self.index_path = self.root / "index.json"
+		self.max_size = max_size
+		self.max_age = max_age
+		self.offline = offline
+		if session is None:
+			session = requests.Session()
+			session.headers.update({"User-Agent": f"setup.py/{_version} ({_repo})"})
+		self.session = session
+		self.lock = threading.RLock()
+		self.url_locks = {}
+		self.hits = 0
+		self.misses = 0
+		self.bytes_saved = 0
+		self.bytes_downloaded = 0
+		self.objects.mkdir(parents=True, exist_ok=True)
+		self.index = self._load_index()
+
+	def _load_index(self):
+		try:
+			with open(self.index_path) as f:
+				return json.load(f)
+		except (FileNotFoundError, json.JSONDecodeError):
+			return {}
+
+	# Writes the index atomically so a concurrently running setup.py never sees a partial file
+	def _save_index(self):
+		fd, tmp = tempfile.mkstemp(dir=self.root, prefix=".index-")
+		with os.fdopen(fd, "w") as f:
+			json.dump(self.index, f, indent="\t", sort_keys=True)
+		os.replace(tmp, self.index_path)
+
+	def _object_path(self, sha256):
+		return self.objects / sha256[:2] / sha256
+
+	# Returns the cached index entry for a URL if its object is still on disk
+	def _lookup(self, url):
+		entry = self.index.get(url)
+		if entry and self._object_path(entry["sha256"]).is_file():
+			return entry
+		return None
+
+	# Streams a response body into the object store, returning (sha256, size)
+	def _store(self, response):
+		digest = hashlib.sha256()
+		size = 0
+		fd, tmp = tempfile.mkstemp(dir=self.objects, prefix=".download-")
+		try:
+			with os.fdopen(fd, "wb") as f:
+				for chunk in response.iter_content(chunk_size=1024 * 1024):
+					digest.update(chunk)
+					size += len(chunk)
+					f.write(chunk)
+			sha256 = digest.hexdigest()
+			obj = self._object_path(sha256)
+			obj.parent.mkdir(exist_ok=True)
+			os.replace(tmp, obj)
+		except BaseException:
+			pathlib.Path(tmp).unlink(missing_ok=True)
+			raise
+		return sha256, size
+
+	def _hit(self, url, entry, dest):
+		self.hits += 1
+		self.bytes_saved += entry["size"]
+		instrumentation.count("cache_hits")
+		entry["used"] = time.time()
+		print(f"\tCache hit for {url} ({entry['sha256'][:12]})")
+		return self._materialize(entry, dest)
+
+	# Serves an object by its hash, for a URL the index may not know about
+	def _hit_object(self, url, sha256, dest):
+		obj = self._object_path(sha256)
+		self.hits += 1
+		self.bytes_saved += obj.stat().st_size
+		instrumentation.count("cache_hits")
+		entry = self._lookup(url)
+		if entry and entry["sha256"] == sha256:
+			entry["used"] = time.time()
+		print(f"\tCache hit for {url} ({sha256[:12]})")
+		return self._materialize({"sha256": sha256}, dest)
+
+	def _materialize(self, entry, dest):
+		dest = pathlib.Path(dest)
+		dest.parent.mkdir(parents=True, exist_ok=True)
+		# Copy (or reflink) rather than link; callers are free to move or modify what they get
+		copy_file(self._object_path(entry["sha256"]), dest, "reflink", skip_unchanged=False)
+		return dest
+
+	# Serializes fetches of the same URL while letting different URLs download concurrently
+	def _url_lock(self, url):
+		with self.lock:
+			return self.url_locks.setdefault(url, threading.Lock())
+
+	# Sends a GET request, backing off and retrying a few times if the server says it's rate limiting us
+	def _get(self, url, headers, attempts=3):
+		for attempt in range(attempts):
+			response = self.session.get(url, headers=headers, stream=True)
+			if response.status_code not in [429, 503] or attempt == attempts - 1:
+				return response
+			retry_after = response.headers.get("Retry-After", "")
+			delay = min(float(retry_after), 60) if retry_after.isdigit() else 5 * 2 ** attempt
+			response.close()
+			print(f"\tGot HTTP {response.status_code} for {url}; retrying in {delay:.0f}s...")
+			time.sleep(delay)
+
+	# Downloads url to dest, going through the cache. Returns the destination path.
+	# max_age overrides how long a cached copy of this URL is used without revalidating it
+	# If sha256 is given, that exact content is what's wanted: it's used from the object store if it's there no matter
+	# how old it is, and otherwise the download has to match it
+	def fetch(self, url, dest, max_age=None, sha256=None):
+		if max_age is None:
+			max_age = self.max_age
+		with self._url_lock(url):
+			with self.lock:
+				now = time.time()
+				if sha256 is not None and self._object_path(sha256).is_file():
+					dest = self._hit_object(url, sha256, dest)
+					self._save_index()
+					return dest
+				entry = self._lookup(url)
+				if entry and sha256 is not None and entry["sha256"] != sha256:
+					entry = None
+				# Fresh enough that we don't even need to ask, or we aren't allowed to
+				if entry and (self.offline or now - entry["fetched"] < max_age):
+					dest = self._hit(url, entry, dest)
+					self._save_index()
+					return dest
+			if self.offline:
+				wanted = f" with sha256 {sha256}" if sha256 else ""
+				error(f"\nERROR: {url}{wanted} isn't in the artifact cache, and we're offline.", is_issue=False)
+			# Otherwise revalidate whatever we have
+			headers = {}
+			if entry:
+				if entry.get("etag"):
+					headers["If-None-Match"] = entry["etag"]
+				if entry.get("last_modified"):
+					headers["If-Modified-Since"] = entry["last_modified"]
+			with self._get(url, headers) as response:
+				if entry and response.status_code == 304:
+					with self.lock:
+						entry["fetched"] = now
+						dest = self._hit(url, entry, dest)
+						self._save_index()
+					return dest
+				response.raise_for_status()
+				expected = sha256
+				sha256, size = self._store(response)
+				validators = (response.headers.get("ETag"), response.headers.get("Last-Modified"))
+			if expected is not None and sha256 != expected:
+				with self.lock:
+					self._collect(sha256)
+				error(f"\nERROR: {url} has changed since it was locked: expected sha256 {expected}, got {sha256}.", is_issue=False)
+			with self.lock:
+				self.misses += 1
+				self.bytes_downloaded += size
+				instrumentation.count("bytes_downloaded", size)
+				print(f"\tCache miss for {url}; downloaded {size} bytes ({sha256[:12]})")
+				entry = {
+					"sha256": sha256,
+					"size": size,
+					"etag": validators[0],
+					"last_modified": validators[1],
+					"fetched": now,
+					"used": now
+				}
+				previous = self.index.get(url)
+				self.index[url] = entry
+				if previous and previous["sha256"] != sha256:
+					self._collect(previous["sha256"])
+				elif previous and "notes" in previous:
+					# Same content as before, so whatever was worked out from it still holds
+					entry["notes"] = previous["notes"]
+				dest = self._materialize(entry, dest)
+				self._evict()
+				self._save_index()
+			return dest
+
+	# Returns the sha256 of a URL's cached content, or None
+	def digest(self, url):
+		with self.lock:
+			entry = self._lookup(url)
+			return entry["sha256"] if entry else None
+
+	# Returns something remembered about a URL's current content with set_note(), or None
+	# Notes are dropped when the content changes, so they can memoize anything derived from it
+	def note(self, url, key):
+		with self.lock:
+			entry = self._lookup(url)
+			return entry.get("notes", {}).get(key) if entry else None
+
+	def set_note(self, url, key, value):
+		with self.lock:
+			entry = self._lookup(url)
+			if entry:
+				entry.setdefault("notes", {})[key] = value
+				self._save_index()
+
+	# Removes least recently used entries until the object store fits in max_size
+	def _evict(self):
+		referenced = {}
+		for url, entry in self.index.items():
+			referenced.setdefault(entry["sha256"], []).append(url)
+		total = sum(self.index[urls[0]]["size"] for urls in referenced.values())
+		by_age = sorted(referenced, key=lambda sha256: max(self.index[url]["used"] for url in referenced[sha256]))
+		for sha256 in by_age:
+			if total <= self.max_size:
+				break
+			urls = referenced[sha256]
+			total -= self.index[urls[0]]["size"]
+			for url in urls:
+				del self.index[url]
+			self._object_path(sha256).unlink(missing_ok=True)
+			print(f"\tEvicted {sha256[:12]} from the artifact cache")
+
+	# Deletes an object if no index entry refers to it anymore
+	def _collect(self, sha256):
+		if not any(entry["sha256"] == sha256 for entry in self.index.values()):
+			self._object_path(sha256).unlink(missing_ok=True)
+
+	# Prints hit/miss statistics for this run
+	def report(self):
+		print(f"Artifact cache: {self.hits} hit(s), {self.misses} miss(es), {self.bytes_saved} bytes saved, {self.bytes_downloaded} bytes downloaded.")
@@ -0,0 +1,556 @@
+#!/usr/bin/env python3
+
+# Benchmarks setup.py without a Docker daemon, Steam or the AlliedModders forums.
+# Each scenario runs "./setup.py fleet" for some number of instances in its own scratch working directory, against:
+#	- a fake docker client, whose containers "install" a synthetic SRCDS tree of a configurable size into their data
+#	  directory, log the SteamCMD ready message, and listen on their game port while running so TCP probes succeed
+#	- a local HTTP server with generated thread pages and archives for every plugin installed, standing in for the
+#	  forums, GitHub and GitLab (it hands out ETags, so the artifact cache's conditional requests get exercised too)
+# setup.py's own instrumentation reports where the time went, and the per-phase timings of every scenario are printed
+# and saved side by side so changes to copying, extraction and plugin installation can be compared.
+#	./benchmark.py --instances 1,4,16
+
+import argparse
+import contextlib
+import docker
+import hashlib
+from helpers import STEP_MARKER
+import http.server
+from images import BASE_IMAGE
+import instrumentation
+import io
+import json
+import os
+import pathlib
+import re
+from readiness import INSTALL_READY_MESSAGE
+import requests
+from resolver import resolve
+import setup
+import shutil
+import socket
+import sys
+import tarfile
+import tempfile
+import threading
+import time
+import urllib.parse
+import zipfile
+
+
+
+# ======== Fake docker client ========
+
+# Writes a synthetic SRCDS install into a data directory: the files setup.py edits, plus bulk game files
+def write_synthetic_install(root, environment, files, size):
+	root = pathlib.PosixPath(root)
+	sourcemod = root / "tf/addons/sourcemod"
+	for d in ["tf/cfg", "tf/maps", "tf/addons/sourcemod/configs/sourcebans", "tf/addons/sourcemod/plugins/disabled", "tf/addons/sourcemod/translations"]:
+		(root / d).mkdir(parents=True, exist_ok=True)
+	server_cfg = root / "tf/cfg/server.cfg"
+	if not server_cfg.exists():
+		server_cfg.write_text(f"hostname \"{environment.get('SRCDS_HOSTNAME', '')}\"\nrcon_password \"{environment.get('SRCDS_RCONPW', '')}\"\nsv_pure 1\n")
+	databases_cfg = sourcemod / "configs/databases.cfg"
+	if databases_cfg.exists():
+		# Only the first install creates these; later boots just verify the game files
+		return write_game_files(root, files, size)
+	databases_cfg.write_text("\"Databases\"\n{\n\t\"driver_default\"\t\t\"mysql\"\n\n\t\"storage-local\"\n\t{\n\t\t\"driver\"\t\t\"sqlite\"\n\t\t\"database\"\t\t\"sourcemod-local\"\n\t}\n}\n")
+	for plugin in ["admin-flatfile", "basecommands", "funcommands", "nextmap", "rockthevote"]:
+		(sourcemod / f"plugins/{plugin}.smx").write_bytes(b"\0" * 16384)
+		(sourcemod / f"plugins/disabled/{plugin}-extra.smx").write_bytes(b"\0" * 16384)
+	write_game_files(root, files, size)
+
+
+# Writes the bulk game files, split evenly over the requested number of files
+def write_game_files(root, files, size):
+	block = os.urandom(64 * 1024)
+	per_file = size // max(files, 1)
+	for i in range(files):
+		path = root / f"tf/maps/synthetic_{i:05}.bsp"
+		if path.exists():
+			continue
+		with open(path, "wb") as f:
+			remaining = per_file
+			while remaining > 0:
+				f.write(block[:remaining])
+				remaining -= len(block)
+
+
+# A container's output, which can be followed from another thread and closed to stop following it
+class FakeLogStream:
+	def __init__(self, container, since):
+		self.container = container
+		self.since = since or 0
+		self.position = 0
+		self.closed = False
+
+	def __iter__(self):
+		return self
+
+	def __next__(self):
+		with self.container.condition:
+			while True:
+				if self.closed:
+					raise StopIteration
+				while self.position < len(self.container.output):
+					timestamp, chunk = self.container.output[self.position]
+					self.position += 1
+					if timestamp >= self.since:
+						return chunk
+				if self.container.status != "running":
+					raise StopIteration
+				self.container.condition.wait()
+
+	def close(self):
+		with self.container.condition:
+			self.closed = True
+			self.container.condition.notify_all()
+
+
+class FakeContainer:
+	def __init__(self, client, image, name, environment, volumes):
+		self.client = client
+		self.image = image
+		self.name = name
+		self.id = hashlib.sha256(f"{name}{time.time()}".encode()).hexdigest()
+		self.environment = environment or {}
+		self.data_directory = next(iter(volumes)) if volumes else None
+		self.status = "created"
+		self.output = []
+		self.condition = threading.Condition()
+		self.listener = None
+		self.execs = []
+
+	def __str__(self):
+		return f"<FakeContainer: {self.id[:12]}>"
+
+	@property
+	def attrs(self):
+		return {"Config": {"Env": [f"{key}={value}" for key, value in self.environment.items()]}}
+
+	def _log(self, text):
+		with self.condition:
+			self.output.append((time.time(), text.encode()))
+			self.condition.notify_all()
+
+	# Runs the base image's entry script: SteamCMD installs (or verifies) the game, then the server starts
+	def _boot(self):
+		time.sleep(self.client.install_seconds)
+		if self.data_directory is not None:
+			write_synthetic_install(self.data_directory, self.environment, self.client.data_files, self.client.data_size)
+		self._log(f"{INSTALL_READY_MESSAGE}\n")
+		port = self.environment.get("SRCDS_PORT")
+		if port is not None:
+			time.sleep(self.client.boot_seconds)
+			with self.condition:
+				if self.status != "running" or self.listener is not None:
+					return
+				listener = socket.socket()
+				listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+				try:
+					listener.bind(("127.0.0.1", int(port)))
+				except OSError as ex:
+					listener.close()
+					self._log(f"Couldn't bind to port {port}: {ex}\n")
+					return
+				listener.listen(64)
+				self.listener = listener
+			self._log("Server started\n")
+
+	def start(self):
+		with self.condition:
+			self.status = "running"
+			self.condition.notify_all()
+		threading.Thread(target=self._boot, daemon=True).start()
+
+	def kill(self):
+		with self.condition:
+			self.status = "exited"
+			if self.listener is not None:
+				self.listener.close()
+				self.listener = None
+			self.condition.notify_all()
+
+	def restart(self, timeout=None):
+		self.kill()
+		self.start()
+
+	def remove(self, v=False, force=False):
+		self.kill()
+		self.client.containers.remove(self)
+
+	def commit(self, repository=None, tag=None):
+		# Like docker, an image that loses its tag is still there until it's removed
+		previous = self.client.images.local.get(f"{repository}:{tag}")
+		if previous is not None:
+			self.client.images.local[previous.id] = previous
+		image = self.client.images.local[f"{repository}:{tag}"] = FakeImage(self.client.images, "sha256:" + hashlib.sha256(self.id.encode()).hexdigest())
+		return image
+
+	def exec_run(self, command, user=None, stream=False):
+		self.execs.append((user, command))
+		if not stream:
+			return 0, b""
+		# Every step of an ExecSession's script succeeds straight away
+		steps = re.findall(r"\\036start (\d+)", command[-1])
+		return None, iter([f"{STEP_MARKER}start {i}\n{STEP_MARKER}end {i} 0\n".encode() for i in steps])
+
+	def logs(self, stream=False, follow=False, since=None):
+		assert stream and follow
+		return FakeLogStream(self, since)
+
+
+class FakeContainers:
+	def __init__(self, client):
+		self.client = client
+		self.containers = {}
+		self.lock = threading.Lock()
+
+	def create(self, image, name=None, environment=None, volumes=None, **kwargs):
+		with self.lock:
+			assert name not in self.containers
+			container = self.containers[name] = FakeContainer(self.client, image, name, environment, volumes)
+		return container
+
+	def get(self, name):
+		with self.lock:
+			if name not in self.containers:
+				raise docker.errors.NotFound(f"No such container: {name}")
+			return self.containers[name]
+
+	# Like the real thing, the name filter matches substrings, and only running containers are listed unless all is set
+	def list(self, all=False, filters=None):
+		name = (filters or {}).get("name", "")
+		with self.lock:
+			return [c for c in self.containers.values() if name in c.name and (all or c.status == "running")]
+
+	def remove(self, container):
+		with self.lock:
+			self.containers.pop(container.name, None)
+
+
+class FakeImage:
+	def __init__(self, images, digest):
+		self.images = images
+		self.id = digest
+		self.attrs = {"RepoDigests": []}
+		self.labels = {}
+
+	def tag(self, repository, tag=None):
+		self.images.local[f"{repository}:{tag}"] = self
+		return True
+
+
+# Stands in for both the registry and the host's images: the registry has one digest per tag, and pulls are counted
+class FakeImages:
+	def __init__(self, registry):
+		self.registry = registry
+		self.local = {}
+		self.pulls = 0
+
+	def get_registry_data(self, reference):
+		if reference not in self.registry:
+			raise docker.errors.NotFound(f"manifest for {reference} not found")
+		return FakeImage(self, self.registry[reference])
+
+	def get(self, reference):
+		if reference not in self.local:
+			raise docker.errors.ImageNotFound(f"No such image: {reference}")
+		return self.local[reference]
+
+	def build(self, fileobj=None, tag=None, labels=None, **kwargs):
+		image = self.local[tag] = FakeImage(self, "sha256:" + hashlib.sha256(fileobj.read()).hexdigest())
+		image.labels = labels or {}
+		return image, iter([{"stream": f"Successfully tagged {tag}\n"}])
+
+	def remove(self, image, **kwargs):
+		references = [reference for reference, local in self.local.items() if image in [reference, local.id]]
+		if not references:
+			raise docker.errors.ImageNotFound(f"No such image: {image}")
+		for reference in references:
+			del self.local[reference]
+
+	def pull(self, reference, tag=None):
+		repository, digest = reference.split("@")
+		assert digest in self.registry.values()
+		self.pulls += 1
+		image = self.local[reference] = FakeImage(self, digest)
+		image.attrs["RepoDigests"].append(reference)
+		return image
+
+
+class FakeDockerClient:
+	def __init__(self, data_files, data_size, install_seconds=0, boot_seconds=0):
+		self.data_files = data_files
+		self.data_size = data_size
+		self.install_seconds = install_seconds
+		self.boot_seconds = boot_seconds
+		self.containers = FakeContainers(self)
+		self.images = FakeImages({BASE_IMAGE: "sha256:" + hashlib.sha256(BASE_IMAGE.encode()).hexdigest()})
+
+
+# ======== HTTP fixtures ========
+
+# Returns the fixture key for a URL: its host, path and query
+def fixture_key(url):
+	parts = urllib.parse.urlsplit(url)
+	return parts.netloc + parts.path + (f"?{parts.query}" if parts.query else "")
+
+
+def plugin_files(slug, size):
+	return {
+		f"addons/sourcemod/plugins/{slug}.smx": os.urandom(size),
+		f"addons/sourcemod/scripting/{slug}.sp": os.urandom(size // 4),
+		f"addons/sourcemod/translations/{slug}.phrases.txt": b"\"Phrases\"\n{\n}\n",
+	}
+
+
+def make_zip(files, leading_dir=None):
+	buffer = io.BytesIO()
+	with zipfile.ZipFile(buffer, "w") as archive:
+		if leading_dir:
+			archive.writestr(f"{leading_dir}/", b"")
+		for name, content in files.items():
+			archive.writestr(f"{leading_dir}/{name}" if leading_dir else name, content)
+	return buffer.getvalue()
+
+
+def make_tar_gz(files, root):
+	buffer = io.BytesIO()
+	with tarfile.open(fileobj=buffer, mode="w:gz") as archive:
+		info = tarfile.TarInfo(root)
+		info.type = tarfile.DIRTYPE
+		info.mode = 0o755
+		archive.addfile(info)
+		for name, content in files.items():
+			info = tarfile.TarInfo(f"{root}/{name}")
+			info.size = len(content)
+			info.mode = 0o644
+			archive.addfile(info, io.BytesIO(content))
+	return buffer.getvalue()
+
+
+# Generates the pages and archives setup.py will request for the given plugins, keyed by fixture_key()
+def plugin_fixtures(plugin_db, plugin_names, plugin_size):
+	fixtures = {}
+	for index, pname in enumerate(plugin_names):
+		p = plugin_db["plugins"][pname]
+		slug = "".join(c if c.isalnum() else "_" for c in pname.lower())
+		files = plugin_files(slug, plugin_size)
+		if "force_download" in p:
+			download = p["force_download"]
+			if download["format"] == ".zip":
+				content = make_zip(files, f"{slug}-master" if download.get("strip_leading_dir") else None)
+			elif download["format"] == ".tar.gz":
+				content = make_tar_gz(files, f"{slug}-master")
+			else:
+				content = files[f"addons/sourcemod/plugins/{slug}.smx"]
+			fixtures[fixture_key(download["url"])] = content
+			continue
+		# Thread pages link to as many attachments as plugins.json expects there to be
+		selection, attachments = p.get("force_attachment_selection", [0, 1])
+		links = []
+		for i in range(attachments):
+			link = f"attachment.php?attachmentid={index * 100 + i}&d=1"
+			links.append(f"<a href=\"{link.replace('&', '&amp;')}\">{slug}-{i}.zip</a>")
+			fixtures[fixture_key(f"https://forums.alliedmods.net/{link}")] = make_zip(files)
+		fixtures[fixture_key(p["thread_url"])] = ("<html><body>\n" + "\n".join(links) + "\n</body></html>\n").encode("latin")
+	return fixtures
+
+
+class FixtureHandler(http.server.BaseHTTPRequestHandler):
+	def do_GET(self):
+		server = self.server
+		content = server.fixtures.get(self.path.lstrip("/"))
+		if content is None:
+			self.send_error(404)
+			return
+		etag = f"\"{hashlib.sha256(content).hexdigest()[:32]}\""
+		with server.lock:
+			server.requests += 1
+		if self.headers.get("If-None-Match") == etag:
+			self.send_response(304)
+			self.send_header("ETag", etag)
+			self.end_headers()
+			return
+		self.send_response(200)
+		self.send_header("ETag", etag)
+		self.send_header("Content-Length", str(len(content)))
+		self.end_headers()
+		self.wfile.write(content)
+		with server.lock:
+			server.bytes_served += len(content)
+
+	def log_message(self, format, *args):
+		pass
+
+
+# Serves fixtures on localhost from a background thread
+class FixtureServer(http.server.ThreadingHTTPServer):
+	daemon_threads = True
+
+	def __init__(self, fixtures):
+		super().__init__(("127.0.0.1", 0), FixtureHandler)
+		self.fixtures = fixtures
+		self.lock = threading.Lock()
+		self.requests = 0
+		self.bytes_served = 0
+		threading.Thread(target=self.serve_forever, daemon=True).start()
+
+	@property
+	def base_url(self):
+		return f"http://127.0.0.1:{self.server_address[1]}/"
+
+
+# Sends every request to the fixture server instead, keeping the original host in the path
+class FixtureAdapter(requests.adapters.HTTPAdapter):
+	def __init__(self, server):
+		super().__init__()
+		self.server = server
+
+	def send(self, request, **kwargs):
+		request.url = self.server.base_url + fixture_key(request.url)
+		return super().send(request, **kwargs)
+
+
+# ======== Scenarios ========
+
+# Plugins that can be installed without custom installer scripts (those talk to APIs the fixtures don't mimic)
+def benchmark_plugins(plugin_db):
+	plugins = plugin_db["plugins"]
+	def installable(pname):
+		return "custom_install" not in plugins[pname] and ("force_download" in plugins[pname] or "thread_url" in plugins[pname])
+	return [pname for pname in plugins if all(installable(n) for n in resolve([pname], plugin_db).order)]
+
+
+# Sets up a scratch working directory that looks like a checkout of the repository with a "benchmark" profile
+def prepare_workdir(workdir, plugin_names, base_port):
+	repo = pathlib.PosixPath(__file__).resolve().parent
+	for name in ["default-settings.ini", "sample-credentials.ini", "plugins.json", "plugin-installers"]:
+		(workdir / name).symlink_to(repo / name)
+	profile = workdir / "profiles/benchmark"
+	(workdir / "profiles").mkdir()
+	(workdir / "profiles/global").symlink_to(repo / "profiles/global")
+	for d in ["direct-copy/tf/cfg", "append-to/tf/cfg", "reconfigure/tf/cfg/sourcemod"]:
+		(profile / d).mkdir(parents=True)
+	for i in range(20):
+		(profile / f"direct-copy/tf/cfg/benchmark_{i}.cfg").write_text("".join(f"sm_cvar benchmark_{i}_{j} {j}\n" for j in range(50)))
+	(profile / "append-to/tf/cfg/server.cfg").write_text("// Appended by the benchmark profile\nmp_timelimit 30\n")
+	(profile / "reconfigure/tf/cfg/server.cfg").write_text("sv_pure 2\nmp_tournament 0\n")
+	# A plugin config the server only generates once the plugin has loaded
+	(profile / "reconfigure/tf/cfg/sourcemod/benchmark.cfg").write_text("sm_benchmark_enabled 1\n")
+	(profile / "settings.ini").write_text(
+		"[srcds]\n"
+		f"SRCDS_START_PORT = {base_port}\n"
+		f"SRCDS_TV_START_PORT = {base_port + 1000}\n"
+		"SRCDS_RCONPW = benchmark\n"
+		"[readiness]\n"
+		"server-probe = tcp\n"
+		"install-timeout = 300\n"
+		"server-timeout = 60\n"
+		"initial-delay = 0.05\n"
+		"max-delay = 0.5\n"
+		"[rolling]\n"
+		"drain-interval = 0.1\n"
+		"[plugins]\n"
+		f"requested-plugins = {', '.join(plugin_names)}\n"
+	)
+
+
+# Runs one scenario and returns setup.py's run report for it
+def run_scenario(args, instances, server, plugin_names, log):
+	workdir = pathlib.PosixPath(tempfile.mkdtemp(prefix=f"benchmark-{instances}-"))
+	prepare_workdir(workdir, plugin_names, args.base_port)
+	client = FakeDockerClient(args.data_files, args.data_size_mb * 1024 * 1024, args.install_seconds, args.boot_seconds)
+	adapter = FixtureAdapter(server)
+	instrumentation.shared = instrumentation.Recorder("shared")
+	cwd = os.getcwd()
+	from_env = docker.from_env
+	get_adapter = requests.Session.get_adapter
+	docker.from_env = lambda: client
+	requests.Session.get_adapter = lambda session, url: adapter
+	argv = ["-p", "benchmark", "-r", "bench", "--instances", f"1-{instances}", "--parallel", str(min(args.parallel, instances)), "--host-ip", "127.0.0.1", "-o", "-e"]
+	os.chdir(workdir)
+	start = time.monotonic()
+	try:
+		with contextlib.redirect_stdout(log):
+			try:
+				setup.fleet_main(argv)
+			except SystemExit as ex:
+				print(f"setup.py exited with {ex.code}")
+		elapsed = time.monotonic() - start
+		with open(max(pathlib.PosixPath("reports").glob("fleet-*.json"))) as f:
+			report = json.load(f)
+		# Then replace the running instances with a rolling update
+		if args.rolling:
+			start = time.monotonic()
+			with contextlib.redirect_stdout(log):
+				try:
+					setup.fleet_main(argv[:argv.index("-o")] + ["--rolling", "--report-dir", "reports/rolling"])
+				except SystemExit as ex:
+					print(f"setup.py exited with {ex.code}")
+			rolling_elapsed = time.monotonic() - start
+			with open(max(pathlib.PosixPath("reports/rolling").glob("fleet-*.json"))) as f:
+				report["rolling"] = json.load(f)
+			report["rolling"]["wall_seconds"] = round(rolling_elapsed, 3)
+	finally:
+		os.chdir(cwd)
+		# Stop the fake servers so the next scenario can use their ports
+		for container in client.containers.list(all=True):
+			container.kill()
+		docker.from_env = from_env
+		requests.Session.get_adapter = get_adapter
+		if not args.keep:
+			shutil.rmtree(workdir, ignore_errors=True)
+	report["benchmark"] = {"instances": instances, "wall_seconds": round(elapsed, 3), "workdir": str(workdir)}
+	return report
+
+
+def main(argv):
+	parser = argparse.ArgumentParser(description="Benchmarks setup.py against a fake docker client and local HTTP fixtures.", formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+	parser.add_argument("--instances", type=str, default="1,4,16", help="Comma-separated instance counts to benchmark.")
+	parser.add_argument("--parallel", type=int, default=4, help="How many instances setup.py provisions at the same time.")
+	parser.add_argument("--data-files", type=int, default=500, help="How many game files each synthetic SRCDS install has.")
+	parser.add_argument("--data-size-mb", type=int, default=64, help="The total size of each synthetic SRCDS install's game files.")
+	parser.add_argument("--plugin-size-kb", type=int, default=256, help="The size of each fake plugin binary.")
+	parser.add_argument("--install-seconds", type=float, default=0, help="How long the fake SteamCMD install takes.")
+	parser.add_argument("--boot-seconds", type=float, default=0, help="How long fake servers take to start listening after the install.")
+	parser.add_argument("--base-port", type=int, default=47015, help="The first game port for fake servers to listen on.")
+	parser.add_argument("--output", type=str, default="reports", help="Where to save the combined benchmark report.")
+	parser.add_argument("--log", type=str, default="benchmark.log", help="Where setup.py's output goes.")
+	parser.add_argument("--keep", action="store_true", help="Keeps each scenario's scratch working directory.")
+	parser.add_argument("--rolling", action="store_true", help="Also times a rolling update of each scenario's instances after provisioning them.")
+	args = parser.parse_args(argv)
+
+	with open("plugins.json") as f:
+		plugin_db = json.load(f)
+	plugin_names = benchmark_plugins(plugin_db)
+	print(f"Generating fixtures for {len(plugin_names)} plugins...")
+	server = FixtureServer(plugin_fixtures(plugin_db, plugin_names, args.plugin_size_kb * 1024))
+	output = os.path.abspath(args.output)
+
+	reports = []
+	with open(args.log, "w") as log:
+		for instances in [int(n) for n in args.instances.split(",")]:
+			print(f"\n======== {instances} instance(s), up to {min(args.parallel, instances)} at a time ========")
+			served = server.bytes_served
+			report = run_scenario(args, instances, server, plugin_names, log)
+			report["benchmark"]["bytes_served"] = server.bytes_served - served
+			reports.append(report)
+			summary = report["summary"]
+			print(f"{report['benchmark']['wall_seconds']:.1f}s total, {summary['failed']} failed, {report['benchmark']['bytes_served']} bytes served\n")
+			instrumentation.print_summary(summary)
+			shared = report["shared"]
+			print("Shared: " + ", ".join([f"{p['name']} {p['wall_seconds']:.1f}s" for p in shared["phases"]] + [f"{counter}: {amount}" for counter, amount in sorted(shared["counters"].items())]))
+			if args.rolling:
+				rolling = report["rolling"]
+				print(f"\nRolling update: {rolling['wall_seconds']:.1f}s total, {rolling['summary']['failed']} failed\n")
+				instrumentation.print_summary(rolling["summary"])
+	server.shutdown()
+
+	path = instrumentation.save_report({"argv": argv, "scenarios": reports}, output, "benchmark")
+	print(f"\nSaved the benchmark report to {path}; setup.py's output is in {args.log}")
+
+
+if __name__ == "__main__":
+	main(sys.argv[1:])
@@ -0,0 +1,135 @@
+#!/usr/bin/env python3
+
+# Applies a profile to a data directory once and reuses the result for every instance.
+# Nearly everything provisioning does to a data directory is the same for every instance of a profile: the "global"
+# and profile layers, SourceMod plugin toggles and plugin installation. A bundle is what those steps change in a
+# freshly installed data directory: the files they add or change, and the paths they remove. It's built on a scratch
+# copy of the first instance's data directory, then copied into every instance, which only gets its own values (the
+# server.cfg hostname and rcon password, profile modules, deferred installations like the SBPP ServerID) on top.
+# Bundles are kept in bundles/<profile>/, named after a hash of everything that went into them, so later runs with
+# the same profile files, plugins, locked downloads and docker image reuse them as well.
+
+from fileops import copy_file, diff_trees, sha256_file, sync_tree
+from golden import STAMP_NAME, seed_data_dir
+import hashlib
+from layers import MANIFEST_NAME, layer_files
+import json
+import os
+import pathlib
+import re
+import shutil
+import tempfile
+import threading
+import time
+
+
+
+BUNDLE_VERSION = 1
+
+METADATA_NAME = "bundle.json"
+
+# The server.cfg settings that differ between instances are built into bundles as these placeholders
+PLACEHOLDERS = {"SRCDS_HOSTNAME": "{{TF2_DOCKER_SRCDS_HOSTNAME}}", "SRCDS_RCONPW": "{{TF2_DOCKER_SRCDS_RCONPW}}"}
+
+
+# Hashes everything a bundle is built from: the profiles' layer files, the image its base install came from, and
+# whatever else the caller passes in (plugin settings, plugins.json entries, installer scripts, locked downloads)
+def bundle_key(profile_names, image, inputs):
+	layers = {}
+	for profile_name in profile_names:
+		for kind in ["direct-copy", "append-to"]:
+			layers[f"{profile_name}/{kind}"] = {rel_path: sha256_file(path) for rel_path, path in layer_files(profile_name, kind).items()}
+	key = {"version": BUNDLE_VERSION, "image": image, "layers": layers, "inputs": inputs}
+	return hashlib.sha256(json.dumps(key, sort_keys=True).encode()).hexdigest()
+
+
+# Fills an instance's values in for the placeholders in a server.cfg document
+def fill_placeholders(document, srcds):
+	for name, placeholder in PLACEHOLDERS.items():
+		document.sub(re.escape(placeholder), lambda match: srcds[name])
+
+
+class Bundle:
+	def __init__(self, path, metadata):
+		self.path = path
+		self.key = metadata["key"]
+		self.removed = metadata["removed"]
+		# The profile's deferred installations, which every instance runs for itself
+		self.deferred = metadata["deferred"]
+
+	# Copies the bundle into a freshly installed data directory
+	# Files are always copied (or reflinked), since instances go on to edit them
+	def apply(self, data_directory):
+		print(f"Applying the profile bundle {self.key[:12]}...")
+		stats = sync_tree(self.path / "files", data_directory, "reflink")
+		for rel_path in self.removed:
+			pathlib.PosixPath(f"{data_directory}/{rel_path}").unlink(missing_ok=True)
+		print(f"Profile bundle: {stats['copied']} file(s) copied, {stats['unchanged']} unchanged, {len(self.removed)} removed.")
+
+
+# Hands out one bundle per profile and run, building it the first time it's needed unless it's already cached
+class BundleCache:
+	def __init__(self, root, profile_name, keep=3):
+		self.root = pathlib.PosixPath(root) / profile_name
+		self.keep = keep
+		self.bundle = None
+		self.lock = threading.Lock()
+
+	# Returns the run's bundle, building it with build(tree) on a scratch copy of base if it hasn't been
+	# key is called for the bundle's key, before building if reuse is set (the key's inputs have to be final by then)
+	# and afterwards to name the new bundle; build returns the deferred installations
+	def get(self, key, base, build, reuse=True):
+		with self.lock:
+			if self.bundle is None:
+				self.bundle = (self._load(key()) if reuse else None) or self._build(key, base, build)
+			return self.bundle
+
+	def _load(self, key):
+		path = self.root / key
+		try:
+			with open(path / METADATA_NAME) as f:
+				metadata = json.load(f)
+		except FileNotFoundError:
+			return None
+		# Bundles are trimmed by when they were last used
+		os.utime(path / METADATA_NAME)
+		print(f"Reusing the profile bundle {key[:12]}.")
+		return Bundle(path, metadata)
+
+	def _build(self, key, base, build):
+		self.root.mkdir(parents=True, exist_ok=True)
+		scratch = pathlib.PosixPath(tempfile.mkdtemp(prefix=".build-", dir=self.root))
+		try:
+			print(f"Building a profile bundle from {base}...")
+			tree = scratch / "tree"
+			seed_data_dir(base, tree, mode="hardlink", skipped={MANIFEST_NAME})
+			deferred = build(tree)
+			removed, added, changed = diff_trees(base, tree, ignore={STAMP_NAME})
+			staging = scratch / "bundle"
+			(staging / "files").mkdir(parents=True)
+			for rel_path in added + changed:
+				destination = staging / "files" / rel_path
+				destination.parent.mkdir(parents=True, exist_ok=True)
+				copy_file(tree / rel_path, destination, "hardlink", skip_unchanged=False)
+			metadata = {"key": key(), "built": time.time(), "removed": removed, "deferred": deferred}
+			with open(staging / METADATA_NAME, "w") as f:
+				json.dump(metadata, f, indent="\t")
+			path = self.root / metadata["key"]
+			try:
+				os.replace(staging, path)
+			except OSError:
+				# Another setup.py built the same bundle first
+				pass
+			print(f"Built the profile bundle {metadata['key'][:12]}: {len(added)} file(s) added, {len(changed)} changed, {len(removed)} removed.")
+		finally:
+			shutil.rmtree(scratch, ignore_errors=True)
+		self._trim()
+		return Bundle(path, metadata)
+
+	# Removes all but the most recently used bundles
+	def _trim(self):
+		bundles = [path for path in self.root.iterdir() if (path / METADATA_NAME).exists()]
+		bundles.sort(key=lambda path: (path / METADATA_NAME).stat().st_mtime, reverse=True)
+		for path in bundles[self.keep:]:
+			print(f"Removing the old profile bundle {path.name[:12]}.")
+			shutil.rmtree(path, ignore_errors=True)
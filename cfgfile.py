@@ -0,0 +1,140 @@
+#!/usr/bin/env python3
+
+# An in-memory model of server.cfg-style files (one "convar value" per line, "//" comments).
+# Each file is parsed once into its lines plus an index from convar name to the lines setting it. Edits, appended
+# blocks and reconfigure settings are applied in memory, and a CfgWorkspace writes every changed file exactly once
+# when it's flushed. Convar names are compared literally (and case-insensitively, like the engine does) rather
+# than being used as regular expressions.
+
+from keyvalues import KeyValuesDocument
+import os
+import pathlib
+import re
+
+
+
+# Returns the convar name a line sets, or None for blank lines and comments
+def line_key(line):
+	stripped = line.strip()
+	if stripped == "" or stripped.startswith("//"):
+		return None
+	return stripped.split(None, 1)[0].strip('"').lower()
+
+
+class CfgDocument:
+	def __init__(self, path):
+		self.path = pathlib.PosixPath(path)
+		self.set_text(self.path.read_text())
+		self.stat = os.stat(self.path)
+		self.dirty = False
+		# (key, "overridden" or "added") for every convar changed through this document
+		self.changes = []
+
+	def set_text(self, text):
+		self.lines = text.split("\n")
+		self.index = {}
+		for i, line in enumerate(self.lines):
+			key = line_key(line)
+			if key is not None:
+				self.index.setdefault(key, []).append(i)
+		self.dirty = True
+
+	@property
+	def text(self):
+		return "\n".join(self.lines)
+
+	# Makes every line setting the line's convar into the given line, or adds it at the end if there aren't any
+	def set(self, line):
+		key = line_key(line)
+		assert key is not None
+		if key in self.index:
+			for i in self.index[key]:
+				self.lines[i] = line
+			self.changes.append((key, "overridden"))
+		else:
+			# Keep the trailing newline at the end of the file
+			position = len(self.lines) - 1 if self.lines and self.lines[-1] == "" else len(self.lines)
+			self.lines.insert(position, line)
+			self.index[key] = [position]
+			self.changes.append((key, "added"))
+		self.dirty = True
+
+	# Appends a block of text to the end of the file
+	def append(self, block):
+		self._note_block(block)
+		self.set_text(self.text + block)
+
+	# Replaces the last occurrence of a block with another; returns False if the old block isn't there
+	def replace_block(self, old, new):
+		text = self.text
+		start = text.rfind(old)
+		if start == -1:
+			return False
+		self._note_block(new)
+		self.set_text(text[:start] + new + text[start + len(old):])
+		return True
+
+	# Applies a regular expression substitution to every line, for files that aren't simple convar lists
+	def sub(self, pattern, repl):
+		self.set_text(re.sub(pattern, repl, self.text, flags=re.M))
+
+	# Records which convars an appended block sets, and whether they were already set earlier in the file
+	def _note_block(self, block):
+		for line in block.split("\n"):
+			key = line_key(line)
+			if key is not None:
+				self.changes.append((key, "overridden" if key in self.index else "added"))
+
+	def save(self):
+		if self.dirty:
+			self.path.write_text(self.text)
+			self.dirty = False
+
+
+# Hands out one document per file in a data directory and writes them all out at once
+class CfgWorkspace:
+	def __init__(self, data_directory):
+		self.data_directory = pathlib.PosixPath(data_directory)
+		self.documents = {}
+
+	def open(self, cfg):
+		return self._open(cfg, CfgDocument)
+
+	# Opens a SourceMod KeyValues config (databases.cfg, etc.) for path-based edits
+	def open_keyvalues(self, cfg):
+		return self._open(cfg, KeyValuesDocument)
+
+	def _open(self, cfg, document_class):
+		assert not cfg.startswith(str(self.data_directory))
+		assert not cfg.startswith("/")
+		cfg = pathlib.PosixPath(cfg).as_posix()
+		document = self.documents.get(cfg)
+		# Mixing line edits and KeyValues edits on one file would lose one set of them
+		assert document is None or isinstance(document, document_class)
+		if document is not None and not document.dirty:
+			# Something else may have replaced the file since we read it
+			stat = os.stat(document.path)
+			if (stat.st_mtime_ns, stat.st_size) != (document.stat.st_mtime_ns, document.stat.st_size):
+				document = None
+		if document is None:
+			document = self.documents[cfg] = document_class(self.data_directory / cfg)
+		return document
+
+	# Drops pending changes to a file that's about to be replaced wholesale
+	def forget(self, cfg):
+		self.documents.pop(pathlib.PosixPath(cfg).as_posix(), None)
+
+	# Writes every changed file once and reports which settings were overridden or added
+	def flush(self):
+		for cfg, document in self.documents.items():
+			if not document.dirty:
+				continue
+			document.save()
+			overridden = sorted({key for key, change in document.changes if change == "overridden"})
+			added = sorted({key for key, change in document.changes if change == "added"} - set(overridden))
+			print(f"Wrote {cfg}: {len(overridden)} setting(s) overridden, {len(added)} added.")
+			if overridden:
+				print(f"\tOverridden: {', '.join(overridden)}")
+			if added:
+				print(f"\tAdded: {', '.join(added)}")
+		self.documents = {}
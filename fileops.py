@@ -0,0 +1,182 @@
+#!/usr/bin/env python3
+
+# Filesystem operations shared by everything that builds a data directory: seeding it from the golden install,
+# direct-copying profile files, installing plugins and fixing permissions.
+# Trees are walked once with os.scandir, which gets each entry's type from the directory listing instead of a stat
+# call per file. Files are hardlinked or reflinked where that's allowed, and otherwise copied in the kernel with
+# copy_file_range. Copies never write through an existing destination file, since it may be hardlinked to the golden
+# install, and destinations that already match their source are left alone.
+
+import errno
+import fcntl
+import filecmp
+import hashlib
+import instrumentation
+import os
+import pathlib
+import shutil
+import stat
+
+
+
+# ioctl request for a copy-on-write clone of a whole file (from linux/fs.h)
+FICLONE = 0x40049409
+
+
+# Yields (relative path, os.DirEntry) for everything under root, parents before their contents
+# Symlinks are yielded but not followed
+def walk(root, rel_root=""):
+	with os.scandir(root) as entries:
+		entries = sorted(entries, key=lambda entry: entry.name)
+	for entry in entries:
+		rel_path = f"{rel_root}{entry.name}"
+		yield rel_path, entry
+		if entry.is_dir(follow_symlinks=False):
+			yield from walk(entry.path, f"{rel_path}/")
+
+
+# Lists the regular files under root, relative to it
+def list_files(root):
+	if not os.path.isdir(root):
+		return {}
+	return {rel_path: pathlib.PosixPath(entry.path) for rel_path, entry in walk(root) if entry.is_file(follow_symlinks=False)}
+
+
+def sha256_file(path):
+	digest = hashlib.sha256()
+	with open(path, "rb") as f:
+		for chunk in iter(lambda: f.read(1024 * 1024), b""):
+			digest.update(chunk)
+	return digest.hexdigest()
+
+
+# Returns whether destination already has the same contents as a source file with the given stat result
+# Matching sizes and modification times are trusted; if only the sizes match, the contents are compared, and the
+# destination's times are fixed up so the next check is cheap again
+def matches(source, source_stat, destination):
+	try:
+		destination_stat = os.stat(destination, follow_symlinks=False)
+	except FileNotFoundError:
+		return False
+	if not stat.S_ISREG(destination_stat.st_mode) or destination_stat.st_size != source_stat.st_size:
+		return False
+	if destination_stat.st_mtime_ns == source_stat.st_mtime_ns:
+		return True
+	if sha256_file(source) != sha256_file(destination):
+		return False
+	os.utime(destination, ns=(source_stat.st_atime_ns, source_stat.st_mtime_ns))
+	return True
+
+
+# Copies a file's contents within the kernel, reflinking it if reflink is set and the filesystem can
+def _copy_contents(source, destination, reflink):
+	with open(source, "rb") as src, open(destination, "wb") as dst:
+		if reflink:
+			try:
+				fcntl.ioctl(dst.fileno(), FICLONE, src.fileno())
+				return
+			except OSError:
+				pass
+		try:
+			size = os.fstat(src.fileno()).st_size
+			while os.copy_file_range(src.fileno(), dst.fileno(), size) > 0:
+				pass
+		except OSError as ex:
+			# Not supported between these filesystems (or by this kernel); copy it the usual way
+			if ex.errno not in [errno.EXDEV, errno.ENOSYS, errno.EOPNOTSUPP, errno.EINVAL]:
+				raise
+			src.seek(0)
+			dst.seek(0)
+			dst.truncate()
+			shutil.copyfileobj(src, dst, 1024 * 1024)
+
+
+# Puts a copy of source at destination, replacing (never writing through) whatever is there already
+# mode is one of "hardlink", "reflink" or "copy"; hardlinks fall back to reflinks where they aren't allowed
+# Returns "linked", "copied" or "unchanged"
+def copy_file(source, destination, mode="copy", skip_unchanged=True):
+	assert mode in ["hardlink", "reflink", "copy"]
+	destination = pathlib.PosixPath(destination)
+	source_stat = os.stat(source)
+	if skip_unchanged and matches(source, source_stat, destination):
+		return "unchanged"
+	partial = destination.with_name(f".{destination.name}.part")
+	try:
+		if mode == "hardlink":
+			partial.unlink(missing_ok=True)
+			try:
+				os.link(source, partial)
+				os.replace(partial, destination)
+				return "linked"
+			except OSError as ex:
+				# Different filesystems, or protected_hardlinks forbids linking files we don't own
+				if ex.errno not in [errno.EXDEV, errno.EPERM]:
+					raise
+		# A partial file left over from a failed attempt may be a hardlink, so it's never opened and written to
+		partial.unlink(missing_ok=True)
+		_copy_contents(source, partial, mode != "copy")
+		shutil.copystat(source, partial)
+		os.replace(partial, destination)
+	finally:
+		partial.unlink(missing_ok=True)
+	return "copied"
+
+
+# Makes destination mirror the files under source, leaving files that already match alone
+# include is called with each path relative to source and returns whether to sync it
+# Returns counts of what was done, along with how many bytes were copied
+def sync_tree(source, destination, mode="copy", include=None):
+	stats = {"linked": 0, "copied": 0, "unchanged": 0, "bytes": 0}
+	destination = pathlib.PosixPath(destination)
+	destination.mkdir(parents=True, exist_ok=True)
+	for rel_path, entry in walk(source):
+		if include is not None and not include(rel_path):
+			continue
+		target = destination / rel_path
+		if entry.is_symlink():
+			target.unlink(missing_ok=True)
+			target.symlink_to(os.readlink(entry.path))
+		elif entry.is_dir():
+			target.mkdir(exist_ok=True)
+		elif entry.is_file():
+			result = copy_file(entry.path, target, mode)
+			stats[result] += 1
+			if result == "copied":
+				stats["bytes"] += entry.stat().st_size
+	instrumentation.count("files_linked", stats["linked"])
+	instrumentation.count("files_copied", stats["copied"])
+	instrumentation.count("bytes_copied", stats["bytes"])
+	return stats
+
+
+# Compares the regular files under two trees, returning the paths (relative to them) that are only in the old tree,
+# only in the new one, and in both with different contents
+# Files that are links to the same inode aren't read, so trees seeded from the same golden install compare quickly
+def diff_trees(old, new, ignore=()):
+	old_files = {rel_path: entry for rel_path, entry in walk(old) if entry.is_file(follow_symlinks=False) and rel_path not in ignore}
+	new_files = {rel_path: entry for rel_path, entry in walk(new) if entry.is_file(follow_symlinks=False) and rel_path not in ignore}
+	changed = []
+	for rel_path in sorted(old_files.keys() & new_files.keys()):
+		old_stat, new_stat = old_files[rel_path].stat(), new_files[rel_path].stat()
+		if (old_stat.st_dev, old_stat.st_ino) == (new_stat.st_dev, new_stat.st_ino):
+			continue
+		if not filecmp.cmp(old_files[rel_path].path, new_files[rel_path].path, shallow=False):
+			changed.append(rel_path)
+	return sorted(old_files.keys() - new_files.keys()), sorted(new_files.keys() - old_files.keys()), changed
+
+
+# Sets permissions on everything under path in a single pass, only touching entries that aren't already right
+# type_permissions maps file name endings (like ".php") to the permissions files with them get instead
+def normalize_permissions(path, dir_permissions=0o755, file_permissions=0o644, type_permissions={}):
+	changed = 0
+	for rel_path, entry in walk(path):
+		if entry.is_dir(follow_symlinks=False):
+			mode = dir_permissions
+		elif entry.is_file(follow_symlinks=False):
+			mode = next((m for extension, m in type_permissions.items() if entry.name.endswith(extension)), file_permissions)
+		else:
+			continue
+		if stat.S_IMODE(entry.stat(follow_symlinks=False).st_mode) != mode:
+			os.chmod(entry.path, mode)
+			changed += 1
+	return changed
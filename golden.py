@@ -0,0 +1,69 @@
+#!/usr/bin/env python3
+
+# Maintains a host-level "golden" SRCDS install that new containers' data directories are seeded from.
+# The golden install is kept up to date by a throwaway container, so each new container's SteamCMD run only has to
+# verify the game files instead of downloading all of app 232250 again.
+# Game files are hardlinked (or reflinked) from the golden install, which saves disk space and lets every container
+# share the same page cache. Files that get edited per instance are always copied so that the golden install is
+# never modified through a link.
+
+from fileops import sync_tree
+from helpers import header
+import os
+import pathlib
+from readiness import install_probe, wait_for
+import time
+
+
+
+# Files under these paths are edited per instance (cfg appends, plugin installs, etc.), so they're always copied
+COPIED_PREFIXES = ("tf/cfg/", "tf/addons/")
+
+# The base image generates these from each container's environment on its first run, so they aren't seeded
+SKIPPED_PATHS = {"tf/cfg/server.cfg"}
+
+# When the golden install was last brought up to date, and which image did it
+STAMP_NAME = ".golden-updated"
+
+# Brings the golden install up to date with a temporary container if it's older than max_age seconds or was made by
+# a different image
+def update_golden(client, image, path, max_age, install_timeout):
+	golden = pathlib.PosixPath(path).resolve()
+	stamp = golden / STAMP_NAME
+	if stamp.exists() and time.time() - stamp.stat().st_mtime < max_age and stamp.read_text() == image:
+		print(f"The golden SRCDS install at {golden} is up to date.")
+		return golden
+
+	header(f"Updating the golden SRCDS install at {golden}...", newlines=(1, 0))
+	golden.mkdir(parents=True, exist_ok=True)
+	name = "tf2-golden-install"
+	for c in client.containers.list(all=True, filters={"name": name}):
+		print(f"Removing leftover container \"{c.name}\" ({c})...")
+		c.remove(force=True)
+	# This container isn't a real server, so it doesn't get host networking and can't collide with running instances
+	container = client.containers.create(image, detach=True, name=name, volumes={str(golden): {"bind": "/home/steam/tf-dedicated/"}})
+	try:
+		container.start()
+		wait_for("golden SRCDS install", install_probe(container), install_timeout)
+	finally:
+		container.remove(force=True)
+	stamp.write_text(image)
+	header("Golden SRCDS install updated!", newlines=(1, 0))
+	return golden
+
+
+# Seeds a data directory from the golden install (or another SRCDS install), leaving out the skipped paths
+# mode is one of "hardlink", "reflink" or "copy"; returns the number of files linked and copied
+def seed_data_dir(golden, data_dir, mode="hardlink", skipped=SKIPPED_PATHS):
+	assert mode in ["hardlink", "reflink", "copy"]
+	print(f"Seeding {data_dir} from {golden} ({mode})...")
+	def include(rel_path):
+		return rel_path != STAMP_NAME and rel_path not in skipped
+	# Files that get edited per instance are synced separately, so they're never linked
+	stats = sync_tree(golden, data_dir, mode, include=lambda rel_path: include(rel_path) and not (rel_path + "/").startswith(COPIED_PREFIXES))
+	for prefix in COPIED_PREFIXES:
+		if os.path.isdir(f"{golden}/{prefix}"):
+			copied = sync_tree(f"{golden}/{prefix}", f"{data_dir}/{prefix}", "copy" if mode == "copy" else "reflink", include=lambda rel_path: include(prefix + rel_path))
+			stats = {key: stats[key] + copied[key] for key in stats}
+	print(f"Seeded {stats['linked']} linked and {stats['copied']} copied file(s), {stats['unchanged']} already up to date.")
+	return stats["linked"], stats["copied"]
@@ -1,28 +1,89 @@
 #!/usr/bin/env python3
 
-import a2s
+import codecs
+import instrumentation
 import os
 import pathlib
 import re
 from shared import _version, _repo
 import shutil
-import socket
 import subprocess
 import tarfile
 import textwrap
+import threading
 import time
 from xkcdpass import xkcd_password as xp
 import zipfile
 
 
 
+# Marks the lines an ExecSession's script prints about its own progress, as opposed to the output of its steps
+STEP_MARKER = "\x1e"
+
+
+# Runs a script of steps in a container with a single exec, streaming their output as it comes
+# Each step runs in its own subshell; the first one that fails stops the session, and its number, command and exit
+# code are reported
+class ExecSession:
+	def __init__(self, container, user):
+		self.container = container
+		self.user = user
+		self.steps = []
+
+	def add(self, command):
+		self.steps.append(command)
+		return self
+
+	def script(self):
+		lines = []
+		for i, command in enumerate(self.steps):
+			lines.append(f"printf '\\036start {i}\\n'")
+			lines.append(f"( {command}\n) 2>&1")
+			lines.append(f"rc=$?; printf '\\036end {i} %d\\n' \"$rc\"; [ \"$rc\" = 0 ] || exit \"$rc\"")
+		return "\n".join(lines) + "\n"
+
+	# Runs the steps, printing their output, and returns a list of {"command", "exit_code", "seconds"} for each one
+	# that ran. Exits with an error if one of them fails.
+	def run(self):
+		results = []
+		# Sessions are often built conditionally; there's no need to exec anything for an empty one
+		if not self.steps:
+			return results
+		started = None
+		decoder = codecs.getincrementaldecoder("utf-8")(errors="replace")
+		pending = ""
+		exit_code, output = self.container.exec_run(["bash", "-c", self.script()], user=self.user, stream=True)
+		instrumentation.count("docker_execs")
+		instrumentation.count("exec_steps", len(self.steps))
+		for chunk in output:
+			*lines, pending = (pending + decoder.decode(chunk)).split("\n")
+			for line in lines:
+				# A step's output may not end with a newline, so markers can come after some of it
+				text, marker, progress = line.partition(STEP_MARKER)
+				if text or not marker:
+					print(text)
+				if not marker:
+					continue
+				event, i, *rc = progress.split()
+				i = int(i)
+				if event == "start":
+					started = time.monotonic()
+					print(f"$ {self.steps[i]}")
+					continue
+				results.append({"command": self.steps[i], "exit_code": int(rc[0]), "seconds": round(time.monotonic() - started, 3)})
+				print(f"(exit code {rc[0]} after {results[-1]['seconds']:.1f}s)")
+		if pending:
+			print(pending)
+		if len(results) < len(self.steps) or results[-1]["exit_code"] != 0:
+			failed = len(results) - 1 if results and results[-1]["exit_code"] != 0 else len(results)
+			reason = f"exit code {results[-1]['exit_code']}" if failed < len(results) else "the exec ended before it finished"
+			error(f"\nERROR: Step {failed + 1} of {len(self.steps)} in {self.container.name} failed ({reason}): {self.steps[failed]}", is_issue=False)
+		return results
+
+
 # Helper function that makes sure commands execute successfully
 def assert_exec(container, user, command):
-	exit_code, output = container.exec_run(command, user=user)
-	output = output.decode()
-	if output:
-		print(f"{output}\n")
-	assert exit_code == 0
+	return ExecSession(container, user).add(command).run()[0]
 
 
 # Outputs an error message and links to the GitLab repo if what happened may be an issue, then exits
@@ -59,18 +120,34 @@ def header(text, newlines=(0, 0)):
 	print(f"{nl_prefix}{'=' * 8} {text} {'=' * 8}{nl_suffix}")
 
 
-# Normalizes permissions recursively on a directory
-def normalize_permissions(path_obj, dir_permissions=0o755, file_permissions=0o644, type_permissions={}):
-	assert type(path_obj) == pathlib.PosixPath
-	for f in path_obj.glob("**/*"):
-		if f.is_dir():
-			f.chmod(dir_permissions)
-		elif f.is_file():
-			f.chmod(file_permissions)
-			for extension in type_permissions:
-				if f.name.endswith(extension):
-					f.chmod(type_permissions[extension])
-					break
+# Prefixes lines printed by labeled threads, so the output of concurrently provisioned instances can be told apart
+class LabeledOutput:
+	def __init__(self, stream):
+		self.stream = stream
+		self.local = threading.local()
+		self.lock = threading.Lock()
+
+	# Labels everything the calling thread prints from now on
+	def label(self, text):
+		self.local.label = text
+		self.local.pending = ""
+
+	def write(self, s):
+		label = getattr(self.local, "label", None)
+		if label is None:
+			return self.stream.write(s)
+		# Only complete lines are written, so lines from different threads never get mixed together
+		*lines, self.local.pending = (self.local.pending + s).split("\n")
+		with self.lock:
+			for line in lines:
+				self.stream.write(f"[{label}] {line}\n")
+		return len(s)
+
+	def flush(self):
+		self.stream.flush()
+
+	def __getattr__(self, name):
+		return getattr(self.stream, name)
 
 
 # Returns the answer to a question as a boolean
@@ -130,63 +207,96 @@ def str_to_list(s):
 	return l
 
 
-# Extracts the given tarfile and returns the path to the extracted files
-def untar(filename, mode="r:gz", expect_root_regex=None):
-	print(f"Opening tarfile \"{filename}\" in mode \"{mode}\" for unarchiving...")
-	tar = tarfile.open(filename, mode)
-	members = tar.getmembers()
-	root = members[0].name
-	print(f"Archive root: {root}")
-	if expect_root_regex:
-		assert re.fullmatch(expect_root_regex, root)
-	tar.extractall("downloads/")
-	return pathlib.PosixPath(f"downloads/{root}/")
-
-
-# Unzips the zipfile somewhere
-def unzip(filename, where, strip_leading_dir=False):
-	with zipfile.ZipFile(filename, "r") as zip:
-		# Get the archive root
-		if strip_leading_dir:
-			root_info = zip.infolist()[0]
-			root = root_info.filename
-			try:
-				assert root.endswith("/")
-			except AssertionError:
-				print("Failed to determine zip archive root directory! Hierarchy follows:")
-				# Print debug info
-				for filename in zip.infolist():
-					print(f"info: {filename}")
-				for filename in zip.namelist():
-					print(f"name: {filename}")
-				raise
-			print(f"\tGot zip root directory: {root}")
-
-		# Make sure temp is empty
-		try:
-			shutil.rmtree("temp")
-		except FileNotFoundError:
-			pass
-		os.mkdir("temp")
+# Returns the path an archive member is extracted to, or None if it's skipped
+# Members that would land outside of where (absolute paths, ".." components) are refused
+def _member_destination(name, where, root, strip_leading_dir, include):
+	parts = [part for part in name.split("/") if part not in ["", "."]]
+	if name.startswith("/") or ".." in parts:
+		raise ValueError(f"Refusing to extract \"{name}\" outside of {where}")
+	if strip_leading_dir:
+		# Only what's under the archive's root directory is extracted, like copying that directory would
+		if not parts or parts[0] != root:
+			return None
+		parts = parts[1:]
+	if not parts:
+		return None
+	relative = "/".join(parts)
+	if include is not None and not include(relative):
+		return None
+	return where / relative
 
-		# Extract to temporary location
-		zip.extractall("temp/")
 
-		if strip_leading_dir:
-			print("\tStripping leading dir from zip archive contents")
-			shutil.copytree(f"temp/{root}", where, dirs_exist_ok=True)
-		else:
-			print("\tNot stripping leading dir from zip archive contents")
-			# Just copy all of the zipfile's contents in
-			shutil.copytree("temp/", where, dirs_exist_ok=True)
+# Streams a file from an archive into place, replacing whatever was there instead of writing through it
+def _write_member(source, destination, mode=None, mtime=None):
+	destination.parent.mkdir(parents=True, exist_ok=True)
+	partial = destination.with_name(f".{destination.name}.part")
+	with open(partial, "wb") as f:
+		shutil.copyfileobj(source, f, 1024 * 1024)
+	if mode is not None:
+		partial.chmod(mode)
+	if mtime is not None:
+		os.utime(partial, (mtime, mtime))
+	os.replace(partial, destination)
+	return destination.stat().st_size
 
 
-# Waits for the given server to come online
-def waitForServer(ip, port):
-	while True:
-		try:
-			r = a2s.info((ip, port))
-			print("Server is online!\n")
-			break
-		except socket.timeout:
-			time.sleep(1)
+# Extracts a .zip or tar archive straight into where, one member at a time, without extracting it anywhere else first
+# strip_leading_dir extracts only the contents of the archive's root directory, which expect_root_regex can check
+# include is called with each member's path (after stripping) and returns whether to extract it
+# file_mode and dir_mode override the permissions in the archive; returns (files extracted, bytes written)
+def extract(filename, where, strip_leading_dir=False, expect_root_regex=None, include=None, file_mode=None, dir_mode=None):
+	where = pathlib.PosixPath(where)
+	files = size = 0
+	root = None
+	# Directory permissions are set last, in case they don't allow writing what goes in them
+	directories = []
+
+	def destination(name):
+		nonlocal root
+		# Archives made with "tar -C dir ." have members like "./addons/..."
+		parts = [part for part in name.split("/") if part not in ["", "."]]
+		if root is None and parts:
+			root = parts[0]
+			print(f"\tArchive root: {root}")
+			if expect_root_regex:
+				assert re.fullmatch(expect_root_regex, root), f"Unexpected archive root \"{root}\" in {filename}"
+		return _member_destination(name, where, root, strip_leading_dir, include)
+
+	def make_dir(path, mode):
+		path.mkdir(parents=True, exist_ok=True)
+		if mode:
+			directories.append((path, mode))
+
+	print(f"\tExtracting {filename} into {where}")
+	if zipfile.is_zipfile(filename):
+		with zipfile.ZipFile(filename, "r") as archive:
+			for info in archive.infolist():
+				path = destination(info.filename)
+				if path is None:
+					continue
+				if info.is_dir():
+					make_dir(path, dir_mode)
+					continue
+				with archive.open(info) as source:
+					size += _write_member(source, path, file_mode)
+				files += 1
+	else:
+		# Stream mode reads members in order instead of indexing the whole archive first
+		with tarfile.open(filename, "r|*") as archive:
+			for member in archive:
+				path = destination(member.name)
+				if path is None:
+					continue
+				if member.isdir():
+					make_dir(path, dir_mode or member.mode & 0o777)
+				elif member.isfile():
+					size += _write_member(archive.extractfile(member), path, file_mode or member.mode & 0o777 or None, member.mtime)
+					files += 1
+				else:
+					print(f"\tWARNING: Not extracting \"{member.name}\", since it isn't a regular file or directory")
+	for path, mode in reversed(directories):
+		path.chmod(mode)
+	if files == 0:
+		error(f"ERROR: Nothing was extracted from {filename}" + (f" (archive root \"{root}\")" if strip_leading_dir else "") + ".", is_issue=True)
+	instrumentation.count("files_extracted", files)
+	return files, size
@@ -0,0 +1,126 @@
+#!/usr/bin/env python3
+
+# Runs profile modules (profiles/<profile>/preinst_modules/*.py) at the points in provisioning they ask for.
+# Modules are imported the first time a profile's hooks are needed, and declare each function they want called with
+# the @hook decorator: which phase it runs in, its order within the phase, and whether it can run at the same time as
+# the phase's other concurrent hooks. The phases, in the order they happen, are:
+#	pre-start	the container has been created but not started yet; the data directory is seeded
+#	running		the container is running after its SRCDS install, for anything that needs to exec in it
+#	offline		the container is stopped and the profile's files have been applied to the data directory (and its
+#			plugins too, when they come from the profile's bundle; see bundle.py)
+#	post-plugin	plugins have been installed, and the server hasn't generated their configs yet
+#	post-ready	the server is up after its final boot
+# Modules written for older versions of setup.py, with just a loader(profile_name, region_name, instance_number,
+# container) function, are run in the offline phase.
+
+import concurrent.futures
+import importlib
+import instrumentation
+import os
+import sys
+import threading
+
+
+
+PHASES = ["pre-start", "running", "offline", "post-plugin", "post-ready"]
+
+
+# Marks a profile module's function as a hook for the given phase
+# Hooks run in order (then by module and function name); consecutive concurrent ones run at the same time
+def hook(phase, order=50, concurrent=False):
+	assert phase in PHASES, f"Unknown hook phase \"{phase}\""
+	def register(function):
+		function.hook = {"phase": phase, "order": order, "concurrent": concurrent}
+		return function
+	return register
+
+
+# What hooks get to know about the instance they're run for
+class HookContext:
+	def __init__(self, profile_name, region_name, instance_number, container, data_directory, config):
+		self.profile_name = profile_name
+		self.region_name = region_name
+		self.instance_number = instance_number
+		self.container = container
+		self.data_directory = data_directory
+		self.config = config
+
+
+# Wraps a function so it runs with the calling thread's recorder and output label
+def _in_context(function):
+	recorder = instrumentation.current()
+	label = getattr(getattr(sys.stdout, "local", None), "label", None)
+	def run(*args):
+		recorder.activate()
+		if label is not None:
+			sys.stdout.label(label)
+		return function(*args)
+	return run
+
+
+class HookRegistry:
+	def __init__(self, profile_name):
+		self.profile_name = profile_name
+		self.hooks = None
+		self.lock = threading.Lock()
+
+	# Imports the profile's modules and collects their hooks, sorted by phase and order, the first time they're needed
+	def _load(self):
+		with self.lock:
+			if self.hooks is None:
+				self.hooks = self._collect()
+			return self.hooks
+
+	def _collect(self):
+		hooks = {phase: [] for phase in PHASES}
+		directory = f"profiles/{self.profile_name}/preinst_modules/"
+		if os.path.isdir(directory):
+			for filename in sorted(os.listdir(directory)):
+				if not filename.endswith(".py"):
+					continue
+				module_name = filename[:-len(".py")]
+				module = importlib.import_module(f"profiles.{self.profile_name}.preinst_modules.{module_name}")
+				declared = [f for f in vars(module).values() if callable(f) and hasattr(f, "hook") and getattr(f, "__module__", None) == module.__name__]
+				for function in declared:
+					hooks[function.hook["phase"]].append((function.hook["order"], module_name, function.__name__, function))
+				if not declared and hasattr(module, "loader"):
+					legacy = module.loader
+					def loader(context, legacy=legacy):
+						legacy(context.profile_name, context.region_name, context.instance_number, context.container)
+					loader.hook = {"phase": "offline", "order": 50, "concurrent": False}
+					hooks["offline"].append((50, module_name, "loader", loader))
+		for phase in PHASES:
+			hooks[phase].sort(key=lambda h: h[:3])
+		return hooks
+
+	# Returns whether any hooks run in the given phase
+	def has(self, phase):
+		return bool(self._load()[phase])
+
+	# Runs a phase's hooks for an instance
+	def run(self, phase, context):
+		hooks = self._load()[phase]
+		if not hooks:
+			return
+		print(f"\nRunning {len(hooks)} {phase} hook(s) from the \"{self.profile_name}\" profile...")
+		batch = []
+		for order, module_name, name, function in hooks:
+			if function.hook["concurrent"]:
+				batch.append((f"{module_name}.{name}", function))
+				continue
+			self._run_batch(batch, context)
+			batch = []
+			print(f"Running {module_name}.{name}")
+			function(context)
+		self._run_batch(batch, context)
+
+	# Runs consecutive concurrent hooks at the same time
+	@staticmethod
+	def _run_batch(batch, context):
+		if not batch:
+			return
+		print(f"Running {', '.join(name for name, _ in batch)}" + (" concurrently" if len(batch) > 1 else ""))
+		with concurrent.futures.ThreadPoolExecutor(max_workers=len(batch)) as executor:
+			futures = [executor.submit(_in_context(function), context) for _, function in batch]
+		for future in futures:
+			future.result()
@@ -0,0 +1,165 @@
+#!/usr/bin/env python3
+
+# Resolves the docker image containers are created from to an exact digest.
+# The registry is asked for the image's current digest once per setup.py run, and the image is only pulled if that
+# digest isn't on the host yet. Every container the run creates uses the resolved "repository@sha256:..." reference
+# instead of the moving tag, and the digest is recorded per profile and region in image-pins.json, so later runs for
+# the same region keep creating containers from the same image until they're told to update it.
+# The apt and pip packages profiles need are baked into a derived image on top of the pinned base image. Derived images
+# are tagged by a hash of their recipe, so each one is built once per host and shared by every container that needs it.
+# When the host user isn't 1000:1000, the derived image's steam user is given the host user's UID/GID as well, so
+# containers can use bind mounts without anything being remapped (or chowned) at runtime.
+
+import docker
+from helpers import error
+import hashlib
+import io
+import json
+import os
+import tempfile
+import time
+
+
+
+# The base image every container is created from
+BASE_IMAGE = "cm2network/tf2:sourcemod"
+
+# Which digest each profile and region's containers run
+PINS_PATH = "image-pins.json"
+
+# Derived images are tagged "<repository>:<recipe hash>"
+DERIVED_REPOSITORY = "tf2-docker/derived"
+
+# Bump this when the Dockerfile template changes, so existing derived images are rebuilt
+RECIPE_VERSION = 2
+
+# The steam user's UID/GID in the base image
+BASE_UID = BASE_GID = 1000
+
+
+# Returns the repository part of an image reference, without its tag or digest
+def repository(reference):
+	name = reference.split("@", 1)[0]
+	# A colon after the last slash starts the tag; one before it is part of a registry host's port
+	if ":" in name.rsplit("/", 1)[-1]:
+		name = name.rsplit(":", 1)[0]
+	return name
+
+
+def load_pins():
+	try:
+		with open(PINS_PATH) as f:
+			return json.load(f)
+	except FileNotFoundError:
+		return {}
+
+
+# Writes the pins atomically, since several setup.py runs for different regions may be going at once
+def save_pins(pins):
+	fd, tmp = tempfile.mkstemp(dir=".", prefix=".image-pins-")
+	with os.fdopen(fd, "w") as f:
+		json.dump(pins, f, indent="\t", sort_keys=True)
+	os.replace(tmp, PINS_PATH)
+
+
+# Makes sure an image pinned by digest is on the host, pulling it only if it isn't
+def ensure_present(client, pinned, tag_as=None):
+	try:
+		image = client.images.get(pinned)
+		print(f"{pinned} is already on this host; not pulling it.")
+	except docker.errors.ImageNotFound:
+		print(f"Pulling {pinned}...")
+		image = client.images.pull(pinned)
+	# Keep the tag pointing at the newest digest we know of, like a regular pull would
+	if tag_as is not None:
+		image.tag(repository(tag_as), tag_as.rsplit(":", 1)[1])
+	return image
+
+
+# Asks the registry for the digest the reference currently points to, returning "repository@sha256:..."
+# If the registry can't be reached, the image already on the host is used instead
+def resolve_image(client, reference):
+	try:
+		digest = client.images.get_registry_data(reference).id
+	except docker.errors.APIError as ex:
+		try:
+			digests = client.images.get(reference).attrs.get("RepoDigests") or []
+		except docker.errors.ImageNotFound:
+			digests = []
+		if not digests:
+			error(f"\nERROR: Couldn't resolve {reference} with the registry ({ex}), and it isn't on this host either.", is_issue=False)
+		print(f"WARNING: Couldn't resolve {reference} with the registry ({ex}); using the image already on this host.")
+		return digests[0]
+	pinned = f"{repository(reference)}@{digest}"
+	print(f"{reference} resolved to {pinned}.")
+	return pinned
+
+
+# Returns the pinned image reference for a profile and region's containers
+# The region's existing pin is reused unless update is set, in which case the registry is asked for the newest digest
+def pin_image(client, reference, profile_name, region_name, update=False):
+	key = f"{profile_name}:{region_name}"
+	pins = load_pins()
+	if key in pins and not update:
+		pinned = pins[key]
+		print(f"Using the image the {region_name} region is pinned to ({pinned}); pass --update-image to update it.")
+		ensure_present(client, pinned)
+		return pinned
+	pinned = resolve_image(client, reference)
+	ensure_present(client, pinned, tag_as=reference)
+	if pins.get(key) != pinned:
+		# Re-read the pins in case another run changed them in the meantime
+		pins = load_pins()
+		pins[key] = pinned
+		save_pins(pins)
+	return pinned
+
+
+# Returns the Dockerfile for a derived image
+def derived_dockerfile(base, apt_packages, pip_packages, upgrade=True, uid=BASE_UID, gid=BASE_GID):
+	lines = [f"FROM {base}", "USER root"]
+	if upgrade or apt_packages:
+		lines.append("RUN apt-get update" + (" && apt-get full-upgrade -y" if upgrade else "") + (f" && apt-get install -y {' '.join(apt_packages)}" if apt_packages else "") + " && apt-get autoremove --purge -y && rm -rf /var/lib/apt/lists/*")
+	if (uid, gid) != (BASE_UID, BASE_GID):
+		# Only the image's own files need new owners; the game install is bind-mounted from the host, where it's already
+		# owned by the host user. usermod takes care of the home directory, and find only touches what's left.
+		lines.append(f"RUN groupmod -o -g {gid} steam && usermod -o -u {uid} -g {gid} steam && find / -xdev \\( -uid {BASE_UID} -o -gid {BASE_GID} \\) -exec chown -h steam:steam {{}} +")
+	# The base image runs everything as the steam user, so go back to it
+	lines.append("USER steam")
+	if pip_packages:
+		lines.append(f"RUN pip3 install {' '.join(pip_packages)}")
+	return "\n".join(lines) + "\n"
+
+
+# Returns the ID of a derived image of base with the given packages installed and the steam user's UID/GID set,
+# building it if this host doesn't have it yet. Derived images older than max_age seconds are rebuilt so they pick up
+# package updates. Containers are created from the ID rather than the tag, which a rebuild (by this run or another
+# one) may move partway through a region.
+def derive_image(client, base, apt_packages, pip_packages, max_age, upgrade=True, uid=BASE_UID, gid=BASE_GID):
+	apt_packages = sorted(set(apt_packages))
+	pip_packages = sorted(set(pip_packages))
+	dockerfile = derived_dockerfile(base, apt_packages, pip_packages, upgrade, uid, gid)
+	description = ", ".join(apt_packages + pip_packages) or "no extra packages"
+	if (uid, gid) != (BASE_UID, BASE_GID):
+		description += f", and the steam user as {uid}:{gid}"
+	recipe_hash = hashlib.sha256(json.dumps([RECIPE_VERSION, dockerfile]).encode()).hexdigest()
+	tag = f"{DERIVED_REPOSITORY}:{recipe_hash[:16]}"
+	try:
+		image = client.images.get(tag)
+		built = float(image.labels.get("tf2-docker.built", 0))
+		if time.time() - built < max_age:
+			print(f"Using the derived image {tag} ({image.id[:19]}), which already has: {description}")
+			return image.id
+		print(f"The derived image {tag} is out of date; rebuilding it...")
+	except docker.errors.ImageNotFound:
+		print(f"Building the derived image {tag} with: {description}")
+	labels = {"tf2-docker.recipe": recipe_hash, "tf2-docker.base": base, "tf2-docker.built": str(time.time())}
+	try:
+		image, logs = client.images.build(fileobj=io.BytesIO(dockerfile.encode()), tag=tag, labels=labels, rm=True, pull=False)
+	except docker.errors.BuildError as ex:
+		for line in ex.build_log:
+			print(line.get("stream", ""), end="")
+		error(f"\nERROR: Couldn't build the derived image {tag}: {ex.msg}", is_issue=False)
+	for line in logs:
+		print(line.get("stream", ""), end="")
+	return image.id
@@ -0,0 +1,171 @@
+#!/usr/bin/env python3
+
+# Concurrent plugin installation pipeline used by setup.py.
+# Plugins are downloaded in parallel, each into its own scratch directory under "downloads/".
+# Only the final step, extracting or copying the downloads into a container's data directory, happens one plugin at a
+# time, in the order the plugins were requested. Archives are extracted straight into the data directory, so nothing
+# is written twice.
+# Every download goes through the profile's plugins.lock, so what each plugin resolved to is recorded and can be
+# installed again exactly.
+
+import concurrent.futures
+from fileops import copy_file
+from helpers import error, extract, select_plugin_url
+import html
+import instrumentation
+import pathlib
+import re
+import shutil
+import tempfile
+import threading
+
+
+
+# Downloads a plugin into the given scratch directory
+# Returns a list of (source, destination, extract options) to install, where destinations are relative to the data
+# directory; sources with extract options are archives to extract, and ones without are files to copy
+def stage_plugin(pname, p, plugin_lock, scratch, thread_max_age):
+	scratch.mkdir(parents=True)
+
+	# Directly download the plugin from the specified URL and install it as specified
+	if "force_download" in p:
+		print(f"\t[{pname}] Downloading according to plugins.json...")
+
+		# Grab plugin download configuration values
+		url = p["force_download"]["url"]
+		format = p["force_download"]["format"]
+		assert format.startswith(".")
+		strip_leading_dir = p["force_download"].get("strip_leading_dir")
+		install_location = p["force_download"]["install_location"]
+
+		archive, entry = plugin_lock.fetch(pname, lambda: url, scratch / f"{pname}{format}")
+		if format == ".zip":
+			return [(archive, install_location, {"strip_leading_dir": strip_leading_dir})]
+		elif format == ".tar.gz":
+			# Tarballs always have their root directory's contents installed
+			return [(archive, install_location, {"strip_leading_dir": True})]
+		elif format == ".smx":
+			# Literally just copy it into the server
+			return [(archive, install_location, None)]
+		else:
+			error(f"ERROR: Unknown plugin download extension: {format}", is_issue=True)
+
+	# Otherwise, try to get a download link from the plugin's AlliedModders thread's webpage HTML
+	# For plugins downloaded from attachments, this is overridden by the force_extract_to parameter.
+	extract_to = p.get("force_extract_to", "tf/")
+	def resolve():
+		kind, url = resolve_thread_download(pname, p, plugin_lock.artifacts, scratch, thread_max_age)
+		return {"url": url, "kind": kind}
+	archive, entry = plugin_lock.fetch(pname, resolve, scratch / pname)
+	if entry["kind"] == "attachment":
+		return [(archive, extract_to, {})]
+	return [(archive.rename(scratch / f"{pname}.smx"), "tf/addons/sourcemod/plugins/", None)]
+
+
+# Finds a plugin's download link on its AlliedModders forum thread, returning ("attachment" or "compiler", url)
+# Thread pages go through the artifact cache, so an unchanged thread costs a conditional request (or nothing at all
+# within max_age seconds), and the link found on a page is remembered until the page changes.
+def resolve_thread_download(pname, p, artifacts, scratch, max_age):
+	print(f"\t[{pname}] Attempting to download the plugin from the AlliedModders forum thread ({p['thread_url']})...")
+	page = artifacts.fetch(p["thread_url"], scratch / "thread.html", max_age=max_age)
+	selection = [p.get("force_attachment_selection"), p.get("force_compiler_selection")]
+	memo = artifacts.note(p["thread_url"], "download")
+	if memo and memo["selection"] == selection:
+		print(f"\t[{pname}] The thread hasn't changed; using the same {memo['kind']} URL as last time: {memo['url']}")
+		return memo["kind"], memo["url"]
+
+	content = page.read_bytes().decode("latin")
+	# Option A: Try to get an attachment; currently, we only look for a zip
+	attachment_urls_escaped = re.findall(r'(?<=href=")attachment.php.*(?=")(?=.*zip)', content)
+	try:
+		# Note that this variable is just in the singular form
+		attachment_url_escaped = select_plugin_url(p, attachment_urls_escaped, type="attachment")
+		print(f"\t[{pname}] Got (escaped) plugin attachment URL from thread: {attachment_url_escaped}")
+		attachment_url = html.unescape(attachment_url_escaped)
+		print(f"\t[{pname}] Got plugin attachment URL from thread: {attachment_url}")
+		kind, url = "attachment", f"https://forums.alliedmods.net/{attachment_url}"
+	# Option B: No attachments found; try to get the plugin as compiled from source
+	except ValueError as ex:
+		print(ex)
+		print(f"\t[{pname}] WARNING: No attachment URLs found, falling back to plugin compiler links...")
+		plugin_compiler_urls = re.findall(r'(?<=href=")https://www.sourcemod.net/vbcompiler.php\?file_id=\d+', content)
+		# If no plugin compiler links are found either, this raises and we exit
+		# Note that this variable is just in the singular form
+		plugin_compiler_url = select_plugin_url(p, plugin_compiler_urls, type="compiler")
+		print(f"\t[{pname}] Got plugin compiler URL from thread: {plugin_compiler_url}")
+		kind, url = "compiler", plugin_compiler_url
+	artifacts.set_note(p["thread_url"], "download", {"selection": selection, "kind": kind, "url": url})
+	return kind, url
+
+
+# Copies a file into a directory, counting it for the instrumentation report
+def counted_copy(source, directory):
+	if copy_file(source, pathlib.PosixPath(directory) / source.name) == "copied":
+		instrumentation.count("files_copied")
+
+
+# Installs staged plugin downloads into the data directory
+def install_staged(staged, data_directory):
+	for source, destination, extract_options in staged:
+		destination = pathlib.PosixPath(f"{data_directory}/{destination}")
+		if extract_options is not None:
+			extract(source, destination, **extract_options)
+		else:
+			destination.mkdir(parents=True, exist_ok=True)
+			counted_copy(source, destination)
+
+
+# Stages plugins on a bounded thread pool. Each plugin is staged at most once, so every instance provisioned by the
+# same setup.py process shares the same downloads and extracted files.
+class PluginStager:
+	def __init__(self, plugin_db, plugin_lock, thread_max_age, max_workers=4):
+		self.plugin_db = plugin_db
+		self.plugin_lock = plugin_lock
+		self.thread_max_age = thread_max_age
+		self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=max_workers)
+		self.scratch_root = pathlib.PosixPath(tempfile.mkdtemp(prefix="plugins-", dir="downloads"))
+		self.staged = {}
+		self.lock = threading.Lock()
+
+	# Returns a future for the plugin's staged files, starting the download if it hasn't been already
+	def stage(self, pname):
+		with self.lock:
+			if pname not in self.staged:
+				scratch = self.scratch_root / str(len(self.staged))
+				self.staged[pname] = self.executor.submit(stage_plugin, pname, self.plugin_db["plugins"][pname], self.plugin_lock, scratch, self.thread_max_age)
+			return self.staged[pname]
+
+	# Stops any pending downloads and deletes the staged files
+	def close(self):
+		self.executor.shutdown(cancel_futures=True)
+		shutil.rmtree(self.scratch_root, ignore_errors=True)
+
+
+# Installs the given plugins into the data directory using the stager's downloads
+# Custom installations are handed to custom_install in request order; deferred ones are returned for later
+def install_plugins(to_install, stager, data_directory, custom_install):
+	post_installation_plugins = []
+	plugin_db = stager.plugin_db
+
+	# Kick off every download that doesn't need to run in setup.py's namespace
+	for pname in to_install:
+		if "custom_install" not in plugin_db["plugins"][pname]:
+			stager.stage(pname)
+
+	# Then install everything in order as it becomes ready
+	for pname in to_install:
+		p = plugin_db["plugins"][pname]
+		if "custom_install" in p:
+			cust_inst = p["custom_install"]
+			# Defer plugin configuration scripts that rely on autogenerated configs
+			if cust_inst.get("post_installation"):
+				print(f"\nDeferring installation of {pname}...")
+				post_installation_plugins.append(cust_inst)
+				continue
+			print(f"\nInstalling plugin: {pname}")
+			custom_install(cust_inst)
+			continue
+		staged = stager.stage(pname).result()
+		print(f"\nInstalling plugin: {pname}")
+		install_staged(staged, data_directory)
+	return post_installation_plugins
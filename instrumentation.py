@@ -0,0 +1,216 @@
+#!/usr/bin/env python3
+
+# Records where the time goes while setup.py runs.
+# Each instance being provisioned gets a Recorder that splits its run into phases (image pull, SRCDS install, apt
+# upgrade, plugin installation, etc.) and counts what happened during each one: bytes downloaded, files copied, docker
+# execs and so on. Work that isn't done on behalf of a single instance, like pulling the image or staging shared plugin
+# downloads, is recorded by the shared recorder instead.
+# setup.py saves everything as a JSON run report; running this file aggregates run reports:
+#	./instrumentation.py reports/*.json
+
+import argparse
+import contextlib
+import cProfile
+import datetime
+import json
+import os
+import pathlib
+import pstats
+import resource
+import sys
+import threading
+import time
+
+
+
+_local = threading.local()
+
+
+class Recorder:
+	def __init__(self, name):
+		self.name = name
+		self.result = None
+		self.started = time.time()
+		self.start = time.monotonic()
+		self.cpu_start = time.thread_time()
+		self.phases = []
+		self.current = None
+		self.counters = {}
+		self.lock = threading.Lock()
+
+	# Makes this the recorder that phase() and count() use on the calling thread
+	def activate(self):
+		_local.recorder = self
+
+	# Ends the current phase, if any, and starts a new one
+	def start_phase(self, name):
+		self.end_phase()
+		self.current = {"name": name, "start": time.monotonic(), "cpu_start": time.thread_time(), "counters": {}}
+
+	def end_phase(self):
+		if self.current is None:
+			return
+		phase = self.current
+		self.current = None
+		self.phases.append({
+			"name": phase["name"],
+			"wall_seconds": round(time.monotonic() - phase["start"], 3),
+			"cpu_seconds": round(time.thread_time() - phase["cpu_start"], 3),
+			"counters": phase["counters"],
+		})
+
+	# Adds to a counter, both for the whole run and for the current phase
+	def count(self, counter, amount=1):
+		with self.lock:
+			self.counters[counter] = self.counters.get(counter, 0) + amount
+			if self.current is not None:
+				self.current["counters"][counter] = self.current["counters"].get(counter, 0) + amount
+
+	def finish(self):
+		self.end_phase()
+		self.wall_seconds = round(time.monotonic() - self.start, 3)
+		self.cpu_seconds = round(time.thread_time() - self.cpu_start, 3)
+
+	def report(self):
+		return {
+			"name": self.name,
+			"result": self.result,
+			"started": datetime.datetime.fromtimestamp(self.started).isoformat(timespec="seconds"),
+			"wall_seconds": getattr(self, "wall_seconds", round(time.monotonic() - self.start, 3)),
+			"cpu_seconds": getattr(self, "cpu_seconds", None),
+			"phases": self.phases,
+			"counters": self.counters,
+		}
+
+
+# Records work that isn't done on behalf of a single instance
+shared = Recorder("shared")
+
+
+# Returns the calling thread's recorder
+def current():
+	return getattr(_local, "recorder", None) or shared
+
+
+# Starts a new phase in the calling thread's recorder
+def phase(name):
+	current().start_phase(name)
+
+
+# Ends the current phase in the calling thread's recorder, for work that doesn't belong to the next phase
+def end_phase():
+	current().end_phase()
+
+
+# Adds to a counter in the calling thread's recorder
+def count(counter, amount=1):
+	current().count(counter, amount)
+
+
+# Profiles the Python code run by the calling thread and dumps the stats to path; does nothing if path is None
+@contextlib.contextmanager
+def profiled(path):
+	if path is None:
+		yield
+		return
+	profiler = cProfile.Profile()
+	try:
+		profiler.enable()
+	except ValueError:
+		# Newer Pythons only allow one active profiler at a time, which matters when instances run in parallel
+		print(f"WARNING: Another thread is already being profiled; not saving {path}.")
+		yield
+		return
+	try:
+		yield
+	finally:
+		profiler.disable()
+		pathlib.PosixPath(path).parent.mkdir(parents=True, exist_ok=True)
+		profiler.dump_stats(path)
+		print(f"\nSaved cProfile stats to {path}; the top functions by cumulative time were:")
+		pstats.Stats(profiler).sort_stats("cumulative").print_stats(15)
+
+
+# Summarizes instance reports per phase: how many instances ran it, and the total/min/max/mean wall time
+def aggregate(instance_reports):
+	phases = {}
+	counters = {}
+	for report in instance_reports:
+		for p in report["phases"]:
+			summary = phases.setdefault(p["name"], {"instances": 0, "total_seconds": 0, "min_seconds": None, "max_seconds": None, "counters": {}})
+			summary["instances"] += 1
+			summary["total_seconds"] += p["wall_seconds"]
+			summary["min_seconds"] = p["wall_seconds"] if summary["min_seconds"] is None else min(summary["min_seconds"], p["wall_seconds"])
+			summary["max_seconds"] = p["wall_seconds"] if summary["max_seconds"] is None else max(summary["max_seconds"], p["wall_seconds"])
+			for counter, amount in p["counters"].items():
+				summary["counters"][counter] = summary["counters"].get(counter, 0) + amount
+		for counter, amount in report["counters"].items():
+			counters[counter] = counters.get(counter, 0) + amount
+	for summary in phases.values():
+		summary["total_seconds"] = round(summary["total_seconds"], 3)
+		summary["mean_seconds"] = round(summary["total_seconds"] / summary["instances"], 3)
+	return {
+		"instances": len(instance_reports),
+		"failed": sum(1 for report in instance_reports if report["result"] != "ready"),
+		"phases": phases,
+		"counters": counters,
+	}
+
+
+# Builds the report for a whole setup.py run
+def run_report(instance_recorders, argv):
+	usage = resource.getrusage(resource.RUSAGE_SELF)
+	children = resource.getrusage(resource.RUSAGE_CHILDREN)
+	instances = [recorder.report() for recorder in instance_recorders]
+	return {
+		"argv": argv,
+		"process": {
+			"max_rss_kb": usage.ru_maxrss,
+			"user_cpu_seconds": round(usage.ru_utime, 3),
+			"system_cpu_seconds": round(usage.ru_stime, 3),
+			"children_cpu_seconds": round(children.ru_utime + children.ru_stime, 3),
+		},
+		"shared": shared.report(),
+		"instances": instances,
+		"summary": aggregate(instances),
+	}
+
+
+# Saves a run report under the given directory and returns its path
+def save_report(report, directory, name):
+	os.makedirs(directory, exist_ok=True)
+	stamp = datetime.datetime.now().strftime("%Y%m%d-%H%M%S")
+	path = pathlib.PosixPath(directory) / f"{name}-{stamp}.json"
+	with open(path, "w") as f:
+		json.dump(report, f, indent="\t")
+	return path
+
+
+# Prints a table of phase timings
+def print_summary(summary):
+	print(f"{'Phase':<40} {'Runs':>5} {'Mean':>9} {'Min':>9} {'Max':>9}")
+	for name, p in summary["phases"].items():
+		print(f"{name:<40} {p['instances']:>5} {p['mean_seconds']:>8.1f}s {p['min_seconds']:>8.1f}s {p['max_seconds']:>8.1f}s")
+	for counter, amount in sorted(summary["counters"].items()):
+		print(f"{counter}: {amount}")
+
+
+def main(argv):
+	parser = argparse.ArgumentParser(description="Aggregates setup.py run reports across instances and runs.")
+	parser.add_argument("reports", nargs="+", help="Run reports saved by setup.py.")
+	parser.add_argument("--json", action="store_true", help="Prints the aggregate as JSON instead of a table.")
+	args = parser.parse_args(argv)
+	instances = []
+	for filename in args.reports:
+		with open(filename) as f:
+			instances.extend(json.load(f)["instances"])
+	summary = aggregate(instances)
+	if args.json:
+		print(json.dumps(summary, indent="\t"))
+	else:
+		print(f"{summary['instances']} instance(s) from {len(args.reports)} report(s), {summary['failed']} failed\n")
+		print_summary(summary)
+
+
+if __name__ == "__main__":
+	main(sys.argv[1:])
@@ -0,0 +1,349 @@
+#!/usr/bin/env python3
+
+# A parser and writer for Valve KeyValues (VDF) files, the format SourceMod's configs use.
+# Files are parsed into a tree of sections, so plugin configs can be edited by path ("Databases/sourcebans/host")
+# no matter how a plugin release happens to indent or align them. Comments and blank lines are kept, and a
+# KeyValuesDocument is written out in the usual tab-indented style when its workspace is flushed.
+# Run ./keyvalues.py with some config files to check that they're written back out with the same contents.
+
+import argparse
+from helpers import error
+import os
+import pathlib
+import sys
+
+
+
+# One line of a section: a key with a string or section value, a comment, or a blank line (no key or comment)
+class _Entry:
+	__slots__ = ("key", "value", "condition", "comment")
+
+	def __init__(self, key, value, condition=None, comment=None):
+		self.key = key
+		self.value = value
+		self.condition = condition
+		self.comment = comment
+
+
+# Splits a path like "Databases/sourcebans/host" into its keys
+def split_path(path):
+	if isinstance(path, str):
+		return [key for key in path.split("/") if key]
+	return list(path)
+
+
+class KeyValues:
+	def __init__(self, values=None):
+		self.entries = []
+		if values is not None:
+			self.merge([], values)
+
+	# Returns the first entry with the given key; keys are case-insensitive, like they are for SourceMod
+	def _find(self, key):
+		for entry in self.entries:
+			if entry.key is not None and entry.key.lower() == key.lower():
+				return entry
+		return None
+
+	# Adds an entry at the end, leaving a blank line between sections like SourceMod's own configs do
+	def _append(self, entry):
+		if isinstance(entry.value, KeyValues) and self.entries and isinstance(self.entries[-1].value, KeyValues):
+			self.entries.append(_Entry(None, None))
+		self.entries.append(entry)
+
+	def keys(self):
+		return [entry.key for entry in self.entries if entry.key is not None]
+
+	def items(self):
+		return [(entry.key, entry.value) for entry in self.entries if entry.key is not None]
+
+	def __contains__(self, path):
+		return self.get(path) is not None
+
+	# Returns the string or section at a path, or default if there's nothing there
+	def get(self, path, default=None):
+		node = self
+		for key in split_path(path):
+			if not isinstance(node, KeyValues):
+				return default
+			entry = node._find(key)
+			if entry is None:
+				return default
+			node = entry.value
+		return node
+
+	# Returns the section at a path, creating any missing sections along the way
+	def section(self, path):
+		node = self
+		for key in split_path(path):
+			entry = node._find(key)
+			if entry is None:
+				entry = _Entry(key, KeyValues())
+				node._append(entry)
+			elif not isinstance(entry.value, KeyValues):
+				raise ValueError(f"\"{key}\" is a value, not a section")
+			node = entry.value
+		return node
+
+	# Sets the string (or whole section, given a dict) at a path
+	# Returns "overridden" or "added", or None if the value was already set to that
+	def set(self, path, value):
+		keys = split_path(path)
+		assert keys
+		parent = self.section(keys[:-1])
+		if isinstance(value, dict):
+			value = KeyValues(value)
+		elif not isinstance(value, KeyValues):
+			value = str(value)
+		entry = parent._find(keys[-1])
+		if entry is None:
+			parent._append(_Entry(keys[-1], value))
+			return "added"
+		if not isinstance(value, KeyValues) and entry.value == value:
+			return None
+		entry.value = value
+		return "overridden"
+
+	# Sets every value from a dict (or another KeyValues) under a path, keeping anything else that's already there
+	# Returns a list of (path, change) for the values that changed
+	def merge(self, path, values):
+		keys = split_path(path)
+		changes = []
+		for key, value in (values.items() if isinstance(values, (dict, KeyValues)) else values):
+			if isinstance(value, (dict, KeyValues)):
+				self.section(keys + [key])
+				changes += self.merge(keys + [key], value)
+			else:
+				change = self.set(keys + [key], value)
+				if change is not None:
+					changes.append(("/".join(keys + [key]), change))
+		return changes
+
+	# Removes the value or section at a path; returns whether there was one
+	def remove(self, path):
+		keys = split_path(path)
+		parent = self.get(keys[:-1])
+		if not isinstance(parent, KeyValues):
+			return False
+		entry = parent._find(keys[-1])
+		if entry is None:
+			return False
+		parent.entries.remove(entry)
+		return True
+
+	def to_dict(self):
+		return {key: value.to_dict() if isinstance(value, KeyValues) else value for key, value in self.items()}
+
+
+# Splits KeyValues text into (kind, text, line number, newlines before the token) tuples
+def _tokenize(text):
+	i = 0
+	line = 1
+	newlines = 0
+	escapes = {"n": "\n", "t": "\t", "\\": "\\", "\"": "\""}
+	while i < len(text):
+		c = text[i]
+		if c == "\n":
+			line += 1
+			newlines += 1
+			i += 1
+			continue
+		if c.isspace():
+			i += 1
+			continue
+		if text.startswith("//", i):
+			end = text.find("\n", i)
+			end = len(text) if end == -1 else end
+			yield "comment", text[i:end].rstrip(), line, newlines
+			i = end
+		elif text.startswith("/*", i):
+			# SMC files (like admin_overrides.cfg) can have block comments, which are kept as they are
+			end = text.find("*/", i + 2)
+			if end == -1:
+				raise ValueError(f"unterminated block comment starting on line {line}")
+			end += 2
+			yield "comment", text[i:end], line, newlines
+			line += text.count("\n", i, end)
+			i = end
+		elif c in "{}":
+			yield "open" if c == "{" else "close", c, line, newlines
+			i += 1
+		elif c == "[":
+			end = text.find("]", i)
+			if end == -1:
+				raise ValueError(f"unterminated condition on line {line}")
+			yield "condition", text[i:end + 1], line, newlines
+			i = end + 1
+		elif c == "\"":
+			start_line = line
+			chars = []
+			i += 1
+			while True:
+				if i >= len(text):
+					raise ValueError(f"unterminated string starting on line {start_line}")
+				c = text[i]
+				if c == "\"":
+					i += 1
+					break
+				if c == "\\" and i + 1 < len(text) and text[i + 1] in escapes:
+					chars.append(escapes[text[i + 1]])
+					i += 2
+					continue
+				if c == "\n":
+					line += 1
+				chars.append(c)
+				i += 1
+			yield "string", "".join(chars), start_line, newlines
+		else:
+			start = i
+			while i < len(text) and not text[i].isspace() and text[i] not in "{}\"":
+				i += 1
+			yield "string", text[start:i], line, newlines
+		newlines = 0
+
+
+# Parses KeyValues text into a KeyValues whose keys are the file's top-level sections
+def parse(text):
+	root = KeyValues()
+	stack = [root]
+	key = None
+	for kind, value, line, newlines in _tokenize(text):
+		node = stack[-1]
+		if kind == "comment":
+			if newlines == 0 and key is None and node.entries and node.entries[-1].key is not None:
+				node.entries[-1].comment = value
+			else:
+				if newlines >= 2 and node.entries:
+					node.entries.append(_Entry(None, None))
+				node.entries.append(_Entry(None, None, comment=value))
+		elif kind == "condition":
+			if key is not None or not node.entries or node.entries[-1].key is None:
+				raise ValueError(f"unexpected condition {value} on line {line}")
+			node.entries[-1].condition = value
+		elif key is None:
+			if kind == "close":
+				if len(stack) == 1:
+					raise ValueError(f"unexpected \"}}\" on line {line}")
+				stack.pop()
+			elif kind == "string":
+				if newlines >= 2 and node.entries:
+					node.entries.append(_Entry(None, None))
+				key = value
+			else:
+				raise ValueError(f"expected a key on line {line}")
+		elif kind == "string":
+			node.entries.append(_Entry(key, value))
+			key = None
+		elif kind == "open":
+			child = KeyValues()
+			node.entries.append(_Entry(key, child))
+			stack.append(child)
+			key = None
+		else:
+			raise ValueError(f"expected a value for \"{key}\" on line {line}")
+	if key is not None or len(stack) > 1:
+		raise ValueError("unexpected end of file")
+	return root
+
+
+def _quote(text):
+	return "\"" + text.replace("\\", "\\\\").replace("\"", "\\\"") + "\""
+
+
+def _write(node, depth, lines):
+	indent = "\t" * depth
+	for entry in node.entries:
+		if entry.key is None:
+			lines.append(indent + entry.comment if entry.comment is not None else "")
+			continue
+		condition = f" {entry.condition}" if entry.condition else ""
+		comment = f"\t{entry.comment}" if entry.comment else ""
+		if isinstance(entry.value, KeyValues):
+			lines.append(f"{indent}{_quote(entry.key)}{condition}")
+			lines.append(f"{indent}{{")
+			_write(entry.value, depth + 1, lines)
+			lines.append(f"{indent}}}{comment}")
+		else:
+			lines.append(f"{indent}{_quote(entry.key)}\t\t{_quote(entry.value)}{condition}{comment}")
+
+
+# Writes a KeyValues back out as text
+def dumps(root):
+	lines = []
+	_write(root, 0, lines)
+	return "\n".join(lines) + "\n"
+
+
+# A KeyValues file in a data directory, handed out by CfgWorkspace.open_keyvalues()
+class KeyValuesDocument:
+	def __init__(self, path):
+		self.path = pathlib.PosixPath(path)
+		try:
+			self.root = parse(self.path.read_text())
+		except ValueError as ex:
+			error(f"\nERROR: Couldn't parse {self.path} as KeyValues: {ex}", is_issue=True)
+		self.stat = os.stat(self.path)
+		self.dirty = False
+		# (path, "overridden" or "added") for every value changed through this document
+		self.changes = []
+
+	@property
+	def text(self):
+		return dumps(self.root)
+
+	def get(self, path, default=None):
+		return self.root.get(path, default)
+
+	def set(self, path, value):
+		change = self.root.set(path, value)
+		if change is not None:
+			self.changes.append(("/".join(split_path(path)), change))
+			self.dirty = True
+		return change
+
+	def merge(self, path, values):
+		changes = self.root.merge(path, values)
+		if changes:
+			self.changes += changes
+			self.dirty = True
+		return changes
+
+	def remove(self, path):
+		removed = self.root.remove(path)
+		self.dirty = self.dirty or removed
+		return removed
+
+	def save(self):
+		if self.dirty:
+			self.path.write_text(self.text)
+			self.dirty = False
+
+
+# Parses each file and checks that writing it back out and parsing that again gives the same sections and values
+def main(argv):
+	parser = argparse.ArgumentParser(description="Checks that KeyValues files survive being parsed and written back out.")
+	parser.add_argument("files", nargs="+", help="KeyValues files, like SourceMod configs.")
+	args = parser.parse_args(argv)
+	failed = 0
+	for filename in args.files:
+		with open(filename) as f:
+			text = f.read()
+		try:
+			root = parse(text)
+			written = dumps(root)
+			same = parse(written).to_dict() == root.to_dict() and dumps(parse(written)) == written
+		except ValueError as ex:
+			print(f"{filename}: couldn't parse it: {ex}")
+			failed += 1
+			continue
+		if not same:
+			print(f"{filename}: its contents changed when it was written back out")
+			failed += 1
+		else:
+			print(f"{filename}: OK" + ("" if written == text else " (reformatted)"))
+	if failed:
+		raise SystemExit(1)
+
+
+if __name__ == "__main__":
+	main(sys.argv[1:])
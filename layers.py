@@ -0,0 +1,146 @@
+#!/usr/bin/env python3
+
+# Applies profile layers ("global" and then the selected profile) to a container's data directory.
+# What each layer applied is recorded in a manifest inside the data directory: the hash and resulting file stats of
+# every direct-copied file, and the exact text of every block appended to a file. When a data directory is reused,
+# only files whose source or destination changed are copied again, previously appended blocks are replaced in place
+# instead of being appended a second time, and files or blocks that were removed from a profile are removed again.
+
+from fileops import copy_file, list_files, sha256_file
+import instrumentation
+import json
+import os
+import pathlib
+import tempfile
+
+
+
+MANIFEST_NAME = ".tf2-docker-manifest.json"
+
+
+# Loads the data directory's manifest, or an empty one for a new data directory
+def load_manifest(data_directory):
+	try:
+		with open(f"{data_directory}/{MANIFEST_NAME}") as f:
+			return json.load(f)
+	except FileNotFoundError:
+		return {"direct-copy": {}, "append-to": {}}
+
+
+# Writes the manifest atomically, so an interrupted run never leaves a half-written one behind
+def save_manifest(data_directory, manifest):
+	fd, tmp = tempfile.mkstemp(dir=data_directory, prefix=".manifest-")
+	with os.fdopen(fd, "w") as f:
+		json.dump(manifest, f, indent="\t", sort_keys=True)
+	os.replace(tmp, f"{data_directory}/{MANIFEST_NAME}")
+
+
+# The stats we compare to tell whether a file was changed since we wrote it
+def file_stats(path):
+	st = os.stat(path)
+	return {"size": st.st_size, "mtime_ns": st.st_mtime_ns}
+
+
+# Returns whether a destination file is still exactly as we left it
+def unchanged_since(path, entry):
+	try:
+		return file_stats(path) == {"size": entry["size"], "mtime_ns": entry["mtime_ns"]}
+	except FileNotFoundError:
+		return False
+
+
+# Lists the files in a profile layer's subdirectory, relative to it
+def layer_files(profile_name, kind):
+	return list_files(f"profiles/{profile_name}/{kind}/")
+
+
+# Direct-copies and appends files from the given profile layers, in order
+# Appended text goes through the workspace, so it's written out when the workspace is flushed
+def apply_layers(profile_names, data_directory, workspace):
+	manifest = load_manifest(data_directory)
+	stats = {"copied": 0, "unchanged": 0, "removed": 0, "appended": 0, "replaced": 0}
+
+	# Later layers win when several of them copy the same file, so work out the winners first
+	print("Direct-copying files...")
+	plan = {}
+	for profile_name in profile_names:
+		for rel_path, source in layer_files(profile_name, "direct-copy").items():
+			plan[rel_path] = (profile_name, source)
+	copied = {}
+	for rel_path, (profile_name, source) in plan.items():
+		destination = pathlib.PosixPath(f"{data_directory}/{rel_path}")
+		sha256 = sha256_file(source)
+		entry = manifest["direct-copy"].get(rel_path)
+		if entry and entry["sha256"] == sha256 and unchanged_since(destination, entry):
+			copied[rel_path] = entry
+			stats["unchanged"] += 1
+			continue
+		destination.parent.mkdir(parents=True, exist_ok=True)
+		workspace.forget(rel_path)
+		copy_file(source, destination, skip_unchanged=False)
+		copied[rel_path] = {"layer": profile_name, "sha256": sha256, **file_stats(destination)}
+		stats["copied"] += 1
+	# Remove files a layer no longer provides, unless something else has changed them since
+	for rel_path, entry in manifest["direct-copy"].items():
+		destination = pathlib.PosixPath(f"{data_directory}/{rel_path}")
+		if rel_path not in plan and unchanged_since(destination, entry):
+			print(f"Removing {rel_path}, which is no longer part of the \"{entry['layer']}\" profile")
+			destination.unlink()
+			stats["removed"] += 1
+	manifest["direct-copy"] = copied
+
+	# Append to files, replacing whatever the same layer appended last time
+	# Layers are applied one after another, so a file a later layer direct-copies replaces what earlier layers appended to it
+	print("Appending profile files to container files...")
+	appended = {}
+	for index, profile_name in enumerate(profile_names):
+		for rel_path, source in layer_files(profile_name, "append-to").items():
+			if rel_path in plan and profile_names.index(plan[rel_path][0]) > index:
+				print(f"Not appending to {rel_path} from the \"{profile_name}\" profile, since the \"{plan[rel_path][0]}\" profile replaces it")
+				continue
+			key = f"{profile_name}:{rel_path}"
+			document = workspace.open(rel_path)
+			block = "\n" + source.read_text()
+			previous = manifest["append-to"].get(key)
+			if previous is not None and previous in document.text:
+				if previous != block:
+					document.replace_block(previous, block)
+					stats["replaced"] += 1
+			else:
+				document.append(block)
+				stats["appended"] += 1
+			appended[key] = block
+	# Take back blocks from files a layer no longer appends
+	for key, previous in manifest["append-to"].items():
+		if key not in appended:
+			rel_path = key.split(":", 1)[1]
+			if not pathlib.PosixPath(f"{data_directory}/{rel_path}").exists():
+				continue
+			if workspace.open(rel_path).replace_block(previous, ""):
+				stats["removed"] += 1
+	manifest["append-to"] = appended
+
+	save_manifest(data_directory, manifest)
+	instrumentation.count("files_copied", stats["copied"])
+	print(f"Profile files: {stats['copied']} copied, {stats['unchanged']} unchanged, {stats['appended']} appended, {stats['replaced']} replaced, {stats['removed']} removed.")
+	return stats
+
+
+# Sets the convars from the profile's reconfigure files in the matching container config files
+# Lines already setting a convar are replaced; convars the file doesn't set yet are added
+# Files the server hasn't generated yet are created from the reconfigure file instead: SourceMod only writes a plugin's
+# config (with its defaults) when the plugin loads and the file is missing, so there's no need to boot for it first
+def reconfigure(profile_name, data_directory, workspace):
+	for rel_path, f in list_files(f"profiles/{profile_name}/reconfigure/").items():
+		lines = [line for line in f.read_text().split("\n") if line != "" and not line.startswith("//")]
+		destination = pathlib.PosixPath(f"{data_directory}/{rel_path}")
+		if not destination.exists():
+			print(f"Creating {rel_path} from {f}, since the server hasn't generated it yet")
+			workspace.forget(rel_path)
+			destination.parent.mkdir(parents=True, exist_ok=True)
+			destination.write_text("".join(f"{line}\n" for line in lines))
+			continue
+		print(f"Reconfiguring {rel_path} from {f}")
+		document = workspace.open(rel_path)
+		for line in lines:
+			document.set(line)
@@ -0,0 +1,98 @@
+#!/usr/bin/env python3
+
+# Records exactly which artifact every plugin was installed from, in a profile's plugins.lock.
+# Resolving a plugin's download is the nondeterministic part of an install: forum threads get new attachments, and
+# "latest" releases move. Each resolution is saved as its URL, sha256 and whatever else identifies it (the release
+# version, the kind of forum download), so later runs can install exactly the same files:
+#	- by default, downloads are resolved as usual and the lock is updated to match
+#	- with --locked, nothing is resolved; every download comes from the lock and has to match its hash
+#	- with --offline, nothing touches the network; locked artifacts and anything else in the artifact cache are used
+# Within a single setup.py run, a download is only ever resolved once, so every instance gets the same files.
+
+from helpers import error
+import json
+import os
+import pathlib
+import tempfile
+import threading
+
+
+
+class PluginLock:
+	def __init__(self, path, artifacts, locked=False):
+		self.path = pathlib.PosixPath(path)
+		self.artifacts = artifacts
+		self.locked = locked
+		try:
+			with open(self.path) as f:
+				self.entries = json.load(f)["plugins"]
+		except FileNotFoundError:
+			if locked:
+				error(f"\nERROR: --locked was given, but there's no {self.path} yet; run without --locked first to create it.", is_issue=False)
+			self.entries = {}
+		# What each download resolved to during this run
+		self.resolved = {}
+		self.key_locks = {}
+		self.changed = False
+		self.lock = threading.Lock()
+
+	# Makes sure every given plugin is in the lock when installing strictly from it
+	def check(self, keys):
+		if not self.locked:
+			return
+		missing = [key for key in keys if key not in self.entries]
+		if missing:
+			error(f"\nERROR: These plugins aren't in {self.path}; run without --locked to add them:\n\t" + "\n\t".join(missing), is_issue=False)
+
+	# Serializes resolving the same download while letting different ones resolve concurrently
+	def _key_lock(self, key):
+		with self.lock:
+			return self.key_locks.setdefault(key, threading.Lock())
+
+	# Fetches the artifact recorded under key to dest, returning (path, entry)
+	# resolve is called to find the artifact when it isn't locked; it returns its URL, or a dict with a "url" and
+	# anything else worth recording about it. The returned entry has the same keys, plus the artifact's "sha256".
+	# resolve_online says resolve goes to the network itself instead of through the artifact cache, so it can't be
+	# called offline at all
+	def fetch(self, key, resolve, dest, resolve_online=False):
+		with self._key_lock(key):
+			entry = self.resolved.get(key)
+			if entry is None:
+				if self.artifacts.offline and resolve_online and key not in self.entries:
+					error(f"\nERROR: {key} isn't locked in {self.path}, and finding its download needs the network; run once without --offline to lock it.", is_issue=False)
+				if self.locked or (self.artifacts.offline and key in self.entries):
+					if key not in self.entries:
+						error(f"\nERROR: {key} isn't in {self.path}; run without --locked to add it.", is_issue=False)
+					entry = self.entries[key]
+					print(f"\t[{key}] Using the locked download: {entry['url']} ({entry['sha256'][:12]})")
+				else:
+					entry = resolve()
+					if isinstance(entry, str):
+						entry = {"url": entry}
+			path = self.artifacts.fetch(entry["url"], dest, sha256=entry.get("sha256"))
+			if "sha256" not in entry:
+				entry = dict(entry, sha256=self.artifacts.digest(entry["url"]))
+			with self.lock:
+				self.resolved[key] = entry
+				if self.entries.get(key) != entry:
+					self.entries[key] = entry
+					self.changed = True
+			return path, entry
+
+	# Returns a copy of every entry in the lock, including what's been resolved so far
+	def snapshot(self):
+		with self.lock:
+			return dict(self.entries)
+
+	# Writes the lock out if anything new was resolved
+	def save(self):
+		with self.lock:
+			if not self.changed:
+				return
+			fd, tmp = tempfile.mkstemp(dir=self.path.parent, prefix=".plugins-lock-")
+			with os.fdopen(fd, "w") as f:
+				json.dump({"plugins": self.entries}, f, indent="\t", sort_keys=True)
+				f.write("\n")
+			os.replace(tmp, self.path)
+			self.changed = False
+			print(f"Updated {self.path}.")
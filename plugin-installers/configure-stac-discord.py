@@ -3,14 +3,16 @@
 # Inserts the StAC webhook URL configuration into discord.cfg
 
 
-with open(f"profiles/{args.profile_name}/direct-copy/stac-webhook-url.txt") as f:
-	webhook_url = f.read().strip()
+# The webhook URL can be set under [credentials]; profiles that already keep it in a file in direct-copy still work
+webhook_url = config["credentials"].get("STAC_DISCORD_WEBHOOK_URL", "").strip()
+if not webhook_url:
+	try:
+		with open(f"profiles/{args.profile_name}/direct-copy/stac-webhook-url.txt") as f:
+			webhook_url = f.read().strip()
+	except FileNotFoundError:
+		pass
+if not webhook_url:
+	error(f"ERROR: StAC's Discord logging needs a webhook URL. Set STAC_DISCORD_WEBHOOK_URL under [credentials] in credentials.ini, or put it in profiles/{args.profile_name}/direct-copy/stac-webhook-url.txt.", is_issue=False)
 
-cfg = (
-	'\n	"stac"\n'
-	'	{\n'
-	f'		"url"	"{webhook_url}"\n'
-	'	}\n'
-	'}'
-)
-edit("tf/addons/sourcemod/configs/discord.cfg", r'}\n*\Z', cfg)
+# Webhooks are sections inside the Discord API plugin's "Discord" section
+keyvalues("tf/addons/sourcemod/configs/discord.cfg").set("Discord/stac", {"url": webhook_url})
@@ -8,21 +8,19 @@ header("Attempting Steamworks installation...", newlines=(2, 1))
 # The SteamWorks downloads page
 base_url = "https://users.alliedmods.net/~kyles/builds/SteamWorks/"
 
-# Figure out the latest version of SteamWorks.
-response = session.get(base_url)
-versions = re.findall(r'(?<=href=")SteamWorks-git\d+-linux\.tar\.gz', response.content.decode(), flags=re.M)
-latest = versions[0]
+# Figure out the latest version of SteamWorks, unless plugins.lock already says which one to use.
+def find_latest():
+	response = session.get(base_url)
+	versions = re.findall(r'(?<=href=")SteamWorks-git\d+-linux\.tar\.gz', response.content.decode(), flags=re.M)
+	latest = versions[0]
+	return {"url": f"{base_url}/{latest}", "version": latest}
 
 # Download it.
-download_url = f"{base_url}/{latest}"
-dest_filename = "downloads/steamworks-latest.tar.gz"
-urllib.request.urlretrieve(download_url, dest_filename)
+archive, release = plugin_lock.fetch("SteamWorks", find_latest, f"downloads/{container_name}-steamworks.tar.gz", resolve_online=True)
+print(f"Using {release['version']}")
 
-# Extract.
-extracted = untar(dest_filename, expect_root_regex="addons")
-
-# Now copy it in and then delete the extracted files
-shutil.copytree(extracted, f"container-data/{container_name}/tf/addons/", dirs_exist_ok=True)
-shutil.rmtree(extracted)
+# Extract the contents of its addons directory straight into the server's.
+extract(archive, f"{data_directory}/tf/addons/", strip_leading_dir=True, expect_root_regex="addons")
+archive.unlink()
 
 print("Success!")
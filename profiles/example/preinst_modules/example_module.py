@@ -1,5 +1,10 @@
 #!/usr/bin/env python3
 
-# Called by setup.py
-def loader(profile_name, region_name, instance_number, container):
-	print(f"This is an example module. Profile name {profile_name}, region {region_name}, instance number {instance_number}.")
+from hooks import hook
+
+
+
+# Called by setup.py once the profile's files are in the data directory
+@hook("offline")
+def example(context):
+	print(f"This is an example module. Profile name {context.profile_name}, region {context.region_name}, instance number {context.instance_number}.")
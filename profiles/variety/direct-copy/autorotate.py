@@ -1,107 +1,126 @@
 #!/usr/bin/env python3
 
 # We determine the rotation to use from the day of the year and the container's instance number (stored by the profile's crontab module as the offset value).
-# If this is the first time running, or rotations.json has been updated, we regenerate tf/subscribed_file_ids.txt
-# Lastly, we write out the mapcycle.txt for the current rotation.
+# subscribed_file_ids.txt lists the workshop maps from every rotation, and mapcycle.txt the maps of the current rotation.
+# varietyd imports this and keeps an Autorotator around, so rotations.json is only read again when it changes; run ./autorotate.py to rotate by hand.
+# Files are only rewritten when their contents change, and are replaced in one go, so SRCDS never sees a partly written mapcycle.
 
 # Side note: subscribed_file_ids.txt might actually be completely unnecessary for TF2.
 
-_version = "0.0.3"
+_version = "0.0.4"
 _repo = "https://gitlab.com/2l47/TF2-docker"
 
 from datetime import date
-import hashlib
 import json
 import os
-
-
-
-# Load the map rotations
-with open("rotations.json") as f:
-	rotations = json.load(f)
-
-# How many rotations are configured?
-num_rotations = len(rotations)
-
-# The offset for instance number 1 is zero, and so on.
-with open("offset.dat") as f:
-	offset = int(f.read())
-
-# Today's day out of the year, 1 to 366.
-day_of_year = date.today().timetuple().tm_yday
-# Today's rotation index, e.g. 3.
-tr_index = (day_of_year + offset) % num_rotations
-# Today's rotation ID, e.g. R3.
-tr_id = list(rotations.keys())[tr_index]
-# Today's rotation.
-tr = rotations[tr_id]
-
-# Debug info
-print(f"Rotation offset: {offset}")
-print(f"DOY: {day_of_year}")
-print(f"Today's rotation (index {tr_index}; ID {tr_id}):")
 import pprint
-pprint.pprint(tr)
-print()
-
-
-# This function writes a mapcycle.txt from the given rotation
-def write_mapcycle(rotation):
-	print("Writing mapcycle.txt")
-	with open("tf/cfg/mapcycle.txt", "a") as mapcycle:
-		mapcycle.truncate(0)
-		for map_name in rotation:
-			map = rotation[map_name]
-			if map["type"] == "stock":
-				mapcycle.write(f"{map_name}\n")
-			elif map["type"] == "workshop":
-				workshop_id = map["workshop_id"]
-				mapcycle.write(f"workshop/{workshop_id}\n")
-			else:
-				raise SystemExit(f"Unknown map type: {map['type']}")
-
-
-# Check if rotations.json has been updated; if so, update workshop IDs
-previous_hash = None
-# Get the hash of rotations.json as of the previous run (if any)
-if os.path.exists("rotations.json.md5"):
-	with open("rotations.json.md5") as f:
-		previous_hash = f.read().strip()
-# Get the current hash
-with open("rotations.json", "rb") as f:
-	current_hash = hashlib.md5(f.read()).hexdigest()
-# Write the current hash
-with open("rotations.json.md5", "w") as md5_f:
-	md5_f.write(current_hash)
-
-# We're going to recreate subscribed_file_ids.txt
-if previous_hash != current_hash:
-	print(f"Previous hash ({previous_hash}) differs from current hash ({current_hash}).")
-	print("Updating subscribed_file_ids.txt...")
-
-	# SRCDS needs to know what workshop files to subscribe to
-	subscribed_file_ids = set()
-
-	# Get workshop map IDs and download necessary maps from all rotations
-	for rotation_id in rotations:
-		print(f"Processing rotation ID {rotation_id}...")
-		maps = rotations[rotation_id]
-		for map_name in maps:
-			map = maps[map_name]
-			print(f"\t{map['type']} map {map_name}")
-			if map["type"] == "workshop":
-				workshop_id = map["workshop_id"]
-				subscribed_file_ids.add(workshop_id)
 
-	# Okay Cool Now Write Out The Up-To-Date "subscribed_file_ids.txt"
-	print(f"Writing {len(subscribed_file_ids)} workshop IDs to subscribed_file_ids.txt")
-	with open("tf/cfg/subscribed_file_ids.txt", "w") as f:
-		f.write("\n".join(subscribed_file_ids))
-# As far as we know, rotations.json hasn't been updated.
-else:
-	print("rotations.json doesn't appear to have been updated; not rewriting subscribed_file_ids.txt")
 
 
-# Just update the mapcycle now
-# Fortunately this is very easy since I already wrote the function for it above ^:)
-write_mapcycle(tr)
+# Writes content to path unless it's already there, replacing the file with a complete new one instead of rewriting it in place
+# Returns whether the file was written
+def write_if_changed(path, content):
+	try:
+		with open(path) as f:
+			if f.read() == content:
+				return False
+	except FileNotFoundError:
+		pass
+	partial = f"{path}.part"
+	with open(partial, "w") as f:
+		f.write(content)
+	os.replace(partial, path)
+	return True
+
+
+# Returns the mapcycle.txt contents for the given rotation
+def mapcycle(rotation):
+	lines = []
+	for map_name, map in rotation.items():
+		if map["type"] == "stock":
+			lines.append(map_name)
+		elif map["type"] == "workshop":
+			lines.append(f"workshop/{map['workshop_id']}")
+		else:
+			raise ValueError(f"Unknown map type: {map['type']}")
+	return "".join(f"{line}\n" for line in lines)
+
+
+# Returns the subscribed_file_ids.txt contents for the given rotations: every workshop map in them, in the order they first appear
+def subscribed_file_ids(rotations):
+	workshop_ids = {}
+	for maps in rotations.values():
+		for map in maps.values():
+			if map["type"] == "workshop":
+				workshop_ids[map["workshop_id"]] = None
+	return "\n".join(workshop_ids)
+
+
+class Autorotator:
+	def __init__(self, directory="."):
+		self.directory = directory
+		self.rotations = None
+		self.offset = None
+		# The stat results rotations.json and offset.dat were last read with
+		self.loaded = {}
+
+	# Returns what a file's stat results need to match for it to still be as it was last read
+	def _stat(self, name):
+		st = os.stat(f"{self.directory}/{name}")
+		return (st.st_mtime_ns, st.st_size, st.st_ino)
+
+	# Writes out today's mapcycle.txt, and subscribed_file_ids.txt if rotations.json has changed
+	# Returns what happened, for varietyd to send on
+	def run(self, today=None):
+		report = []
+		# A file is only marked as read once it has been parsed, so a broken one keeps failing until it's fixed
+		# instead of leaving the previous contents in use
+		stat = self._stat("rotations.json")
+		if self.loaded.get("rotations.json") != stat:
+			self.rotations = None
+			with open(f"{self.directory}/rotations.json") as f:
+				rotations = json.load(f)
+			report.append(f"Loaded {len(rotations)} rotations from rotations.json.")
+			if write_if_changed(f"{self.directory}/tf/cfg/subscribed_file_ids.txt", subscribed_file_ids(rotations)):
+				report.append("Updated subscribed_file_ids.txt.")
+			self.rotations = rotations
+			self.loaded["rotations.json"] = stat
+		stat = self._stat("offset.dat")
+		if self.loaded.get("offset.dat") != stat:
+			self.offset = None
+			# The offset for instance number 1 is zero, and so on.
+			with open(f"{self.directory}/offset.dat") as f:
+				self.offset = int(f.read())
+			self.loaded["offset.dat"] = stat
+
+		# Today's day out of the year, 1 to 366.
+		day_of_year = (today or date.today()).timetuple().tm_yday
+		# Today's rotation index, e.g. 3.
+		tr_index = (day_of_year + self.offset) % len(self.rotations)
+		# Today's rotation ID, e.g. R3.
+		tr_id = list(self.rotations.keys())[tr_index]
+		# Today's rotation.
+		tr = self.rotations[tr_id]
+
+		# Debug info
+		report.append(f"Rotation offset: {self.offset}")
+		report.append(f"DOY: {day_of_year}")
+		report.append(f"Today's rotation (index {tr_index}; ID {tr_id}):")
+		report.append(pprint.pformat(tr))
+
+		if write_if_changed(f"{self.directory}/tf/cfg/mapcycle.txt", mapcycle(tr)):
+			report.append("Updated mapcycle.txt.")
+		else:
+			report.append("mapcycle.txt is already up to date.")
+		return "\n".join(report)
+
+
+def main():
+	try:
+		print(Autorotator().run())
+	except ValueError as ex:
+		raise SystemExit(ex)
+
+
+if __name__ == "__main__":
+	main()
@@ -1,17 +1,20 @@
 #!/usr/bin/env python3
 
 from helpers import assert_exec, header
+from hooks import hook
 import os
 
 
 
-# Called by setup.py
-def loader(profile_name, region_name, instance_number, container):
+# Called by setup.py once the profile's files are in the data directory
+@hook("offline")
+def write_daemon_files(context):
 	header("Installing varietyd...", newlines=(2, 0))
+	profile_name, region_name, instance_number = context.profile_name, context.region_name, context.instance_number
 	print(f"\n(daemon_setup.py) Hello, world! Profile name {profile_name}, region {region_name}, instance number {instance_number}.")
 
 	# Where is the data for this container stored?
-	container_data = f"container-data/tf2-{profile_name}-{region_name}-{instance_number}"
+	container_data = context.data_directory
 
 	# varietyd includes the region and instance number in webhook messages
 	with open(f"{container_data}/container-info.dat", "w") as f:
@@ -43,20 +46,16 @@ def loader(profile_name, region_name, instance_number, container):
 	# 3 - I don't want to compile and install cronie as a replacement, and still fall to point 1
 
 	# Instead, we'll just spawn our own daemon (varietyd) to handle map rotation in the entry script.
-	# It sends any autorotate.py output via a Discord webhook and can be extended to support more functionality in the future if desired.
+	# It runs autorotate.py in-process and sends its output via a Discord webhook and can be extended to support more functionality in the future if desired.
 
-	# Now then, since we're not running inside the container, we don't have direct filesystem access to the main volume.
-	# Therefore, we need exec access to install the daemon. Fortunately, we've already been passed a container object ^:)
-	# Just gotta start the container again, first.
-	container.start()
 
-	# varietyd requires the following python modules
-	assert_exec(container, "root", "apt install python3-pip -y")
-	assert_exec(container, "steam", "pip3 install python-daemon pytz requests scheduler setproctitle")
+# Called by setup.py while the container is up after its SRCDS install
+@hook("running")
+def spawn_daemon(context):
+	# Now then, since we're not running inside the container, we don't have direct filesystem access to the entry script.
+	# Therefore, we need exec access to install the daemon. Fortunately, setup.py runs this while the container's up anyway ^:)
+	# (varietyd's python modules are declared in the profile's settings.ini, so they're already installed.)
 
-	# The daemon's already been copied into /home/steam/tf-dedicated/
+	# The daemon gets copied into /home/steam/tf-dedicated/ with the rest of the profile's files
 	# Just edit the entry script to spawn it
-	assert_exec(container, "steam", "sed -i 's_\#!/bin/bash_&\\n\\n./tf-dedicated/varietyd\\n_' entry.sh")
-
-	# Shut it back off
-	container.kill()
+	assert_exec(context.container, "steam", "sed -i 's_\#!/bin/bash_&\\n\\n./tf-dedicated/varietyd\\n_' entry.sh")
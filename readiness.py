@@ -0,0 +1,225 @@
+#!/usr/bin/env python3
+
+# Readiness probes for containers and game servers.
+# Polling probes (TCP, A2S, RCON) are retried with exponential backoff and jitter, log probes stream the container's
+# output through an incremental matcher, and every wait has an overall deadline so a hung instance fails loudly
+# instead of blocking setup.py forever. The time each phase took to become ready is recorded.
+
+import a2s
+from helpers import error
+import random
+import socket
+import struct
+import threading
+import time
+
+
+
+# Waits for a TCP port to accept connections
+class TcpProbe:
+	def __init__(self, ip, port, timeout=2):
+		self.name = f"TCP {ip}:{port}"
+		self.address = (ip, port)
+		self.timeout = timeout
+
+	def check(self):
+		try:
+			with socket.create_connection(self.address, timeout=self.timeout):
+				return True
+		except OSError:
+			return False
+
+
+# Waits for a Source server to answer A2S_INFO queries
+class A2SProbe:
+	def __init__(self, ip, port, timeout=2):
+		self.name = f"A2S {ip}:{port}"
+		self.address = (ip, port)
+		self.timeout = timeout
+
+	def check(self):
+		try:
+			a2s.info(self.address, timeout=self.timeout)
+			return True
+		except (OSError, a2s.BrokenMessageError):
+			return False
+
+
+# Waits for a Source server to accept RCON authentication
+class RconProbe:
+	SERVERDATA_AUTH = 3
+	SERVERDATA_AUTH_RESPONSE = 2
+
+	def __init__(self, ip, port, password, timeout=2):
+		self.name = f"RCON {ip}:{port}"
+		self.address = (ip, port)
+		self.password = password
+		self.timeout = timeout
+
+	# Reads one RCON packet, returning (id, type)
+	@staticmethod
+	def _read_packet(sock):
+		size = struct.unpack("<i", RconProbe._read_exactly(sock, 4))[0]
+		body = RconProbe._read_exactly(sock, size)
+		return struct.unpack("<ii", body[:8])
+
+	@staticmethod
+	def _read_exactly(sock, n):
+		data = b""
+		while len(data) < n:
+			chunk = sock.recv(n - len(data))
+			if not chunk:
+				raise ConnectionError("RCON connection closed")
+			data += chunk
+		return data
+
+	def check(self):
+		request_id = random.randint(1, 2 ** 31 - 1)
+		body = struct.pack("<ii", request_id, self.SERVERDATA_AUTH) + self.password.encode() + b"\x00\x00"
+		try:
+			with socket.create_connection(self.address, timeout=self.timeout) as sock:
+				sock.sendall(struct.pack("<i", len(body)) + body)
+				# The server sends an empty response value packet before the actual auth response
+				while True:
+					response_id, response_type = self._read_packet(sock)
+					if response_type == self.SERVERDATA_AUTH_RESPONSE:
+						break
+		except OSError:
+			return False
+		# A wrong password won't fix itself by waiting
+		if response_id == -1:
+			error(f"\nERROR: The server at {self.address[0]}:{self.address[1]} rejected the RCON password.", is_issue=False)
+		return response_id == request_id
+
+
+# Waits for a pattern to show up in a container's output, echoing the output as it arrives
+# Output is matched as a byte stream, so the pattern is found even when it's split across chunks
+class LogPatternProbe:
+	def __init__(self, container, pattern, since=None, echo=True):
+		self.name = f"log pattern \"{pattern}\""
+		self.container = container
+		self.pattern = pattern.encode()
+		self.since = since
+		self.echo = echo
+
+	# Returns True once the pattern has been seen, or False if the output ended or the timeout passed first
+	def wait(self, timeout):
+		stream = self.container.logs(stream=True, follow=True, since=self.since)
+		# Closing the stream is the only way to interrupt a blocking read, so a timer does it at the deadline
+		timed_out = threading.Event()
+		def expire():
+			timed_out.set()
+			stream.close()
+		timer = threading.Timer(timeout, expire)
+		timer.daemon = True
+		timer.start()
+		tail = b""
+		try:
+			for chunk in stream:
+				if self.echo:
+					print(chunk.decode(errors="replace"), end="")
+				window = tail + chunk
+				if self.pattern in window:
+					return True
+				# Only the end of the window could still be the start of a match
+				tail = window[-(len(self.pattern) - 1):] if len(self.pattern) > 1 else b""
+			return False
+		except Exception:
+			# The stream errors out if it's closed in the middle of a read
+			if timed_out.is_set():
+				return False
+			raise
+		finally:
+			timer.cancel()
+			stream.close()
+
+
+# The base image's SteamCMD prints this once the TF2 SRCDS is installed and up to date
+INSTALL_READY_MESSAGE = "Success! App '232250' already up to date."
+
+
+# Waits for the base docker image to finish installing (or verifying) the TF2 SRCDS
+def install_probe(container, since=None):
+	return LogPatternProbe(container, INSTALL_READY_MESSAGE, since=since)
+
+
+# Returns the configured kind of probe ("a2s", "rcon" or "tcp") for a game server
+def server_probe(kind, ip, port, rcon_password=None):
+	if kind == "a2s":
+		return A2SProbe(ip, port)
+	elif kind == "rcon":
+		return RconProbe(ip, port, rcon_password)
+	elif kind == "tcp":
+		return TcpProbe(ip, port)
+	error(f"ERROR: Unknown server readiness probe: {kind}", is_issue=False)
+
+
+# Returns how many people are playing on a Source server (SourceTV and other bots don't count), or None if it doesn't
+# answer A2S_INFO queries
+def human_players(ip, port, timeout=2):
+	try:
+		info = a2s.info((ip, port), timeout=timeout)
+	except (OSError, a2s.BrokenMessageError):
+		return None
+	return max(0, info.player_count - info.bot_count)
+
+
+# Waits until nobody is playing on a server, checking every interval seconds and giving up after timeout seconds
+# A single query can go unanswered on a busy server, so the server only counts as unreachable (with nobody to drop)
+# once several queries in a row, spread over an interval, have gone unanswered.
+# Returns "empty", "unreachable", or "timeout" if players were still on it when the timeout passed.
+def wait_until_empty(ip, port, timeout, interval, attempts=3):
+	print(f"Waiting up to {timeout:.0f}s for the players on {ip}:{port} to leave...")
+	deadline = time.monotonic() + timeout
+	unanswered = 0
+	while True:
+		players = human_players(ip, port)
+		remaining = deadline - time.monotonic()
+		if players is None:
+			unanswered += 1
+			if unanswered >= attempts:
+				print(f"The server hasn't answered {unanswered} queries in a row, so there's nobody to drop.")
+				return "unreachable"
+			delay = min(interval / (attempts - 1), max(remaining, 0))
+			print(f"The server didn't answer; asking again in {delay:.0f}s...")
+			time.sleep(delay)
+			continue
+		unanswered = 0
+		if players == 0:
+			print("The server is empty.")
+			return "empty"
+		if remaining <= 0:
+			print(f"WARNING: {players} player(s) are still on the server, but the drain timeout has passed.")
+			return "timeout"
+		print(f"{players} player(s) still on the server; checking again in {min(interval, remaining):.0f}s...")
+		time.sleep(min(interval, remaining))
+
+
+# Waits until the probe reports ready or the timeout passes, then records how long it took under timings[phase]
+# Polling probes are retried with exponential backoff and full jitter between initial_delay and max_delay
+def wait_for(phase, probe, timeout, timings=None, initial_delay=0.5, max_delay=10):
+	print(f"Waiting up to {timeout:.0f}s for {phase} ({probe.name})...")
+	start = time.monotonic()
+	deadline = start + timeout
+	if hasattr(probe, "wait"):
+		ready = probe.wait(timeout)
+	else:
+		ready = False
+		attempt = 0
+		while True:
+			if probe.check():
+				ready = True
+				break
+			remaining = deadline - time.monotonic()
+			if remaining <= 0:
+				break
+			delay = min(max_delay, initial_delay * 2 ** attempt)
+			time.sleep(min(remaining, random.uniform(0, delay)))
+			attempt += 1
+	elapsed = time.monotonic() - start
+	if not ready:
+		error(f"\nERROR: Timed out after {elapsed:.0f}s waiting for {phase} ({probe.name}).", is_issue=False)
+	print(f"Ready: {phase} took {elapsed:.1f}s.\n")
+	if timings is not None:
+		timings[phase] = elapsed
+	return elapsed
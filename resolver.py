@@ -0,0 +1,117 @@
+#!/usr/bin/env python3
+
+# Works out which plugins to install, and in what order, from a profile's requested-plugins setting.
+# Requirements (including those of requested optional features) are followed transitively, every plugin appears in the
+# plan once no matter how many others need it, and requirements are installed before the plugins that need them.
+# Plugins with a post_installation custom install configure files that only exist after the server's first boot, so
+# they're kept in a separate deferred list in the same dependency order.
+# Unknown plugins, unknown features and requirement cycles are all reported before anything is downloaded.
+
+from helpers import error
+
+
+
+# Splits a plugin spec like "StAC[discord_logging]" or "SourceBans++[a&b]" into its name and list of features
+def parse_spec(spec):
+	start = spec.find("[")
+	if start == -1:
+		return spec, []
+	if not spec.endswith("]"):
+		error(f"\nERROR: Malformed plugin name \"{spec}\"; features go in brackets at the end, like \"StAC[discord_logging]\".", is_issue=False)
+	return spec[:start], [f for f in spec[start + 1:-1].split("&") if f]
+
+
+class InstallPlan:
+	def __init__(self, immediate, deferred, required_by, features):
+		# Plugins installed before the first boot, requirements first
+		self.immediate = immediate
+		# Plugins whose custom installs run after the first boot, in the same order
+		self.deferred = deferred
+		# Why each plugin is in the plan: "requested", or the names of the plugins that need it
+		self.required_by = required_by
+		# The optional features enabled for each plugin
+		self.features = features
+
+	# Every plugin in the order it's handled
+	@property
+	def order(self):
+		return self.immediate + self.deferred
+
+	def print(self):
+		def describe(name):
+			reasons = [r for r in self.required_by[name] if r != "requested"]
+			text = name
+			if self.features[name]:
+				text += f" [{', '.join(sorted(self.features[name]))}]"
+			if reasons:
+				text += f" (required by {', '.join(reasons)})"
+			return text
+		print(f"Install plan: {len(self.immediate)} plugin(s) before the first boot, {len(self.deferred)} after it.")
+		for i, name in enumerate(self.immediate, 1):
+			print(f"\t{i}. {describe(name)}")
+		if self.deferred:
+			print("Deferred until the server has generated its plugin configs:")
+			for i, name in enumerate(self.deferred, 1):
+				print(f"\t{i}. {describe(name)}")
+
+
+# Resolves a list of plugin specs against the plugin database into an InstallPlan
+def resolve(requested, plugin_db):
+	plugins = plugin_db["plugins"]
+	problems = []
+	requires = {}
+	required_by = {}
+	features = {}
+	queue = [(spec, "requested") for spec in requested]
+	while queue:
+		spec, reason = queue.pop(0)
+		name, wanted = parse_spec(spec)
+		if name not in plugins:
+			problems.append(f"Unknown plugin \"{name}\"" + (f" (required by {reason})" if reason != "requested" else ""))
+			continue
+		if reason not in required_by.setdefault(name, []):
+			required_by[name].append(reason)
+		# A plugin is expanded once, and again for each feature that's asked for later on
+		new_features = [f for f in wanted if f not in features.get(name, set())]
+		if name in requires and not new_features:
+			continue
+		requirements = []
+		if name not in requires:
+			requires[name] = []
+			features[name] = set()
+			requirements += plugins[name].get("requires", [])
+		for f in new_features:
+			optional_features = plugins[name].get("optional_features", {})
+			if f not in optional_features:
+				problems.append(f"Unknown feature \"{f}\" for plugin \"{name}\"")
+				continue
+			features[name].add(f)
+			requirements += optional_features[f]["requires"]
+		for requirement in requirements:
+			requirement_name = parse_spec(requirement)[0]
+			if requirement_name not in requires[name]:
+				requires[name].append(requirement_name)
+			queue.append((requirement, name))
+	if problems:
+		error("\nERROR: The requested plugins can't be resolved:\n\t" + "\n\t".join(problems), is_issue=False)
+
+	# Depth-first, so each plugin comes after its requirements; ties keep the order plugins were requested in
+	order = []
+	visiting = []
+	def visit(name):
+		if name in order:
+			return
+		if name in visiting:
+			cycle = visiting[visiting.index(name):] + [name]
+			error(f"\nERROR: Plugin requirements form a cycle: {' -> '.join(cycle)}", is_issue=True)
+		visiting.append(name)
+		for requirement in requires[name]:
+			visit(requirement)
+		visiting.pop()
+		order.append(name)
+	for name in requires:
+		visit(name)
+
+	def deferred(name):
+		return plugins[name].get("custom_install", {}).get("post_installation", False)
+	return InstallPlan([n for n in order if not deferred(n)], [n for n in order if deferred(n)], required_by, features)
@@ -10,7 +10,8 @@
 
 import configparser
 import getpass
-from helpers import execute, genpass, normalize_permissions, prompt, sed
+from fileops import normalize_permissions
+from helpers import execute, extract, genpass, prompt, sed
 import os
 import pathlib
 import re
@@ -19,7 +20,6 @@ import shutil
 from sid import getSteamID
 import stat
 import subprocess
-import tarfile
 import urllib
 
 
@@ -196,8 +196,7 @@ except FileExistsError:
 # Make it traversable, readable, writable; traversable/readble
 sbpp_inst.chmod(0o744)
 # Extract the webpanel archive
-tar = tarfile.open(dest_filename, mode="r:gz")
-tar.extractall("/var/www/html/sbpp/")
+extract(dest_filename, sbpp_inst)
 # Set basic permissions manually since SBPP doesn't distribute tarfiles with normal permissions...
 normalize_permissions(sbpp_inst, dir_permissions=0o555, file_permissions=0o444, type_permissions={".php": 0o544})
 # Now manually set quickstart-requested permissions, for the same reason...
@@ -210,8 +209,8 @@ for path, mode in dir_permissions.items():
 			raise SystemExit(f"ERROR: Unexpectedly missing path: {path}")
 		continue
 	p.chmod(mode)
-	for f in p.glob("**/*"):
-		f.chmod(mode)
+	if p.is_dir():
+		normalize_permissions(p, dir_permissions=mode, file_permissions=mode)
 # Now set the owner to www-data so SBPP can write stuff here
 execute("chown www-data -R /var/www/html/sbpp")
 
@@ -1,511 +1,1060 @@
 #!/usr/bin/env python3
 
 import argparse
+from artifacts import ArtifactCache
+from bundle import BundleCache, PLACEHOLDERS, bundle_key, fill_placeholders
+from cfgfile import CfgWorkspace
+import concurrent.futures
 import configparser
+import difflib
 import docker
-from helpers import assert_exec, error, genpass, header, select_plugin_url, str_to_list, untar, unzip, waitForServer
-import html
+from fileops import diff_trees, sha256_file
+from golden import STAMP_NAME, seed_data_dir, update_golden
+from helpers import ExecSession, LabeledOutput, error, extract, genpass, header, str_to_list
+from hooks import HookContext, HookRegistry
+from images import BASE_GID, BASE_IMAGE, BASE_UID, derive_image, pin_image
+import instrumentation
+from installer import PluginStager, install_plugins
 import json
+from layers import MANIFEST_NAME, apply_layers, reconfigure
+from lockfile import PluginLock
 import os
 import pathlib
 import re
+from readiness import install_probe, server_probe, wait_for, wait_until_empty
+from resolver import resolve
 import requests
 from shared import _version, _repo
 import shutil
 import subprocess
-import urllib.parse
-import urllib.request
+import sys
+import tempfile
+import time
+import traceback
 
 
 
 # ======== Process initial container options ========
 
-parser = argparse.ArgumentParser(
-	description = f"TF2-docker container setup script, version {_version}",
-	formatter_class = argparse.ArgumentDefaultsHelpFormatter
-)
-
-# General container options
-parser.add_argument("--profile-name", "-p", type=str, required=True, help="A profile name with custom configurations, files, and plugins.")
-parser.add_argument("--region-name", "-r", type=str, required=True, help="Docker containers are created with names like \"tf2-default-dallas-1\". Provide a region, e.g. \"dallas\"")
-parser.add_argument("--instance-number", "-i", type=int, required=True, help="Docker containers are created with names like \"tf2-default-dallas-1\". Provide an instance number, e.g. \"1\"")
-parser.add_argument("--cpu-affinity", "-c", type=str, default="", help="The CPUs in which to allow container execution. e.g. \"0,1\" or \"0-3\"")
-
-# Behavioral options
-parser.add_argument("--overwrite", "-o", action="store_true", help="Stops and removes any preexisting containers with the same name.")
-parser.add_argument("--erase", "-e", action="store_true", help="Erases preexisting container data directories with the same name.")
-parser.add_argument("--force-reuse", "-f", action="store_true", help="Forces reuse of existing container data directories. A bad idea due to repeated cfg appending.")
-parser.add_argument("--skip-apt", "-s", action="store_true", help="Skips upgrading the base system and installing extra packages. Will cause issues with some profiles.")
-parser.add_argument("--no-wait", "-n", action="store_true", help="Skips waiting for the server to come online after everything is completed.")
-
-# Other options
-parser.add_argument("--host-ip", type=str, help="Optional value that overrides the auto-detected host IP address.")
-
-# Parse the command-line arguments and make sure they're sane
-args = parser.parse_args()
-assert args.region_name.isalpha() and args.region_name.islower()
-assert args.instance_number > 0
-
-# Define the container name based on the profile name, server region, and instance number
-assert args.profile_name.isalpha() and args.profile_name.islower()
-container_name = f"tf2-{args.profile_name}-{args.region_name}-{args.instance_number}"
-
-# We use the host IP address to check if the server has been brought up later on
-if not args.host_ip:
-	args.host_ip = subprocess.check_output("hostname -I | cut -d ' ' -f 1", shell=True).decode().strip()
-	print(f"Auto-detected your IP address as {args.host_ip}. If this is incorrect, override the value with the --host-ip option.\n")
-
-
-# ======== Prepare the container configuration ========
-
-# Connect to the docker socket
-client = docker.from_env()
-
-# Make sure a container doesn't already exist with this name
-print(f"Using container name {container_name}; checking for pre-existing containers...")
-preexisting = client.containers.list(all=True, filters={"name": container_name})
-descriptors = [f"{i}: {i.name}" for i in preexisting]
-if descriptors:
-	if not args.overwrite:
-		message = f"ERROR: Found {len(preexisting)} pre-existing container(s) matching the name \"{container_name}\":\n"
-		message += f"\t{descriptors}\n\n"
-		message += "You may need to delete them or pick another identifier."
-		error(message, is_issue=False)
-	else:
-		# "Overwrite" the container(s)
-		print("WARNING: Overwriting preexisting containers!")
-		for c in preexisting:
-			if c.status == "running":
-				print(f"Killing container \"{c.name}\" ({c})...")
-				c.kill()
-			print(f"Removing container \"{c.name}\" ({c})...")
-			c.remove(v=True)
-else:
-	print("No conflictingly named containers found.")
-
-# Set up a persistent data directory for the container
-data_dir = pathlib.PosixPath(f"container-data/{container_name}")
-if data_dir.exists() and args.erase:
-	print("WARNING: Erasing existing container data!")
-	shutil.rmtree(data_dir)
-try:
-	pathlib.Path.mkdir(data_dir, parents=True)
-except FileExistsError:
-	if not args.force_reuse:
-		message = "ERROR: A data directory for a container with this name already exists."
-		message += "\nSince there doesn't seem to be an associated container, you may wish to delete it."
-		error(message, is_issue=False)
-
-# Randomized passwords get stored here
-try:
-	os.mkdir("container-passwords")
-except FileExistsError:
-	pass
-
-# Plugins get downloaded here
-try:
-	os.mkdir("downloads")
-except FileExistsError:
-	pass
+# Adds the options that single-instance and fleet provisioning have in common
+def add_common_arguments(parser):
+	parser.add_argument("--cpu-affinity", "-c", type=str, default="", help="The CPUs in which to allow container execution. e.g. \"0,1\" or \"0-3\"")
+
+	# Behavioral options
+	parser.add_argument("--overwrite", "-o", action="store_true", help="Stops and removes any preexisting containers with the same name.")
+	parser.add_argument("--erase", "-e", action="store_true", help="Erases preexisting container data directories with the same name.")
+	parser.add_argument("--force-reuse", "-f", action="store_true", help="Forces reuse of existing container data directories. Profile files are re-applied incrementally according to the data directory's manifest.")
+	parser.add_argument("--reapply", action="store_true", help="Only re-applies changed profile files and reconfigure settings to existing data directories, then restarts their containers. Nothing is reinstalled.")
+	parser.add_argument("--update-image", action="store_true", help="Checks the registry for a newer docker image instead of using the one the region is pinned to, pulling it if needed.")
+	parser.add_argument("--skip-apt", "-s", action="store_true", help="Skips upgrading the base system and installing the default extra packages. Packages the profile needs (extra-apt-packages and extra-pip-packages) are still installed.")
+	parser.add_argument("--no-wait", "-n", action="store_true", help="Skips waiting for the server to come online after everything is completed.")
+	parser.add_argument("--rolling", action="store_true", help="Updates running instances without dropping their players: each one's replacement is provisioned alongside it, and swapped in with a single restart once the running server is empty. Fleets are updated one instance at a time.")
+	parser.add_argument("--locked", action="store_true", help="Installs plugins strictly from the profile's plugins.lock, verifying their hashes, instead of resolving their downloads again.")
+	parser.add_argument("--offline", action="store_true", help="Installs plugins only from the local artifact cache, without any network access. Locked downloads are used where the lock has them.")
+
+	# Other options
+	parser.add_argument("--host-ip", type=str, help="Optional value that overrides the auto-detected host IP address.")
+	parser.add_argument("--report-dir", type=str, default="reports", help="Where to save the JSON report of how long each phase took.")
+	parser.add_argument("--cprofile", action="store_true", help="Also profiles setup.py's own Python code with cProfile, saving the stats next to the report.")
+	parser.set_defaults(render=False, staging=False)
+
+
+# Parses the command-line arguments for provisioning a single instance
+def parse_args(argv):
+	parser = argparse.ArgumentParser(
+		description = f"TF2-docker container setup script, version {_version}",
+		epilog = "To provision several instances of a region at once, see: ./setup.py fleet --help. To build a data directory without docker, see: ./setup.py render --help",
+		formatter_class = argparse.ArgumentDefaultsHelpFormatter
+	)
+
+	# General container options
+	parser.add_argument("--profile-name", "-p", type=str, required=True, help="A profile name with custom configurations, files, and plugins.")
+	parser.add_argument("--region-name", "-r", type=str, required=True, help="Docker containers are created with names like \"tf2-default-dallas-1\". Provide a region, e.g. \"dallas\"")
+	parser.add_argument("--instance-number", "-i", type=int, required=True, help="Docker containers are created with names like \"tf2-default-dallas-1\". Provide an instance number, e.g. \"1\"")
+	add_common_arguments(parser)
+
+	# Parse the command-line arguments and make sure they're sane
+	args = parser.parse_args(argv)
+	assert args.region_name.isalpha() and args.region_name.islower()
+	assert args.profile_name.isalpha() and args.profile_name.islower()
+	assert args.instance_number > 0
+	return args
+
+
+# Parses the command-line arguments for provisioning several instances of a region at once
+def parse_fleet_args(argv):
+	parser = argparse.ArgumentParser(
+		prog = "setup.py fleet",
+		description = f"TF2-docker fleet setup, version {_version}. Provisions several instances of a profile in one region, sharing configuration, the docker image and plugin downloads between them.",
+		formatter_class = argparse.ArgumentDefaultsHelpFormatter
+	)
+
+	parser.add_argument("--profile-name", "--profile", "-p", type=str, required=True, help="A profile name with custom configurations, files, and plugins.")
+	parser.add_argument("--region-name", "--region", "-r", type=str, required=True, help="The region to provision instances in, e.g. \"dallas\"")
+	parser.add_argument("--instances", type=str, required=True, help="The instance numbers to provision, e.g. \"1-4\" or \"1,3,5\"")
+	parser.add_argument("--parallel", type=int, default=2, help="How many instances to provision at the same time.")
+	add_common_arguments(parser)
+
+	args = parser.parse_args(argv)
+	assert args.region_name.isalpha() and args.region_name.islower()
+	assert args.profile_name.isalpha() and args.profile_name.islower()
+	assert args.parallel > 0
+	return args
+
+
+# Parses the command-line arguments for rendering an instance's data directory without docker
+def parse_render_args(argv):
+	parser = argparse.ArgumentParser(
+		prog = "setup.py render",
+		description = f"TF2-docker data directory renderer, version {_version}. Builds the data directory an instance would be provisioned with from a base SRCDS install, without docker, and optionally shows how it differs from an existing one.",
+		formatter_class = argparse.ArgumentDefaultsHelpFormatter
+	)
+
+	parser.add_argument("--profile-name", "-p", type=str, required=True, help="A profile name with custom configurations, files, and plugins.")
+	parser.add_argument("--region-name", "-r", type=str, required=True, help="The region the instance is in, e.g. \"dallas\"")
+	parser.add_argument("--instance-number", "-i", type=int, required=True, help="The instance's number, e.g. \"1\"")
+	parser.add_argument("--base", type=str, help="The SRCDS install to start from, which needs a server.cfg the base image has generated. Defaults to the golden install.")
+	parser.add_argument("--output", type=str, help="Where to build the data directory. Defaults to renders/<container name>, or a temporary directory that's removed afterwards with --diff.")
+	parser.add_argument("--diff", type=str, nargs="?", const="", help="Shows how the rendered data directory differs from an existing one, by default the instance's own in container-data/.")
+	parser.add_argument("--overwrite", "-o", action="store_true", help="Replaces whatever is already in the output directory.")
+	parser.add_argument("--locked", action="store_true", help="Installs plugins strictly from the profile's plugins.lock, verifying their hashes, instead of resolving their downloads again.")
+	parser.add_argument("--offline", action="store_true", help="Installs plugins only from the local artifact cache, without any network access. Locked downloads are used where the lock has them.")
+	parser.add_argument("--report-dir", type=str, default="reports", help="Where to save the JSON report of how long each phase took.")
+	parser.set_defaults(render=True, reapply=False, rolling=False, staging=False, cprofile=False)
+
+	args = parser.parse_args(argv)
+	assert args.region_name.isalpha() and args.region_name.islower()
+	assert args.profile_name.isalpha() and args.profile_name.islower()
+	assert args.instance_number > 0
+	return args
+
+
+# Converts an instance list like "1-4" or "1,3,5-6" into a sorted list of instance numbers
+def parse_instances(spec):
+	numbers = set()
+	for element in str_to_list(spec):
+		start, _, end = element.partition("-")
+		numbers.update(range(int(start), int(end or start) + 1))
+	assert numbers and min(numbers) > 0
+	return sorted(numbers)
+
+
+# Replacements being built by rolling updates have this added to their hostname until they're swapped in
+STAGING_HOSTNAME_SUFFIX = " (staging)"
+
+# Rolling updates recreate each instance's container from an image of its replacement, tagged with the instance's name
+ROLLING_REPOSITORY = "tf2-docker-rolling"
+
+
+# Container names are based on the profile name, server region, and instance number
+# Replacements being built by rolling updates are named after the instance they replace
+def get_container_name(profile_name, region_name, instance_number, staging=False):
+	return f"tf2-{profile_name}-{region_name}-{instance_number}" + ("-next" if staging else "")
 
 
 # ======== Load and process configuration files ========
 
-# Reads values from configuration files
-config = configparser.ConfigParser()
-# Preserve case-sensitive keys
-config.optionxform = str
-# Load default settings, passwords, tokens, keys, etc.
-config.read("default-settings.ini")
-config.read("settings.ini")
-config.read("sample-credentials.ini")
-config.read("credentials.ini")
-
-# Load any overriding or additional settings from the selected profile, if any
-config.read(f"profiles/{args.profile_name}/settings.ini")
-config.read(f"profiles/{args.profile_name}/credentials.ini")
-
-# srcds configuration time
-srcds = config["srcds"]
-creds = config["credentials"]
-
-# Check if we actually have a token first, though
-gameserver_login_token = ""
-try:
-	section_name = f"region:{args.region_name}"
-	tokens = str_to_list(config[section_name].get("SRCDS_LOGIN_TOKENS"))
-	gameserver_login_token = tokens[args.instance_number - 1]
-	if gameserver_login_token == "":
-		print(f"\nWARNING: You have not entered a gameserver login token in credentials.ini (SRCDS_LOGIN_TOKENS) under the [{section_name}] section.\n" \
-			"Without one, your server might not display in the community server browser, be reachable, or be able to communicate with the item server.\n" \
-			"You probably want to create one at: https://steamcommunity.com/dev/managegameservers\n" \
-			"See sample-credentials.ini for instructions on how to store your credentials.")
-	elif len(gameserver_login_token) != 32:
-		error(f"\nInvalid gameserver login token for instance number {args.instance_number} of region {args.region_name}: {gameserver_login_token}", is_issue=False)
-except KeyError:
-	print(f"\nWARNING: You have not defined any gameserver login tokens in credentials.ini for the {args.region_name} region.")
-except IndexError:
-	error(f"\nA gameserver login token is not present for instance number {args.instance_number} of region {args.region_name}!", is_issue=False)
-
-# Check if the profile wants a random server/rcon password
-for i in ["SRCDS_PW", "SRCDS_RCONPW"]:
-	if srcds[i] == "random":
-		srcds[i] = genpass()
-		fname = f"container-passwords/{container_name}_{i}.txt"
-		with open(fname, "w") as f:
-			f.write(f"{srcds[i]}\n")
-		print(f"\nThe {i} has been changed to: {srcds[i]}\nFor your convenience, it has been saved to {fname}.")
-
-# Different SRCDS instances need different ports!
-srcds["SRCDS_PORT"] = str(int(srcds["SRCDS_START_PORT"]) + args.instance_number - 1)
-print(f"\nSRCDS port set to {srcds['SRCDS_PORT']}.")
-srcds["SRCDS_TV_PORT"] = str(int(srcds["SRCDS_TV_START_PORT"]) + args.instance_number - 1)
-print(f"SourceTV port set to {srcds['SRCDS_TV_PORT']}.")
-# We use different key names in our credential configuration files for clarity
-srcds["SRCDS_TOKEN"] = gameserver_login_token
-srcds["SRCDS_WORKSHOP_AUTHKEY"] = creds["STEAM_WEB_API_KEY"]
-# Construct an environment dict from our config for the docker image to use on its first run
-env = dict(srcds.items())
-
-# Adds the region name and instance number to the server hostname if enabled
-if srcds.getboolean("append-identifier-to-hostname"):
-	srcds["SRCDS_HOSTNAME"] = f"{srcds['SRCDS_HOSTNAME']} | {args.region_name} | {args.instance_number}"
-
-
-# ======== Initialize the container ========
-
-# Pull the docker image
-print("\nPulling the docker image...")
-client.images.pull("cm2network/tf2:sourcemod")
-
-# Create the container
-data_directory = pathlib.Path.resolve(pathlib.PosixPath(f"container-data/{container_name}"), strict=True)
-container = client.containers.create("cm2network/tf2:sourcemod", cpuset_cpus=args.cpu_affinity, detach=True, environment=env, name=container_name, network_mode="host", volumes={data_directory: {"bind": "/home/steam/tf-dedicated/"}})
-
-# Start the container
-print("Starting the container...")
-container.start()
-
-# Allow users with a UID/GID other than 1000 to use bind mounts successfully without file permissions or bindfs nonsense
-UID, GID = os.getuid(), os.getgid()
-if UID != 1000 or GID != 1000:
-	# Adjust the entry script to make it wait while we change the steam user's UID/GID
-	assert_exec(container, "steam", "sed -i 's_\#!/bin/bash_&\\nsleep 15_' entry.sh")
-	# Restart the container
-	container.restart(timeout=0)
-	# Change the steam user's UID
-	assert_exec(container, "root", f"usermod -u {UID} steam")
-	# Change the ID of the steam group (also updates the steam user's GID)
-	assert_exec(container, "root", f"groupmod -g {GID} steam")
-	# Correct file permissions
-	assert_exec(container, "root", "chown -R steam:steam /home/steam/ /tmp/dumps/")
-	# Restore the entry script
-	assert_exec(container, "steam", "sed -i '/sleep 15/d' entry.sh")
-	# Restart the container again
-	container.restart(timeout=0)
-
-# Now we need to do all the actual setup stuff.
-print("Waiting for the base docker image to install the TF2 SRCDS with SourceMod before installing profile configurations, files, and plugins...\n")
-ready_message = "Success! App '232250' already up to date."
-logs = container.attach(stdout=True, stream=True)
-for backlog in logs:
-	lines = backlog.decode().split("\n")
-	for l in lines:
-		print(l)
-	if ready_message in lines:
-		break
-header("SRCDS installed!", newlines=(1, 0))
-
-
-# ======== Update the base system ========
-
-if not args.skip_apt:
-	header("Upgrading the base system and installing extra packages...", newlines=(1, 0))
-	for command in ["apt update", "apt full-upgrade -y", "apt install net-tools procps vim -y", "apt autoremove --purge -y"]:
-		exit_code, output = container.exec_run(command, user="root")
-		print(f"{output.decode()}\n")
-		assert exit_code == 0
-
-# Go ahead and shutdown the server while we set things up.
-header("Killing the container for server configuration...")
-container.kill()
-
-
-# ======== Define configuration helper functions ========
-
-# Edit configuration options easily by replacing patterns
-def edit(cfg, pattern, repl):
-	assert not cfg.startswith(str(data_directory))
-	assert not cfg.startswith("/")
-	p = pathlib.Path(f"{data_directory}/{cfg}")
-	p.write_text(re.sub(pattern, repl, p.read_text(), flags=re.M))
-
-
-# ======== Configure the server ========
-
-header("Starting configuration...", newlines=(1, 0))
-# The first thing to do is make the configured server name persistent.
-edit("tf/cfg/server.cfg", "^hostname.*", f"hostname {srcds['SRCDS_HOSTNAME']}")
-# Same thing for the rcon password
-edit("tf/cfg/server.cfg", "^rcon_password.*", f"rcon_password {srcds['SRCDS_RCONPW']}")
-
-# Direct-copy and append files from the global profile and selected profile
-for profile_name in ["global", args.profile_name]:
-	print(f"\nApplying configurations from the \"{profile_name}\" profile...")
-
-	# Dynamically copy profile data
-	print(f"Direct-copying files...")
-	profile_prefix = f"profiles/{profile_name}"
-	copy_prefix = f"{profile_prefix}/direct-copy/"
-	if os.path.isdir(copy_prefix):
-		shutil.copytree(copy_prefix, f"{data_directory}/", dirs_exist_ok=True)
-
-	# Append to files
-	print("Appending profile files to container files...")
-	p = pathlib.PosixPath(f"{profile_prefix}/append-to/")
-	for f in p.glob("**/*"):
-		if f.is_file():
-			rel_path = f.relative_to(f"{profile_prefix}/append-to/")
-			sv_f = pathlib.PosixPath(f"{data_directory}/{rel_path}")
-			sv_f_data = sv_f.read_text() + "\n" + f.read_text()
-			sv_f.write_text(sv_f_data)
-
-# Execute any user scripts for the profile
-if os.path.isdir(f"profiles/{args.profile_name}/preinst_modules/"):
-	for filename in os.listdir(f"profiles/{args.profile_name}/preinst_modules/"):
-		if filename.endswith(".py"):
-			module = filename.split(".py")[0]
-			exec(f"from profiles.{args.profile_name}.preinst_modules.{module} import loader")
-			loader(args.profile_name, args.region_name, args.instance_number, container)
-
-
-# ======== Install server plugins ========
-
-def handle_custom_installation(cust_inst):
-	filename = cust_inst["file_to_exec"]
-	with open(f"plugin-installers/{filename}") as f:
-		exec(f.read())
-	if "function_to_call" in cust_inst:
-		func_name = cust_inst["function_to_call"]
-		arg_str = ""
-		if "function_arguments" in cust_inst:
-			arg_str = cust_inst["function_arguments"]
-		exec(f"{func_name}({arg_str})")
-
-post_installation_plugins = []
-
-if config.has_section("plugins"):
-	header("Installing plugins...", newlines=(0, 1))
-	plugins = config["plugins"]
-
-	# Deal with special keys first
-	# TODO: RGL goes here or something... maybe a preinst-module would be better for fetching maps..?
-
-	# Enable the specified plugins included with SourceMod but which are disabled by default
-	plugins_to_enable = str_to_list(plugins.get("enable-plugins"))
-	if plugins_to_enable:
-		repo = os.getcwd()
-		os.chdir(f"{data_directory}/tf/addons/sourcemod/plugins/disabled/")
-		for pname in plugins_to_enable:
-			if pname == "":
-				if len(plugins_to_enable) == 1:
-					print("No plugins to enable...")
-				else:
-					print("WARNING: Extra comma in enable-plugins?")
-				continue
-			print(f"Enabling plugin: {pname}")
-			s_fname = f"{pname}.smx"
-			p = pathlib.PosixPath(s_fname)
-			if p.exists():
-				p.replace(f"../{s_fname}")
+# Reads the configuration for the given profile
+def load_config(profile_name):
+	# Reads values from configuration files
+	config = configparser.ConfigParser()
+	# Preserve case-sensitive keys
+	config.optionxform = str
+	# Load default settings, passwords, tokens, keys, etc.
+	config.read("default-settings.ini")
+	config.read("settings.ini")
+	config.read("sample-credentials.ini")
+	config.read("credentials.ini")
+
+	# Load any overriding or additional settings from the selected profile, if any
+	config.read(f"profiles/{profile_name}/settings.ini")
+	config.read(f"profiles/{profile_name}/credentials.ini")
+	return config
+
+
+# Returns an independent copy of a configuration, so each instance can adjust its own values
+def copy_config(config):
+	copy = configparser.ConfigParser()
+	copy.optionxform = str
+	copy.read_dict({section: dict(config.items(section, raw=True)) for section in config.sections()})
+	return copy
+
+
+# Resolves the requested-plugins setting into the list of plugins to install, in order
+def plan_plugins(plugins, plugin_db):
+	requested_plugins = str_to_list(plugins.get("requested-plugins"))
+	specs = []
+	for pname in requested_plugins:
+		if pname == "":
+			if len(requested_plugins) == 1:
+				print("No plugins requested...")
 			else:
-				print(f"WARNING: Path does not exist: {p}")
-		os.chdir(repo)
-
-	# Disable the specified plugins included with SourceMod
-	plugins_to_disable = str_to_list(plugins.get("disable-plugins"))
-	if plugins_to_disable:
-		repo = os.getcwd()
-		os.chdir(f"{data_directory}/tf/addons/sourcemod/plugins/")
-		for pname in plugins_to_disable:
-			if pname == "":
-				if len(plugins_to_disable) == 1:
-					print("No plugins to disable...")
-				else:
-					print("WARNING: Extra comma in disable-plugins?")
-				continue
-			print(f"Disabling plugin: {pname}")
-			s_fname = f"{pname}.smx"
-			p = pathlib.PosixPath(s_fname)
-			if p.exists():
-				p.unlink()
+				print("WARNING: Extra comma in requested-plugins?")
+			continue
+		specs.append(pname)
+	plan = resolve(specs, plugin_db)
+	plan.print()
+	return plan.order
+
+
+# ======== Prepare what all instances have in common ========
+
+# Everything that's the same for every instance of a profile is set up once per setup.py process
+class Deployment:
+	def __init__(self, args):
+		self.config = load_config(args.profile_name)
+
+		# Renders only work on files, so they don't need a server to check on or the docker socket
+		self.host_ip = self.client = None
+		if not args.render:
+			# We use the host IP address to check if the server has been brought up later on
+			self.host_ip = args.host_ip
+			if not self.host_ip:
+				self.host_ip = subprocess.check_output("hostname -I | cut -d ' ' -f 1", shell=True).decode().strip()
+				print(f"Auto-detected your IP address as {self.host_ip}. If this is incorrect, override the value with the --host-ip option.\n")
+
+			# Connect to the docker socket
+			self.client = docker.from_env()
+
+		# Randomized passwords get stored here
+		try:
+			os.mkdir("container-passwords")
+		except FileExistsError:
+			pass
+
+		# Plugins get downloaded here (from the artifact cache)
+		try:
+			os.mkdir("downloads")
+		except FileExistsError:
+			pass
+
+		# Downloads go through a cache shared by all instances and runs on this host
+		self.downloads = self.config["downloads"]
+		self.artifacts = ArtifactCache(max_size=self.downloads.getint("cache-max-size-mb") * 1024 * 1024, max_age=self.downloads.getint("cache-max-age"), offline=args.offline)
+
+		# Webpages are requested through this session
+		self.session = requests.Session()
+		# Set the user agent for the session, used for requesting webpages
+		self.session.headers.update({"User-Agent": f"setup.py/{_version} ({_repo})"})
+
+		# Load our plugin database and work out which plugins to install.
+		with open("plugins.json") as f:
+			self.plugin_db = json.load(f)
+		self.to_install = []
+		if self.config.has_section("plugins"):
+			self.to_install = plan_plugins(self.config["plugins"], self.plugin_db)
+
+		# Profile modules are imported the first time one of their hooks is needed
+		self.hooks = HookRegistry(args.profile_name)
+
+		# What each plugin's download resolved to is recorded in the profile's lock
+		self.plugin_lock = PluginLock(f"profiles/{args.profile_name}/plugins.lock", self.artifacts, locked=args.locked)
+		# Installer scripts that download their plugin (SteamWorks, SourceBans++) lock it under the plugin's name; only
+		# post-installation scripts, which just edit configs, have nothing in the lock
+		self.plugin_lock.check([pname for pname in self.to_install if not self.plugin_db["plugins"][pname].get("custom_install", {}).get("post_installation")])
+		self.stager = PluginStager(self.plugin_db, self.plugin_lock, self.downloads.getint("thread-max-age"), max_workers=self.downloads.getint("parallel-downloads"))
+
+		# Re-applying profiles to existing instances and rendering data directories don't need anything else
+		self.golden = self.bundles = None
+		if args.reapply or args.render:
+			return
+
+		# Resolve the docker image to a digest once; every container in the region is created from exactly that image
+		instrumentation.phase("image resolution")
+		print("\nResolving the docker image...")
+		self.image = pin_image(self.client, BASE_IMAGE, args.profile_name, args.region_name, update=args.update_image)
+		base_image = self.image
+
+		# Bake the packages the profile needs into a derived image, unless packages are being installed the old way
+		# Hosts whose user isn't 1000:1000 always get a derived image, whose steam user has the host user's UID/GID, so
+		# containers can use bind mounts successfully without file permissions or bindfs nonsense
+		# --skip-apt only skips the upgrade and the default packages; the profile's own packages are always installed
+		image = self.config["image"]
+		self.apt_packages = [p for p in ([] if args.skip_apt else str_to_list(image.get("apt-packages"))) + str_to_list(image.get("extra-apt-packages")) if p]
+		self.pip_packages = [p for p in ([] if args.skip_apt else str_to_list(image.get("pip-packages"))) + str_to_list(image.get("extra-pip-packages")) if p]
+		self.prebaked = image.getboolean("prebake") and not (args.skip_apt and not self.apt_packages and not self.pip_packages)
+		uid, gid = os.getuid(), os.getgid()
+		if self.prebaked or (uid, gid) != (BASE_UID, BASE_GID):
+			instrumentation.phase("image build")
+			header("Preparing the derived docker image...", newlines=(1, 0))
+			packages = (self.apt_packages, self.pip_packages) if self.prebaked else ([], [])
+			self.image = derive_image(self.client, self.image, *packages, image.getfloat("max-age-hours") * 3600, upgrade=self.prebaked and not args.skip_apt, uid=uid, gid=gid)
+
+		# New data directories are seeded from a golden SRCDS install, which is brought up to date here first
+		golden = self.config["golden"]
+		instrumentation.phase("golden install update")
+		if golden.getboolean("enabled"):
+			if os.getuid() != 1000 or os.getgid() != 1000:
+				print("\nWARNING: The golden SRCDS install requires the host user's UID/GID to be 1000:1000; not using it.")
 			else:
-				print(f"WARNING: Path does not exist: {p}")
-		os.chdir(repo)
-
-	# Load our plugin database.
-	with open("plugins.json") as f:
-		plugin_db = json.load(f)
-
-	# Set the user agent for urllib.request.urlretrieve(), used for file downloads
-	opener = urllib.request.build_opener()
-	opener.addheaders = [("User-Agent", f"setup.py/{_version} ({_repo})")]
-	urllib.request.install_opener(opener)
-
-	# Now download and install the plugins requested.
-	session = requests.Session()
-	# Set the user agent for the session, used for requesting webpages
-	session.headers.update({"User-Agent": f"setup.py/{_version} ({_repo})"})
-	requested_plugins = str_to_list(plugins.get("requested-plugins"))
-	if requested_plugins:
-		for pname in requested_plugins:
-			if pname == "":
-				if len(requested_plugins) == 1:
-					print("No plugins requested...")
-				else:
-					print("WARNING: Extra comma in requested-plugins?")
+				self.golden = update_golden(self.client, base_image, golden["path"], golden.getfloat("max-age-hours") * 3600, self.config["readiness"].getfloat("install-timeout"))
+
+		# The profile is applied once, and the result is reused by every instance
+		if self.config["bundle"].getboolean("enabled"):
+			self.bundles = BundleCache("bundles", args.profile_name, keep=self.config["bundle"].getint("keep"))
+		instrumentation.end_phase()
+
+	# Cleans up shared downloads and reports on them
+	def close(self):
+		self.stager.close()
+		self.plugin_lock.save()
+		self.artifacts.report()
+		instrumentation.shared.finish()
+
+
+# ======== Configure an instance ========
+
+# Looks up an instance's gameserver login token, warning if there isn't one
+def get_login_token(config, region_name, instance_number):
+	gameserver_login_token = ""
+	try:
+		section_name = f"region:{region_name}"
+		tokens = str_to_list(config[section_name].get("SRCDS_LOGIN_TOKENS"))
+		gameserver_login_token = tokens[instance_number - 1]
+		if gameserver_login_token == "":
+			print(f"\nWARNING: You have not entered a gameserver login token in credentials.ini (SRCDS_LOGIN_TOKENS) under the [{section_name}] section.\n" \
+				"Without one, your server might not display in the community server browser, be reachable, or be able to communicate with the item server.\n" \
+				"You probably want to create one at: https://steamcommunity.com/dev/managegameservers\n" \
+				"See sample-credentials.ini for instructions on how to store your credentials.")
+		elif len(gameserver_login_token) != 32:
+			error(f"\nInvalid gameserver login token for instance number {instance_number} of region {region_name}: {gameserver_login_token}", is_issue=False)
+	except KeyError:
+		print(f"\nWARNING: You have not defined any gameserver login tokens in credentials.ini for the {region_name} region.")
+	except IndexError:
+		error(f"\nA gameserver login token is not present for instance number {instance_number} of region {region_name}!", is_issue=False)
+	return gameserver_login_token
+
+
+# Works out an instance's own configuration: the profile's, with the instance's passwords, ports, token and hostname
+# Returns the configuration, its srcds section, and the environment the container is created with
+def configure_instance(args, deployment, container_name):
+	# Each instance gets its own copy of the configuration since some values are instance-specific
+	config = copy_config(deployment.config)
+
+	# srcds configuration time
+	srcds = config["srcds"]
+	creds = config["credentials"]
+
+	# Check if we actually have a token first, though
+	gameserver_login_token = get_login_token(config, args.region_name, args.instance_number)
+
+	# Check if the profile wants a random server/rcon password
+	for i in ["SRCDS_PW", "SRCDS_RCONPW"]:
+		if srcds[i] == "random":
+			fname = f"container-passwords/{container_name}_{i}.txt"
+			# Renders use the password the instance was provisioned with, and never replace a saved one
+			if args.render and os.path.exists(fname):
+				with open(fname) as f:
+					srcds[i] = f.read().strip()
 				continue
-			# Handle plugins with optional features
-			to_process = [pname]
-			features_start = pname.find("[")
-			if features_start != -1:
-				base = pname[:features_start]
-				feature_names = pname[features_start + 1:-1].split("&")
-				print(f"\n{base} requested with features: {', '.join(feature_names)}")
-				to_process = {base}
-				# Plugin requirements
-				if "requires" in plugin_db["plugins"][base]:
-					for requirement in plugin_db["plugins"][base]["requires"]:
-						to_process.add(requirement)
-				# Enabled plugin feature requirements
-				for fname in feature_names:
-					for f_requirement in plugin_db["plugins"][base]["optional_features"][fname]["requires"]:
-						to_process.add(f_requirement)
-				print(f"Plugins to fetch: {', '.join(to_process)}")
-			for pname in to_process:
-				print(f"\nDownloading and installing plugin: {pname}")
-				# Get the plugin entry
-				p = plugin_db["plugins"][pname]
-				# For plugins downloaded from attachments and plugin compiler links.
-				extract_to = f"container-data/{container_name}/tf/"
-				# Overridden by the force_extract_to parameter.
-				if "force_extract_to" in p:
-					extract_to = f"container-data/{container_name}/{p['force_extract_to']}"
-				# Directly download the plugin from the specified URL and install it as specified
-				if "force_download" in p:
-					print("\tDownloading and installing according to plugins.json...")
-
-					# Grab plugin download configuration values
-					url = p["force_download"]["url"]
-					format = p['force_download']['format']
-					assert format.startswith(".")
-					strip_leading_dir = p["force_download"].get("strip_leading_dir")
-					install_location = p["force_download"]["install_location"]
-
-					# We're using this legacy urllib method because it lets us specify a destination filename easily
-					dest_filename = f"downloads/{pname}{format}"
-					urllib.request.urlretrieve(p["force_download"]["url"], dest_filename)
-
-					# Handle installation
-					if format == ".zip":
-						unzip(dest_filename, f"container-data/{container_name}/{install_location}", strip_leading_dir=strip_leading_dir)
-					elif format == ".tar.gz":
-						# Extract.
-						extracted = untar(dest_filename)
-
-						# Now copy it in and then delete the extracted files
-						shutil.copytree(extracted, f"container-data/{container_name}/{install_location}", dirs_exist_ok=True)
-						shutil.rmtree(extracted)
-					elif format == ".smx":
-						try:
-							# Literally just move it into the server
-							shutil.move(dest_filename, f"container-data/{container_name}/{install_location}")
-						except shutil.Error:
-							# Probably alreadys exists due to --force-reuse
-							# Might as well do a lazy check that this is the case
-							assert args.force_reuse
+			srcds[i] = genpass()
+			if args.render:
+				print(f"\nThe {i} has been changed to: {srcds[i]} for this render only.")
+				continue
+			with open(fname, "w") as f:
+				f.write(f"{srcds[i]}\n")
+			print(f"\nThe {i} has been changed to: {srcds[i]}\nFor your convenience, it has been saved to {fname}.")
+
+	# Different SRCDS instances need different ports!
+	# Replacements built by rolling updates run alongside their instance, so they get ports of their own until they're swapped in
+	offset = config["rolling"].getint("staging-port-offset") if args.staging else 0
+	srcds["SRCDS_PORT"] = str(int(srcds["SRCDS_START_PORT"]) + args.instance_number - 1 + offset)
+	print(f"\nSRCDS port set to {srcds['SRCDS_PORT']}.")
+	srcds["SRCDS_TV_PORT"] = str(int(srcds["SRCDS_TV_START_PORT"]) + args.instance_number - 1 + offset)
+	print(f"SourceTV port set to {srcds['SRCDS_TV_PORT']}.")
+	# We use different key names in our credential configuration files for clarity
+	# A token can only be logged in on one server at a time, so replacements only get theirs when they're swapped in
+	srcds["SRCDS_TOKEN"] = "" if args.staging else gameserver_login_token
+	srcds["SRCDS_WORKSHOP_AUTHKEY"] = creds["STEAM_WEB_API_KEY"]
+	# Construct an environment dict from our config for the docker image to use on its first run
+	env = dict(srcds.items())
+
+	# Adds the region name and instance number to the server hostname if enabled
+	if srcds.getboolean("append-identifier-to-hostname"):
+		srcds["SRCDS_HOSTNAME"] = f"{srcds['SRCDS_HOSTNAME']} | {args.region_name} | {args.instance_number}"
+	# Replacements don't pass for the instance in the server browser while it's still running
+	if args.staging:
+		srcds["SRCDS_HOSTNAME"] += STAGING_HOSTNAME_SUFFIX
+
+	return config, srcds, env
+
+
+# Returns a function that runs plugin installer scripts with access to an instance's state
+# Config edits go through the given workspace
+def custom_installation_runner(args, deployment, config, container_name, data_directory, workspace):
+	# Edit configuration options easily by replacing patterns
+	def edit(cfg, pattern, repl):
+		workspace.open(cfg).sub(pattern, repl)
+
+	def handle_custom_installation(cust_inst):
+		# Installer scripts run with setup.py's globals, plus the helpers and state they use spelled out
+		namespace = dict(globals(), args=args, config=config, container_name=container_name, data_directory=data_directory, edit=edit, extract=extract, keyvalues=workspace.open_keyvalues, session=deployment.session, artifacts=deployment.artifacts, plugin_lock=deployment.plugin_lock)
+		filename = cust_inst["file_to_exec"]
+		with open(f"plugin-installers/{filename}") as f:
+			exec(f.read(), namespace)
+		if "function_to_call" in cust_inst:
+			func_name = cust_inst["function_to_call"]
+			arg_str = ""
+			if "function_arguments" in cust_inst:
+				arg_str = cust_inst["function_arguments"]
+			exec(f"{func_name}({arg_str})", namespace)
+	return handle_custom_installation
+
+
+# Makes the configured server name and rcon password persistent
+def set_server_identity(workspace, hostname, rcon_password):
+	server_cfg = workspace.open("tf/cfg/server.cfg")
+	server_cfg.set(f"hostname {hostname}")
+	server_cfg.set(f"rcon_password {rcon_password}")
+
+
+# Does what's the same for every instance of the profile: the profile layers, SourceMod plugin toggles and plugin
+# installation. With a hook context, the profile's offline hooks run between the layers and the plugins.
+# Returns the deferred installations
+def apply_profile(args, deployment, config, data_directory, workspace, handle_custom_installation, hook_context=None):
+	# Direct-copy and append files from the global profile and selected profile
+	# A reused data directory only gets what changed since the last time, according to its manifest
+	print(f"\nApplying configurations from the \"global\" and \"{args.profile_name}\" profiles...")
+	apply_layers(["global", args.profile_name], data_directory, workspace)
+
+	# Execute any user scripts for the profile
+	if hook_context is not None:
+		instrumentation.phase("preinst modules")
+		deployment.hooks.run("offline", hook_context)
+
+	# ======== Install server plugins ========
+
+	post_installation_plugins = []
+
+	if config.has_section("plugins"):
+		instrumentation.phase("plugin installation")
+		header("Installing plugins...", newlines=(0, 1))
+		plugins = config["plugins"]
+
+		# Deal with special keys first
+		# TODO: RGL goes here or something... maybe a preinst-module would be better for fetching maps..?
+
+		# Enable the specified plugins included with SourceMod but which are disabled by default
+		plugins_to_enable = str_to_list(plugins.get("enable-plugins"))
+		if plugins_to_enable:
+			plugins_dir = pathlib.PosixPath(f"{data_directory}/tf/addons/sourcemod/plugins/")
+			for pname in plugins_to_enable:
+				if pname == "":
+					if len(plugins_to_enable) == 1:
+						print("No plugins to enable...")
 					else:
-						error("ERROR: Unknown plugin download extension: {format}", is_issue=True)
-				elif "custom_install" in p:
-					cust_inst = p["custom_install"]
-					# Defer plugin configuration scripts that rely on autogenerated configs
-					if "post_installation" in cust_inst:
-						if cust_inst["post_installation"]:
-							print(f"Deferring installation of {pname}...")
-							post_installation_plugins.append(cust_inst)
-							continue
-					handle_custom_installation(cust_inst)
-				# Otherwise, try to get a download link from the plugin's AlliedModders thread's webpage HTML
+						print("WARNING: Extra comma in enable-plugins?")
+					continue
+				print(f"Enabling plugin: {pname}")
+				s_fname = f"{pname}.smx"
+				p = plugins_dir / "disabled" / s_fname
+				if p.exists():
+					p.replace(plugins_dir / s_fname)
 				else:
-					print(f"\tAttempting to download the plugin from the AlliedModders forum thread ({p['thread_url']})...")
-					response = session.get(p["thread_url"])
-					content = response.content.decode("latin")
-					# Option A: Try to get an attachment; currently, we only look for a zip
-					attachment_urls_escaped = re.findall(r'(?<=href=")attachment.php.*(?=")(?=.*zip)', content)
-					try:
-						# Note that this variable is just in the singular form
-						attachment_url_escaped = select_plugin_url(p, attachment_urls_escaped, type="attachment")
-						print(f"\tGot (escaped) plugin attachment URL from thread: {attachment_url_escaped}")
-						attachment_url = html.unescape(attachment_url_escaped)
-						print(f"\tGot plugin attachment URL from thread: {attachment_url}")
-						urllib.request.urlretrieve(f"https://forums.alliedmods.net/{attachment_url}", f"downloads/{pname}.zip")
-						unzip(f"downloads/{pname}.zip", extract_to)
-					# Option B: No attachments found; try to get the plugin as compiled from source
-					except ValueError as ex:
-						print(ex)
-						print("\tWARNING: No attachment URLs found, falling back to plugin compiler links...")
-						plugin_compiler_urls = re.findall(r'(?<=href=")https://www.sourcemod.net/vbcompiler.php\?file_id=\d+', content)
-						try:
-							# Note that this variable is just in the singular form
-							plugin_compiler_url = select_plugin_url(p, plugin_compiler_urls, type="compiler")
-							print(f"\tGot plugin compiler URL from thread: {plugin_compiler_url}")
-							# Download it directly into the server
-							urllib.request.urlretrieve(plugin_compiler_url, f"container-data/{container_name}/tf/addons/sourcemod/plugins/{pname}.smx")
-						except ValueError:
-							# No plugin compiler links found, raise and exit
-							raise
-
-
-header("Plugin installation complete, starting the container...", newlines=(2, 0))
-container.start()
-
-
-# ======== Reconfigure server plugins ========
-
-# The last thing we have to do is reconfigure plugins.
-# Config files will have been generated for newly-installed plugins once the server is online.
-print("\nWaiting for the server to come online so we can reconfigure any plugins...")
-waitForServer(args.host_ip, int(srcds["SRCDS_PORT"]))
-
-header("Processing deferred installations...", newlines=(1, 1))
-for cust_inst in post_installation_plugins:
-	handle_custom_installation(cust_inst)
-
-header("Reconfiguring plugins...", newlines=(1, 1))
-p = pathlib.PosixPath(f"{profile_prefix}/reconfigure/")
-for f in p.glob("**/*"):
-	if f.is_file():
-		# Load the file as-is
-		rel_path = f.relative_to(f"{profile_prefix}/reconfigure/")
-		sv_f = pathlib.PosixPath(f"{data_directory}/{rel_path}")
-		sv_f_as_is = sv_f.read_text()
-
-		# Conjure and write new contents
-		sv_f_data = sv_f_as_is
-		for line in f.read_text().split("\n"):
-			if line == "" or line.startswith("//"):
-				continue
-			print(f"Processing line from {f}: {line}")
-			key = line.split(" ")[0]
-			print(f"Got key \"{key}\", substituting matching lines")
-			sv_f_data = re.sub(f"^{key}.*", line, sv_f_data, flags=re.M)
-		sv_f.write_text(sv_f_data)
-
-
-# ======== Yeet ========
-
-header("Configuration complete, restarting the container...", newlines=(2, 1))
-container.restart()
-
-if not args.no_wait:
-	waitForServer(args.host_ip, int(srcds["SRCDS_PORT"]))
+					print(f"WARNING: Path does not exist: {p}")
+
+		# Disable the specified plugins included with SourceMod
+		plugins_to_disable = str_to_list(plugins.get("disable-plugins"))
+		if plugins_to_disable:
+			plugins_dir = pathlib.PosixPath(f"{data_directory}/tf/addons/sourcemod/plugins/")
+			for pname in plugins_to_disable:
+				if pname == "":
+					if len(plugins_to_disable) == 1:
+						print("No plugins to disable...")
+					else:
+						print("WARNING: Extra comma in disable-plugins?")
+					continue
+				print(f"Disabling plugin: {pname}")
+				s_fname = f"{pname}.smx"
+				p = plugins_dir / s_fname
+				if p.exists():
+					p.unlink()
+				else:
+					print(f"WARNING: Path does not exist: {p}")
+
+		# Now download and install the plugins requested.
+		# Downloads and extraction happen concurrently and are shared between instances; only copying into the server is serialized
+		print(f"\nDownloading and installing {len(deployment.to_install)} plugin(s), up to {deployment.downloads.getint('parallel-downloads')} at a time...")
+		post_installation_plugins = install_plugins(deployment.to_install, deployment.stager, data_directory, handle_custom_installation)
+	return post_installation_plugins
+
+
+# Returns the profile's bundle, building it from this instance's freshly installed data directory if this run
+# doesn't have one yet and there isn't one cached for the same inputs
+def profile_bundle(args, deployment, config, data_directory):
+	plugins = deployment.plugin_db["plugins"]
+	custom = [pname for pname in deployment.to_install if "custom_install" in plugins[pname]]
+	# What the plugins' downloads resolved to is part of the bundle's key, so they're resolved first. Installer scripts
+	# resolve their own downloads as they run, so bundles with those are only reused when the lock pins them.
+	for pname in deployment.to_install:
+		if pname not in custom:
+			deployment.stager.stage(pname).result()
+	reuse = not custom or deployment.plugin_lock.locked or deployment.artifacts.offline
+
+	def key():
+		installers = sorted({plugins[pname]["custom_install"]["file_to_exec"] for pname in custom})
+		inputs = {
+			"setup": _version,
+			# Instance-specific server settings only go into server.cfg, as placeholders
+			"config": {section: dict(deployment.config.items(section, raw=True)) for section in deployment.config.sections() if section != "srcds"},
+			"plugins": {pname: plugins[pname] for pname in deployment.to_install},
+			"installers": {filename: sha256_file(f"plugin-installers/{filename}") for filename in installers},
+			# The SBPP installer script reads this too
+			"sbpp.ini": sha256_file("sbpp.ini") if os.path.exists("sbpp.ini") else None,
+			"lock": deployment.plugin_lock.snapshot(),
+		}
+		return bundle_key(["global", args.profile_name], deployment.image, inputs)
+
+	def build(tree):
+		workspace = CfgWorkspace(tree)
+		handle_custom_installation = custom_installation_runner(args, deployment, config, f"bundle-{args.profile_name}", tree, workspace)
+		set_server_identity(workspace, PLACEHOLDERS["SRCDS_HOSTNAME"], PLACEHOLDERS["SRCDS_RCONPW"])
+		deferred = apply_profile(args, deployment, config, tree, workspace, handle_custom_installation)
+		workspace.flush()
+		return deferred
+
+	instrumentation.phase("profile bundle")
+	return deployment.bundles.get(key, data_directory, build, reuse=reuse)
+
+
+# Does everything to a data directory that doesn't need the container: the server.cfg basics, the profile (from its
+# bundle, if given), profile modules, deferred installations and reconfigure files
+# Returns the workspace (which the caller flushes), the custom installation runner, and the deferred installations
+# that still need configs the server generates when it first loads the new plugins
+def configure_data_directory(args, deployment, config, container_name, data_directory, hook_context, bundle=None):
+	srcds = config["srcds"]
+
+	# Config files are edited in memory and written out once before each boot
+	workspace = CfgWorkspace(data_directory)
+	handle_custom_installation = custom_installation_runner(args, deployment, config, container_name, data_directory, workspace)
+
+	# ======== Configure the server ========
+
+	header("Starting configuration...", newlines=(1, 0))
+	if bundle is None:
+		instrumentation.phase("profile layers")
+		# The first thing to do is make the configured server name and rcon password persistent.
+		set_server_identity(workspace, srcds["SRCDS_HOSTNAME"], srcds["SRCDS_RCONPW"])
+		post_installation_plugins = apply_profile(args, deployment, config, data_directory, workspace, handle_custom_installation, hook_context)
+	else:
+		# Everything that's the same for every instance comes from the bundle; this instance's own values go on top
+		bundle.apply(data_directory)
+		fill_placeholders(workspace.open("tf/cfg/server.cfg"), srcds)
+		instrumentation.phase("preinst modules")
+		deployment.hooks.run("offline", hook_context)
+		post_installation_plugins = bundle.deferred
+
+	deployment.hooks.run("post-plugin", hook_context)
+
+	# ======== Reconfigure server plugins ========
+
+	# Deferred installations are run right away if the configs they edit are already there (shipped with the plugins,
+	# or left over from a reused data directory). Only those that need configs the server generates when it first
+	# loads the new plugins wait for a config boot.
+	instrumentation.phase("deferred installations")
+	header("Processing deferred installations...", newlines=(1, 1))
+	pending = []
+	for cust_inst in post_installation_plugins:
+		try:
+			handle_custom_installation(cust_inst)
+		except FileNotFoundError as ex:
+			# Only files in the data directory can be generated by the server; anything else is missing for good
+			if ex.filename is None or not pathlib.PosixPath(ex.filename).resolve().is_relative_to(pathlib.PosixPath(data_directory).resolve()):
+				raise
+			print(f"{cust_inst['file_to_exec']} needs {ex.filename}, which the server hasn't generated yet; running it after a config boot.")
+			pending.append(cust_inst)
+
+	instrumentation.phase("reconfigure")
+	header("Reconfiguring plugins...", newlines=(1, 1))
+	reconfigure(args.profile_name, data_directory, workspace)
+	return workspace, handle_custom_installation, pending
+
+
+# ======== Provision an instance ========
+
+# Re-applies profile files and reconfigure settings to an existing instance and restarts it
+def reapply(args, deployment):
+	container_name = get_container_name(args.profile_name, args.region_name, args.instance_number)
+	try:
+		data_directory = pathlib.Path.resolve(pathlib.PosixPath(f"container-data/{container_name}"), strict=True)
+	except FileNotFoundError:
+		error(f"ERROR: There is no data directory for {container_name} to re-apply the profile to.", is_issue=False)
+
+	instrumentation.phase("profile layers")
+	print(f"\nRe-applying configurations from the \"global\" and \"{args.profile_name}\" profiles to {container_name}...")
+	workspace = CfgWorkspace(data_directory)
+	apply_layers(["global", args.profile_name], data_directory, workspace)
+	header("Reconfiguring plugins...", newlines=(1, 1))
+	reconfigure(args.profile_name, data_directory, workspace)
+	workspace.flush()
+
+	for c in deployment.client.containers.list(filters={"name": container_name}):
+		if c.name == container_name:
+			instrumentation.phase("restart")
+			header(f"Restarting {container_name}...", newlines=(1, 0))
+			c.restart()
+
+
+# Prints how a rendered data directory differs from an existing one, with unified diffs of the text files that changed
+def print_diff(existing, rendered):
+	only_existing, only_rendered, changed = diff_trees(existing, rendered, ignore={MANIFEST_NAME, STAMP_NAME})
+	header(f"Differences between {existing} (-) and the render (+):", newlines=(2, 1))
+	for rel_path in only_existing:
+		print(f"- {rel_path}")
+	for rel_path in only_rendered:
+		print(f"+ {rel_path}")
+	for rel_path in changed:
+		try:
+			old = (existing / rel_path).read_text().splitlines(keepends=True)
+			new = (rendered / rel_path).read_text().splitlines(keepends=True)
+		except UnicodeDecodeError:
+			print(f"~ {rel_path} (binary)")
+			continue
+		print(f"~ {rel_path}")
+		print("".join(line if line.endswith("\n") else line + "\n" for line in difflib.unified_diff(old, new, f"a/{rel_path}", f"b/{rel_path}")), end="")
+	print(f"\n{len(only_existing)} file(s) only in {existing}, {len(only_rendered)} only in the render, {len(changed)} changed.")
+
+
+# Builds the data directory an instance would be provisioned with from a base SRCDS install, without docker
+# With --diff, it's compared to an existing data directory; without --output, it's then thrown away
+def render(args, deployment):
+	container_name = get_container_name(args.profile_name, args.region_name, args.instance_number)
+	golden = deployment.config["golden"]
+	base = pathlib.PosixPath(args.base or golden["path"]).resolve()
+	if not (base / "tf/cfg/server.cfg").is_file():
+		error(f"ERROR: {base} has no tf/cfg/server.cfg, which the base image generates the first time it boots. Render from the golden install or an existing data directory.", is_issue=False)
+	existing = None
+	if args.diff is not None:
+		existing = pathlib.PosixPath(args.diff or f"container-data/{container_name}")
+		if not existing.is_dir():
+			error(f"ERROR: There is no data directory at {existing} to compare the render to.", is_issue=False)
+
+	temporary = args.output is None and existing is not None
+	if temporary:
+		os.makedirs("renders", exist_ok=True)
+		output = pathlib.PosixPath(tempfile.mkdtemp(dir="renders", prefix=f".{container_name}-"))
+	else:
+		output = pathlib.PosixPath(args.output or f"renders/{container_name}")
+		if output.exists() and any(output.iterdir()):
+			if not args.overwrite:
+				error(f"ERROR: {output} isn't empty; pass --overwrite to replace it.", is_issue=False)
+			print(f"WARNING: Replacing {output}!")
+			shutil.rmtree(output)
+		output.mkdir(parents=True, exist_ok=True)
+
+	try:
+		# Files profile modules write in place are only known to be absent from the golden install, so anything else
+		# is reflinked instead of hardlinked. The base's own server.cfg is kept, since no container will generate one.
+		instrumentation.phase("data directory seeding")
+		mode = golden["seed-mode"]
+		if mode == "hardlink" and base != pathlib.PosixPath(golden["path"]).resolve():
+			mode = "reflink"
+		seed_data_dir(base, output, mode=mode, skipped={MANIFEST_NAME})
+
+		instrumentation.phase("instance configuration")
+		config, _, _ = configure_instance(args, deployment, container_name)
+		skipped_hooks = [phase for phase in ["pre-start", "running", "post-ready"] if deployment.hooks.has(phase)]
+		if skipped_hooks:
+			print(f"\nNOTE: The profile's {', '.join(skipped_hooks)} hooks need the container, so they aren't run for renders.")
+		data_directory = output.resolve()
+		hook_context = HookContext(args.profile_name, args.region_name, args.instance_number, None, data_directory, config)
+		workspace, _, pending = configure_data_directory(args, deployment, config, container_name, data_directory, hook_context)
+		workspace.flush()
+
+		header(f"Rendered {container_name} to {output}.", newlines=(2, 0))
+		if pending:
+			print("These need configs the server generates when it first loads the new plugins, so provisioning does them after a config boot:")
+			for cust_inst in pending:
+				print(f"\t{cust_inst['file_to_exec']}")
+
+		if existing is not None:
+			instrumentation.phase("diff")
+			print_diff(existing, output)
+	finally:
+		if temporary:
+			shutil.rmtree(output)
+
+
+# Creates and configures a single container
+def provision(args, deployment):
+	if args.reapply:
+		return reapply(args, deployment)
+	if args.render:
+		return render(args, deployment)
+	if args.rolling:
+		return rolling_update(args, deployment)
+	client = deployment.client
+	container_name = get_container_name(args.profile_name, args.region_name, args.instance_number, args.staging)
+
+	# ======== Prepare the container configuration ========
+
+	# Make sure a container doesn't already exist with this name
+	instrumentation.phase("container checks")
+	print(f"Using container name {container_name}; checking for pre-existing containers...")
+	preexisting = client.containers.list(all=True, filters={"name": container_name})
+	descriptors = [f"{i}: {i.name}" for i in preexisting]
+	if descriptors:
+		if not args.overwrite:
+			message = f"ERROR: Found {len(preexisting)} pre-existing container(s) matching the name \"{container_name}\":\n"
+			message += f"\t{descriptors}\n\n"
+			message += "You may need to delete them or pick another identifier."
+			error(message, is_issue=False)
+		else:
+			# "Overwrite" the container(s)
+			print("WARNING: Overwriting preexisting containers!")
+			for c in preexisting:
+				if c.status == "running":
+					print(f"Killing container \"{c.name}\" ({c})...")
+					c.kill()
+				print(f"Removing container \"{c.name}\" ({c})...")
+				c.remove(v=True)
+	else:
+		print("No conflictingly named containers found.")
+
+	# Set up a persistent data directory for the container
+	data_dir = pathlib.PosixPath(f"container-data/{container_name}")
+	if data_dir.exists() and args.erase:
+		print("WARNING: Erasing existing container data!")
+		shutil.rmtree(data_dir)
+	try:
+		pathlib.Path.mkdir(data_dir, parents=True)
+		# Seed the new data directory so SteamCMD only has to verify the game files
+		if deployment.golden:
+			instrumentation.phase("data directory seeding")
+			seed_data_dir(deployment.golden, data_dir, mode=deployment.config["golden"]["seed-mode"])
+	except FileExistsError:
+		if not args.force_reuse:
+			message = "ERROR: A data directory for a container with this name already exists."
+			message += "\nSince there doesn't seem to be an associated container, you may wish to delete it."
+			error(message, is_issue=False)
+
+	# ======== Load and process configuration files ========
+
+	instrumentation.phase("instance configuration")
+	config, srcds, env = configure_instance(args, deployment, container_name)
+
+	# ======== Initialize the container ========
+
+	# Create the container
+	instrumentation.phase("container creation")
+	data_directory = pathlib.Path.resolve(pathlib.PosixPath(f"container-data/{container_name}"), strict=True)
+	container = client.containers.create(deployment.image, cpuset_cpus=args.cpu_affinity, detach=True, environment=env, name=container_name, network_mode="host", volumes={data_directory: {"bind": "/home/steam/tf-dedicated/"}})
+
+	# How long each phase took to become ready
+	readiness = config["readiness"]
+	timings = {}
+	def wait_for_server(phase):
+		probe = server_probe(readiness["server-probe"], deployment.host_ip, int(srcds["SRCDS_PORT"]), rcon_password=srcds["SRCDS_RCONPW"])
+		wait_for(phase, probe, readiness.getfloat("server-timeout"), timings, initial_delay=readiness.getfloat("initial-delay"), max_delay=readiness.getfloat("max-delay"))
+
+	# Every boot costs a SteamCMD validation and a server start, so there's one to install SRCDS and one to run the
+	# configured server, plus one in between only if something needs configs the server generates
+	boots = []
+	def boot(reason, restart=False):
+		boots.append(reason)
+		instrumentation.count("container_boots")
+		print(f"{'Restarting' if restart else 'Starting'} the container ({reason} boot)...")
+		if restart:
+			container.restart()
+		else:
+			container.start()
+
+	# Profile modules that need the container before it first starts
+	hook_context = HookContext(args.profile_name, args.region_name, args.instance_number, container, data_directory, config)
+	deployment.hooks.run("pre-start", hook_context)
+
+	# Only output from this boot onwards counts when waiting for the install to finish
+	booted = int(time.time())
+	boot("install")
+
+	# Now we need to do all the actual setup stuff.
+	instrumentation.phase("SRCDS install")
+	print("Waiting for the base docker image to install the TF2 SRCDS with SourceMod before installing profile configurations, files, and plugins...\n")
+	wait_for("SRCDS install", install_probe(container, since=booted), readiness.getfloat("install-timeout"), timings)
+	header("SRCDS installed!", newlines=(1, 0))
+
+	# ======== Update the base system ========
+
+	# The derived image already has everything, otherwise it's installed into this container
+	# With --skip-apt, only the profile's own packages are installed, without upgrading the base system
+	if not deployment.prebaked and (not args.skip_apt or deployment.apt_packages or deployment.pip_packages):
+		instrumentation.phase("apt upgrade")
+		header("Upgrading the base system and installing extra packages..." if not args.skip_apt else "Installing the profile's packages...", newlines=(1, 0))
+		session = ExecSession(container, "root")
+		if not args.skip_apt or deployment.apt_packages:
+			session.add("apt update")
+		if not args.skip_apt:
+			session.add("apt full-upgrade -y")
+		if deployment.apt_packages:
+			session.add(f"apt install {' '.join(deployment.apt_packages)} -y")
+		if not args.skip_apt:
+			session.add("apt autoremove --purge -y")
+		session.run()
+		if deployment.pip_packages:
+			ExecSession(container, "steam").add(f"pip3 install {' '.join(deployment.pip_packages)}").run()
+
+	# Everything profile modules need to do inside the container happens while it's up anyway
+	if deployment.hooks.has("running"):
+		instrumentation.phase("running hooks")
+		deployment.hooks.run("running", hook_context)
+
+	# Go ahead and shutdown the server while we set things up.
+	header("Killing the container for server configuration...")
+	container.kill()
+
+	# Fresh data directories get the profile from its bundle; reused ones have their manifest's changes applied instead
+	bundle = None
+	if deployment.bundles and not (data_directory / MANIFEST_NAME).exists():
+		bundle = profile_bundle(args, deployment, config, data_directory)
+	workspace, handle_custom_installation, pending = configure_data_directory(args, deployment, config, container_name, data_directory, hook_context, bundle)
+
+	if pending:
+		instrumentation.phase("plugin config generation")
+		header("Starting the container so the server generates the remaining plugin configs...", newlines=(2, 0))
+		workspace.flush()
+		boot("config")
+		wait_for_server("plugin config generation")
+		for cust_inst in pending:
+			handle_custom_installation(cust_inst)
+
+	# ======== Yeet ========
+
+	instrumentation.phase("final boot")
+	header("Configuration complete, starting the server...", newlines=(2, 1))
+	workspace.flush()
+	boot("final", restart=bool(pending))
+
+	# Hooks that need the server up are waited for even with --no-wait
+	if not args.no_wait or deployment.hooks.has("post-ready"):
+		wait_for_server("final boot")
+	if deployment.hooks.has("post-ready"):
+		instrumentation.phase("post-ready hooks")
+		deployment.hooks.run("post-ready", hook_context)
+
+	print("Time to ready: " + ", ".join(f"{phase} {elapsed:.1f}s" for phase, elapsed in timings.items()))
+	print(f"Booted the container {len(boots)} time(s): {', '.join(boots)}.")
+
+
+# ======== Rolling updates ========
+
+# Returns the environment a container was created with
+def container_environment(container):
+	return dict(variable.split("=", 1) for variable in container.attrs["Config"]["Env"])
+
+
+# Returns the image a rolling update last recreated an instance's container from, or None
+def get_rolling_image(client, container_name):
+	try:
+		return client.images.get(f"{ROLLING_REPOSITORY}:{container_name}")
+	except docker.errors.ImageNotFound:
+		return None
+
+
+# Removes an image a rolling update recreated an instance's container from, once no container uses it
+def remove_rolling_image(client, image, container_name):
+	if image is None:
+		return
+	try:
+		client.images.remove(image.id)
+		print(f"Removed the image {container_name} was last recreated from.")
+	except docker.errors.APIError as ex:
+		print(f"WARNING: Couldn't remove the image {container_name} was last recreated from: {ex}")
+
+
+# Replaces a running instance without dropping its players. A replacement is provisioned alongside it, on ports of its
+# own and without the instance's gameserver login token, and has to come up before anything happens to the running
+# server. Once that server is empty (or the drain timeout passes), the replacement's data directory takes over and its
+# container is recreated on the instance's own name, ports and token, which costs the instance a single restart.
+def rolling_update(args, deployment):
+	client = deployment.client
+	container_name = get_container_name(args.profile_name, args.region_name, args.instance_number)
+	running = [c for c in client.containers.list(filters={"name": container_name}) if c.name == container_name]
+	if not running:
+		print(f"{container_name} isn't running, so there are no players to keep; provisioning it in place.")
+		previous_image = get_rolling_image(client, container_name)
+		provision(argparse.Namespace(**dict(vars(args), rolling=False, overwrite=True, erase=True)), deployment)
+		remove_rolling_image(client, previous_image, container_name)
+		return
+	current = running[0]
+
+	header(f"Provisioning a replacement for {container_name} alongside it...", newlines=(1, 0))
+	provision(argparse.Namespace(**dict(vars(args), rolling=False, staging=True, overwrite=True, erase=True, no_wait=False)), deployment)
+	staging_name = get_container_name(args.profile_name, args.region_name, args.instance_number, staging=True)
+	replacement = client.containers.get(staging_name)
+	replacement.kill()
+	# The image the running container was recreated from by the last rolling update, if it was, goes once it's gone
+	previous_image = get_rolling_image(client, container_name)
+	# Anything the replacement's container has outside its data directory (packages, profile module edits to the
+	# entry script) carries over through an image of it
+	image = replacement.commit(repository=ROLLING_REPOSITORY, tag=container_name)
+
+	instrumentation.phase("drain")
+	rolling = deployment.config["rolling"]
+	drained = wait_until_empty(deployment.host_ip, int(container_environment(current)["SRCDS_PORT"]), rolling.getfloat("drain-timeout"), rolling.getfloat("drain-interval"))
+	if drained == "unreachable":
+		print(f"WARNING: {container_name} isn't answering player count queries; swapping it out without knowing whether anyone is on it.")
+
+	instrumentation.phase("swap")
+	header(f"Swapping the replacement in for {container_name}...", newlines=(1, 0))
+	# The data directories trade places first, while the running server keeps using its own (renamed) one, so the
+	# instance is left as it was if that fails. The old data directory is kept until the swapped-in server is up.
+	data_directory = pathlib.PosixPath(f"container-data/{container_name}")
+	retired = pathlib.PosixPath(f"container-data/{container_name}-old")
+	staged = pathlib.PosixPath(f"container-data/{staging_name}")
+	if not (staged / "tf/cfg/server.cfg").is_file():
+		error(f"\nERROR: The replacement's data directory {staged} has no tf/cfg/server.cfg; leaving {container_name} as it is.", is_issue=True)
+	shutil.rmtree(retired, ignore_errors=True)
+	if data_directory.exists():
+		data_directory.rename(retired)
+	try:
+		staged.rename(data_directory)
+	except OSError as ex:
+		if retired.exists():
+			retired.rename(data_directory)
+		error(f"\nERROR: Couldn't move the replacement's data directory into place ({ex}); leaving {container_name} as it is.", is_issue=False)
+	# The replacement ran under a hostname of its own
+	workspace = CfgWorkspace(data_directory)
+	workspace.open("tf/cfg/server.cfg").sub(rf"^(hostname .*){re.escape(STAGING_HOSTNAME_SUFFIX)}$", lambda match: match.group(1))
+	workspace.flush()
+	for password in pathlib.PosixPath("container-passwords").glob(f"{staging_name}_*.txt"):
+		password.replace(password.with_name(container_name + password.name[len(staging_name):]))
+	env = container_environment(replacement)
+	for variable in ["SRCDS_PORT", "SRCDS_TV_PORT"]:
+		env[variable] = str(int(env[variable]) - rolling.getint("staging-port-offset"))
+	env["SRCDS_TOKEN"] = get_login_token(deployment.config, args.region_name, args.instance_number)
+
+	current.kill()
+	current.remove(v=True)
+	replacement.remove(v=True)
+	container = client.containers.create(image.id, cpuset_cpus=args.cpu_affinity, detach=True, environment=env, name=container_name, network_mode="host", volumes={data_directory.resolve(): {"bind": "/home/steam/tf-dedicated/"}})
+	instrumentation.count("container_boots")
+	container.start()
+	if previous_image is not None and previous_image.id != image.id:
+		remove_rolling_image(client, previous_image, container_name)
+
+	if not args.no_wait:
+		readiness = deployment.config["readiness"]
+		probe = server_probe(readiness["server-probe"], deployment.host_ip, int(env["SRCDS_PORT"]), rcon_password=env["SRCDS_RCONPW"])
+		wait_for("swapped-in server", probe, readiness.getfloat("server-timeout"), initial_delay=readiness.getfloat("initial-delay"), max_delay=readiness.getfloat("max-delay"))
+	shutil.rmtree(retired, ignore_errors=True)
+	print(f"{container_name} is now running its replacement.")
+
+
+# ======== Entry points ========
+
+# Provisions an instance while recording how long each phase takes, adding its recorder to recorders
+# With --cprofile, the instance's Python code is also profiled with cProfile
+def instrumented_provision(args, deployment, recorders):
+	container_name = get_container_name(args.profile_name, args.region_name, args.instance_number)
+	recorder = instrumentation.Recorder(container_name)
+	recorders.append(recorder)
+	recorder.activate()
+	profile_path = f"{args.report_dir}/{container_name}.prof" if args.cprofile else None
+	try:
+		with instrumentation.profiled(profile_path):
+			provision(args, deployment)
+		recorder.result = "ready"
+	except BaseException as ex:
+		recorder.result = f"FAILED: {type(ex).__name__}: {str(ex).strip()}"
+		raise
+	finally:
+		recorder.finish()
+
+
+# Saves the report for this run of setup.py
+def save_run_report(args, recorders, name):
+	report = instrumentation.run_report(recorders, sys.argv)
+	path = instrumentation.save_report(report, args.report_dir, name)
+	print(f"\nSaved the timing report to {path}")
+	return report
+
+
+# Provisions a single instance
+def main(argv):
+	args = parse_args(argv)
+	recorders = []
+	try:
+		with instrumentation.profiled(f"{args.report_dir}/deployment.prof" if args.cprofile else None):
+			deployment = Deployment(args)
+		try:
+			instrumented_provision(args, deployment, recorders)
+		finally:
+			deployment.close()
+	finally:
+		save_run_report(args, recorders, get_container_name(args.profile_name, args.region_name, args.instance_number))
+
+
+# Renders a single instance's data directory
+def render_main(argv):
+	args = parse_render_args(argv)
+	container_name = get_container_name(args.profile_name, args.region_name, args.instance_number)
+	recorders = []
+	try:
+		deployment = Deployment(args)
+		try:
+			instrumented_provision(args, deployment, recorders)
+		finally:
+			deployment.close()
+	finally:
+		save_run_report(args, recorders, f"render-{container_name}")
+
+
+# Provisions several instances of a region at once, with at most args.parallel of them in progress at a time
+def fleet_main(argv):
+	args = parse_fleet_args(argv)
+	instance_numbers = parse_instances(args.instances)
+	with instrumentation.profiled(f"{args.report_dir}/deployment.prof" if args.cprofile else None):
+		deployment = Deployment(args)
+	recorders = []
+
+	# Rolling updates take one instance of the region out of service at a time
+	if args.rolling and args.parallel > 1:
+		print("Rolling updates replace one instance at a time; ignoring --parallel.")
+		args.parallel = 1
+
+	# Label each line of output with the instance it came from
+	output = LabeledOutput(sys.stdout)
+	sys.stdout = output
+
+	def run(instance_number):
+		instance_args = argparse.Namespace(**vars(args), instance_number=instance_number)
+		container_name = get_container_name(args.profile_name, args.region_name, instance_number)
+		output.label(container_name)
+		start = time.monotonic()
+		try:
+			instrumented_provision(instance_args, deployment, recorders)
+			result = "ready"
+		except SystemExit as ex:
+			result = f"FAILED: {str(ex).strip()}"
+		except Exception as ex:
+			print(traceback.format_exc())
+			result = f"FAILED: {type(ex).__name__}: {ex}"
+		return container_name, result, time.monotonic() - start
+
+	header(f"Provisioning {len(instance_numbers)} instance(s), up to {args.parallel} at a time...", newlines=(1, 1))
+	start = time.monotonic()
+	try:
+		with concurrent.futures.ThreadPoolExecutor(max_workers=args.parallel) as executor:
+			results = list(executor.map(run, instance_numbers))
+	finally:
+		sys.stdout = output.stream
+		deployment.close()
+
+	# Summarize how each instance went
+	header(f"Fleet summary ({time.monotonic() - start:.0f}s total)", newlines=(2, 0))
+	for container_name, result, elapsed in results:
+		print(f"{container_name}: {result} ({elapsed:.0f}s)")
+	report = save_run_report(args, sorted(recorders, key=lambda recorder: recorder.name), f"fleet-{args.profile_name}-{args.region_name}")
+	print()
+	instrumentation.print_summary(report["summary"])
+	if any(result != "ready" for _, result, _ in results):
+		raise SystemExit(1)
+
+
+if __name__ == "__main__":
+	if sys.argv[1:2] == ["fleet"]:
+		fleet_main(sys.argv[2:])
+	elif sys.argv[1:2] == ["render"]:
+		render_main(sys.argv[2:])
+	else:
+		main(sys.argv[1:])
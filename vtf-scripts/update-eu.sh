@@ -6,5 +6,4 @@ set -ex
 # Timezone for Variety.TF EU servers
 export TIMEZONE="Europe/Luxembourg"
 
-time ./setup.py -p variety -r frankfurt -i 1 -o -e
-time ./setup.py -p variety -r frankfurt -i 2 -o -e
+time ./setup.py fleet -p variety -r frankfurt --instances 1-2 --rolling --update-image
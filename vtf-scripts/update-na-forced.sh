@@ -8,5 +8,4 @@ git reset --hard origin/dev
 # Timezone for Variety.TF NA servers
 export TIMEZONE="America/Chicago"
 
-time ./setup.py -p variety -r dallas -i 1 -o -e
-time ./setup.py -p variety -r dallas -i 2 -o -e
+time ./setup.py fleet -p variety -r dallas --instances 1-2 --parallel 2 -o -e --update-image
@@ -5,5 +5,4 @@ set -ex
 # Timezone for Variety.TF NA servers
 export TIMEZONE="America/Chicago"
 
-time ./setup.py -p variety -r test -i 1 -o -e
-time ./setup.py -p variety -r test -i 2 -o -e
+time ./setup.py fleet -p variety -r test --instances 1-2 --parallel 2 -o -e --update-image